@@ -0,0 +1 @@
+"""Performance tooling for the Python services (not shipped in the images)."""
@@ -0,0 +1,619 @@
+"""
+In-memory stand-in for the Elasticsearch client, for benchmarks.
+
+It covers the part of the client API the services use: get, mget, exists,
+index, update (partial docs, scripts, scripted upserts, if_seq_no),
+delete, bulk, count, update_by_query, point-in-time search with
+term/terms/ids/match/range/exists/bool queries, sort, search_after,
+_source filtering and filter/terms/nested/date_histogram/metric aggregations, and the
+index/alias/mapping calls the bootstraps make. Documents are
+copied on the way in and out, as they would be through JSON.
+
+Painless cannot run here. Scripts are looked up by their exact source in
+a registry of Python equivalents, which take the painless-style `ctx` and
+`params`:
+
+    @fake_es.script(transfer_engine.CREDIT_SCRIPT)
+    def credit(ctx, params):
+        ctx['_source']['balance'] += params['amt']
+
+A script that sets ctx['op'] = 'noop' leaves the document unchanged and
+the update reports `noop`, like in Elasticsearch.
+
+`latency` seconds (plus up to `jitter`) are slept at the start of every
+API call. `calls` and `seconds` add up the calls made and the time spent
+in them, so a benchmark can tell the caller's time from the fake's.
+"""
+import copy
+import time
+import uuid
+import random
+import fnmatch
+import functools
+import itertools
+import threading
+from datetime import datetime, timedelta, timezone
+from elasticsearch import NotFoundError, ConflictError, BadRequestError
+
+SCRIPTS = {}
+
+
+def script(source):
+    """Register the decorated function as the Python equivalent of `source`."""
+    def register(fn):
+        SCRIPTS[source] = fn
+        return fn
+    return register
+
+
+def _api(method):
+    """Count the call, add the configured latency and time it."""
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        es = getattr(self, 'es', self)
+        started = time.perf_counter()
+        es.calls += 1
+        delay = es.latency + (random.random() * es.jitter if es.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            es.seconds += time.perf_counter() - started
+    return call
+
+
+class _Meta:
+    def __init__(self, status):
+        self.status = status
+
+
+def _error(cls, status, reason):
+    return cls(reason, _Meta(status), {'error': {'type': reason}, 'status': status})
+
+
+def _field(source, name):
+    if name.endswith('.keyword'):
+        name = name[:-len('.keyword')]
+    value = source
+    for part in name.split('.'):
+        if isinstance(value, list):
+            # Objects in an array are flattened, as in an ES mapping
+            value = [v for item in value if isinstance(item, dict) for v in _as_list(item.get(part))
+                     if v is not None] or None
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def matches(query, doc_id, source):
+    """Whether a document matches `query`; raises NotImplementedError for unsupported clauses."""
+    if not query or 'match_all' in query:
+        return True
+    kind, clause = next(iter(query.items()))
+    if kind == 'bool':
+        if not all(matches(q, doc_id, source) for q in _as_list(clause.get('must', [])) + _as_list(clause.get('filter', []))):
+            return False
+        if any(matches(q, doc_id, source) for q in _as_list(clause.get('must_not', []))):
+            return False
+        should = _as_list(clause.get('should', []))
+        if should:
+            required = clause.get('minimum_should_match', 0 if ('must' in clause or 'filter' in clause) else 1)
+            if sum(matches(q, doc_id, source) for q in should) < int(required):
+                return False
+        return True
+    if kind == 'ids':
+        return doc_id in clause['values']
+    if kind == 'exists':
+        return _field(source, clause['field']) is not None
+
+    name, expected = next(iter(clause.items()))
+    value = _field(source, name)
+    values = value if isinstance(value, list) else [value]
+    if kind == 'term':
+        expected = expected['value'] if isinstance(expected, dict) else expected
+        return expected in values
+    if kind == 'terms':
+        return any(v in expected for v in values)
+    if kind == 'match':
+        expected = expected['query'] if isinstance(expected, dict) else expected
+        return any(str(v).lower() == str(expected).lower() for v in values if v is not None)
+    if kind == 'range':
+        checks = {'gte': lambda v, b: v >= b, 'gt': lambda v, b: v > b,
+                  'lte': lambda v, b: v <= b, 'lt': lambda v, b: v < b}
+        return any(all(checks[op](v, bound) for op, bound in expected.items() if op in checks)
+                   for v in values if v is not None)
+    raise NotImplementedError(f'query clause {kind!r}')
+
+
+def _metric(kind, values):
+    if kind == 'value_count':
+        return {'value': len(values)}
+    if kind == 'sum':
+        return {'value': float(sum(values))}
+    if kind in ('avg', 'max', 'min'):
+        if not values:
+            return {'value': None}
+        value = {'avg': lambda: sum(values) / len(values), 'max': lambda: max(values), 'min': lambda: min(values)}
+        return {'value': float(value[kind]())}
+    if kind == 'stats':
+        stats = {name: _metric(name, values)['value'] for name in ('min', 'max', 'avg', 'sum')}
+        return dict(stats, count=len(values))
+    raise NotImplementedError(f'aggregation {kind!r}')
+
+
+def aggregate(aggs, docs):
+    """Evaluate `aggs` over (doc_id, source) pairs, shaped like an ES response."""
+    result = {}
+    for name, spec in (aggs or {}).items():
+        spec = dict(spec)
+        subs = spec.pop('aggs', spec.pop('aggregations', None))
+        kind, params = next(iter(spec.items()))
+        if kind == 'filter':
+            selected = [(i, src) for i, src in docs if matches(params, i, src)]
+            result[name] = dict(aggregate(subs, selected), doc_count=len(selected))
+        elif kind == 'nested':
+            # Each object of the array becomes a document of its own, under the same path
+            path = params['path']
+            inner = [(doc_id, {path: obj}) for doc_id, src in docs for obj in _as_list(_field(src, path) or [])]
+            result[name] = dict(aggregate(subs, inner), doc_count=len(inner))
+        elif kind == 'terms':
+            groups = {}
+            for doc_id, src in docs:
+                for value in _as_list(_field(src, params['field'])):
+                    if value is not None:
+                        groups.setdefault(value, []).append((doc_id, src))
+            buckets = [dict(aggregate(subs, group), key=key, doc_count=len(group)) for key, group in groups.items()]
+            result[name] = {'buckets': _order(buckets, params.get('order', {'_count': 'desc'}))[:params.get('size', 10)]}
+        elif kind == 'date_histogram':
+            groups = {}
+            for doc_id, src in docs:
+                for value in _as_list(_field(src, params['field'])):
+                    if value is not None:
+                        groups.setdefault(_calendar_bucket(value, params['calendar_interval']), []).append((doc_id, src))
+            result[name] = {'buckets': [
+                dict(aggregate(subs, groups[start]), key=int(start.replace(tzinfo=timezone.utc).timestamp() * 1000),
+                     key_as_string=start.isoformat(timespec='milliseconds') + 'Z', doc_count=len(groups[start]))
+                for start in sorted(groups) if len(groups[start]) >= params.get('min_doc_count', 1)
+            ]}
+        else:
+            values = [v for _, src in docs for v in _as_list(_field(src, params['field'])) if v is not None]
+            result[name] = _metric(kind, values)
+    return result
+
+
+def _order(buckets, order):
+    """Terms buckets sorted by `order`; ties go to the smaller key, as in Elasticsearch."""
+    (by, direction), = order.items()
+    if by == '_key':
+        return sorted(buckets, key=lambda b: b['key'], reverse=direction == 'desc')
+    value = (lambda b: b['doc_count']) if by == '_count' else (lambda b: b[by]['value'])
+    buckets = sorted(buckets, key=lambda b: b['key'])
+    return sorted(buckets, key=value, reverse=direction == 'desc')
+
+
+def _calendar_bucket(value, interval):
+    """Start of the UTC calendar hour/day/week (from Monday)/month holding an ISO timestamp."""
+    moment = datetime.fromisoformat(value[:-1] if value.endswith('Z') else value).replace(tzinfo=None)
+    if interval == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'day':
+        return day
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+    raise NotImplementedError(f'calendar_interval {interval!r}')
+
+
+def _select(source, includes):
+    if includes is None or includes is True:
+        return source
+    if includes is False:
+        return {}
+    return {name: source[name] for name in _as_list(includes) if name in source}
+
+
+class _Indices:
+    def __init__(self, es):
+        self.es = es
+
+    @_api
+    def exists(self, index, **kw):
+        return all(i in self.es._indices or i in self.es._aliases for i in _names(index))
+
+    @_api
+    def exists_alias(self, name, **kw):
+        return name in self.es._aliases
+
+    @_api
+    def get_alias(self, name, **kw):
+        if name not in self.es._aliases:
+            raise _error(NotFoundError, 404, 'alias_not_found')
+        return {i: {'aliases': {name: {}}} for i in self.es._aliases[name]}
+
+    @_api
+    def update_aliases(self, actions, **kw):
+        for action in actions:
+            op, spec = next(iter(action.items()))
+            members = self.es._aliases.setdefault(spec['alias'], [])
+            if op == 'add' and spec['index'] not in members:
+                members.append(spec['index'])
+            elif op == 'remove' and spec['index'] in members:
+                members.remove(spec['index'])
+        return {'acknowledged': True}
+
+    @_api
+    def create(self, index, mappings=None, settings=None, aliases=None, **kw):
+        if index in self.es._indices:
+            raise _error(BadRequestError, 400, 'resource_already_exists_exception')
+        self.es._create(index, mappings, aliases)
+        return {'acknowledged': True, 'index': index}
+
+    @_api
+    def put_index_template(self, name, index_patterns, template=None, **kw):
+        self.es._templates[name] = (_as_list(index_patterns), template or {})
+        return {'acknowledged': True}
+
+    @_api
+    def get_mapping(self, index, ignore_unavailable=False, **kw):
+        result = {}
+        for name in _names(index):
+            if name not in self.es._indices and name not in self.es._aliases:
+                if ignore_unavailable:
+                    continue
+                raise _error(NotFoundError, 404, 'index_not_found_exception')
+            for concrete in self.es._concrete(name):
+                result[concrete] = {'mappings': copy.deepcopy(self.es._indices[concrete]['mappings'])}
+        return result
+
+    @_api
+    def put_mapping(self, index, properties=None, meta=None, **kw):
+        for concrete in self.es._concrete(index):
+            mappings = self.es._indices[concrete]['mappings']
+            if properties:
+                mappings.setdefault('properties', {}).update(copy.deepcopy(properties))
+            if meta is not None:
+                mappings['_meta'] = copy.deepcopy(meta)
+        return {'acknowledged': True}
+
+    @_api
+    def get_settings(self, index, **kw):
+        return {c: {'settings': dict(self.es._indices[c]['settings'])} for c in self.es._concrete(index)}
+
+    @_api
+    def put_settings(self, index=None, settings=None, **kw):
+        for concrete in self.es._concrete(index):
+            self.es._indices[concrete]['settings'].update(_flatten(settings or {}))
+        return {'acknowledged': True}
+
+    @_api
+    def refresh(self, index=None, **kw):
+        return {'_shards': {'failed': 0}}
+
+
+def _names(index):
+    if isinstance(index, (list, tuple)):
+        return list(index)
+    return str(index).split(',')
+
+
+def _flatten(settings, prefix=''):
+    flat = {}
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+class _Transport:
+    """Only here so common/metrics.py and common/tracing.py can wrap it."""
+
+    def perform_request(self, method, target, **kwargs):
+        raise NotImplementedError('the fake answers API calls directly')
+
+
+class FakeElasticsearch:
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency    = latency
+        self.jitter     = jitter
+        self.indices    = _Indices(self)
+        self.transport  = _Transport()
+        self.calls      = 0
+        self.seconds    = 0.0
+        self._indices   = {}
+        self._aliases   = {}
+        self._templates = {}
+        self._pits      = {}
+        self._seq_no    = itertools.count()
+        self._lock      = threading.RLock()
+
+    # ─── INTERNALS ───────────────────────────────────────────────────────────
+    def _create(self, index, mappings=None, aliases=None):
+        for patterns, template in self._templates.values():
+            if any(fnmatch.fnmatch(index, p) for p in patterns):
+                mappings = mappings or template.get('mappings')
+                aliases = {**(template.get('aliases') or {}), **(aliases or {})}
+        self._indices[index] = {'docs': {}, 'mappings': copy.deepcopy(mappings or {}), 'settings': {}}
+        for alias in aliases or {}:
+            self._aliases.setdefault(alias, []).append(index)
+
+    def _concrete(self, index):
+        names = []
+        for name in _names(index):
+            names += self._aliases.get(name, [name] if name in self._indices else [])
+        return names
+
+    def _docs(self, index, create=True):
+        """Documents of the index `index` writes to; auto-creates like ES does."""
+        if index in self._aliases:
+            index = self._aliases[index][-1]
+        if index not in self._indices:
+            if not create:
+                raise _error(NotFoundError, 404, 'index_not_found_exception')
+            self._create(index)
+        return self._indices[index]['docs']
+
+    def _hit(self, index, doc_id, doc):
+        return {'_index': index, '_id': doc_id, 'found': True, '_source': copy.deepcopy(doc['source']),
+                '_seq_no': doc['seq_no'], '_primary_term': 1, '_version': doc['version']}
+
+    def _store(self, docs, doc_id, source):
+        previous = docs.get(doc_id)
+        docs[doc_id] = {'source': source, 'seq_no': next(self._seq_no),
+                        'version': previous['version'] + 1 if previous else 1}
+        return docs[doc_id]
+
+    def _check_version(self, doc, if_seq_no):
+        if if_seq_no is not None and (doc is None or doc['seq_no'] != if_seq_no):
+            raise _error(ConflictError, 409, 'version_conflict_engine_exception')
+
+    def _run_script(self, spec, source, op):
+        if spec['source'] not in SCRIPTS:
+            raise NotImplementedError(f"no Python equivalent registered for script {spec['source']!r}")
+        ctx = {'_source': source, 'op': op}
+        SCRIPTS[spec['source']](ctx, spec.get('params', {}))
+        return ctx['op']
+
+    def _update(self, index, doc_id, body, if_seq_no=None):
+        docs = self._docs(index)
+        doc = docs.get(doc_id)
+        self._check_version(doc, if_seq_no)
+        if doc is None:
+            if body.get('scripted_upsert') and 'script' in body:
+                source = copy.deepcopy(body.get('upsert', {}))
+                if self._run_script(body['script'], source, 'create') == 'noop':
+                    return None, 'noop'
+                return self._store(docs, doc_id, source), 'created'
+            if 'upsert' in body:
+                return self._store(docs, doc_id, copy.deepcopy(body['upsert'])), 'created'
+            if body.get('doc_as_upsert'):
+                return self._store(docs, doc_id, copy.deepcopy(body['doc'])), 'created'
+            raise _error(NotFoundError, 404, 'document_missing_exception')
+
+        source = copy.deepcopy(doc['source'])
+        if 'script' in body:
+            if self._run_script(body['script'], source, 'index') == 'noop':
+                return doc, 'noop'
+        else:
+            source.update(copy.deepcopy(body.get('doc', {})))
+        return self._store(docs, doc_id, source), 'updated'
+
+    # ─── DOCUMENT APIS ───────────────────────────────────────────────────────
+    @_api
+    def ping(self, **kw):
+        return True
+
+    @_api
+    def info(self, **kw):
+        return {'name': 'fake', 'version': {'number': '8.9.0'}}
+
+    def options(self, **kw):
+        return self
+
+    @_api
+    def get(self, index, id, ignore=None, **kw):
+        with self._lock:
+            doc = self._docs(index, create=False).get(id)
+            if doc is None:
+                if ignore and 404 in _as_list(ignore):
+                    return {'_index': index, '_id': id, 'found': False}
+                raise _error(NotFoundError, 404, 'not_found')
+            return self._hit(index, id, doc)
+
+    @_api
+    def exists(self, index, id, **kw):
+        with self._lock:
+            return (index in self._indices or index in self._aliases) and id in self._docs(index)
+
+    @_api
+    def mget(self, index=None, ids=None, docs=None, source=True, **kw):
+        pairs = [(index, i) for i in ids] if ids is not None else [(d.get('_index', index), d['_id']) for d in docs]
+        out = []
+        with self._lock:
+            for idx, doc_id in pairs:
+                if idx not in self._indices and idx not in self._aliases:
+                    out.append({'_index': idx, '_id': doc_id, 'error': {'type': 'index_not_found_exception'}})
+                    continue
+                doc = self._docs(idx).get(doc_id)
+                if doc is None:
+                    out.append({'_index': idx, '_id': doc_id, 'found': False})
+                    continue
+                hit = self._hit(idx, doc_id, doc)
+                if source is False:
+                    del hit['_source']
+                out.append(hit)
+        return {'docs': out}
+
+    @_api
+    def index(self, index, id=None, document=None, body=None, op_type=None, if_seq_no=None, **kw):
+        doc_id = id or uuid.uuid4().hex
+        with self._lock:
+            docs = self._docs(index)
+            if op_type == 'create' and doc_id in docs:
+                raise _error(ConflictError, 409, 'version_conflict_engine_exception')
+            self._check_version(docs.get(doc_id), if_seq_no)
+            created = doc_id not in docs
+            doc = self._store(docs, doc_id, copy.deepcopy(document if document is not None else body))
+        return {'_index': index, '_id': doc_id, 'result': 'created' if created else 'updated',
+                '_seq_no': doc['seq_no'], '_primary_term': 1, '_version': doc['version']}
+
+    @_api
+    def update(self, index, id, body=None, doc=None, script=None, upsert=None, scripted_upsert=None,
+               doc_as_upsert=None, if_seq_no=None, if_primary_term=None, **kw):
+        if body is None:
+            body = {k: v for k, v in (('doc', doc), ('script', script), ('upsert', upsert),
+                                      ('scripted_upsert', scripted_upsert), ('doc_as_upsert', doc_as_upsert))
+                    if v is not None}
+        with self._lock:
+            stored, result = self._update(index, id, body, if_seq_no)
+        return {'_index': index, '_id': id, 'result': result,
+                '_seq_no': stored['seq_no'] if stored else None, '_primary_term': 1}
+
+    @_api
+    def delete(self, index, id, **kw):
+        with self._lock:
+            docs = self._docs(index, create=False)
+            if id not in docs:
+                raise _error(NotFoundError, 404, 'not_found')
+            del docs[id]
+        return {'_index': index, '_id': id, 'result': 'deleted'}
+
+    @_api
+    def bulk(self, operations=None, body=None, **kw):
+        """Applies actions in order; each failure is reported on its item, as ES does."""
+        ops = operations if operations is not None else body
+        items, errors, i = [], False, 0
+        with self._lock:
+            while i < len(ops):
+                op, meta = next(iter(ops[i].items()))
+                index, doc_id = meta.get('_index'), meta.get('_id') or uuid.uuid4().hex
+                source = ops[i + 1] if op != 'delete' else None
+                i += 1 if op == 'delete' else 2
+                try:
+                    docs = self._docs(index)
+                    if op == 'delete':
+                        if doc_id not in docs:
+                            raise _error(NotFoundError, 404, 'not_found')
+                        self._check_version(docs[doc_id], meta.get('if_seq_no'))
+                        del docs[doc_id]
+                        item = {'result': 'deleted', 'status': 200}
+                    elif op in ('index', 'create'):
+                        if op == 'create' and doc_id in docs:
+                            raise _error(ConflictError, 409, 'version_conflict_engine_exception')
+                        self._check_version(docs.get(doc_id), meta.get('if_seq_no'))
+                        created = doc_id not in docs
+                        self._store(docs, doc_id, copy.deepcopy(source))
+                        item = {'result': 'created' if created else 'updated', 'status': 201 if created else 200}
+                    else:
+                        _, result = self._update(index, doc_id, source, meta.get('if_seq_no'))
+                        item = {'result': result, 'status': 201 if result == 'created' else 200}
+                except (NotFoundError, ConflictError) as e:
+                    errors = True
+                    item = {'status': e.meta.status, 'error': e.body['error']}
+                items.append({op: {'_index': index, '_id': doc_id, **item}})
+        return {'errors': errors, 'items': items}
+
+    @_api
+    def count(self, index, query=None, **kw):
+        with self._lock:
+            return {'count': sum(1 for name in self._concrete(index)
+                                 for doc_id, doc in self._indices[name]['docs'].items()
+                                 if matches(query, doc_id, doc['source']))}
+
+    @_api
+    def update_by_query(self, index, query=None, script=None, **kw):
+        updated = 0
+        with self._lock:
+            for name in self._concrete(index):
+                for doc_id, doc in list(self._indices[name]['docs'].items()):
+                    if matches(query, doc_id, doc['source']):
+                        self._update(name, doc_id, {'script': script})
+                        updated += 1
+        return {'updated': updated, 'failures': []}
+
+    # ─── SEARCH ──────────────────────────────────────────────────────────────
+    @_api
+    def open_point_in_time(self, index, keep_alive=None, **kw):
+        pit_id = uuid.uuid4().hex
+        self._pits[pit_id] = index
+        return {'id': pit_id}
+
+    @_api
+    def close_point_in_time(self, id=None, body=None, **kw):
+        self._pits.pop(id or (body or {}).get('id'), None)
+        return {'succeeded': True}
+
+    @_api
+    def search(self, index=None, body=None, query=None, sort=None, size=10, from_=0, search_after=None,
+               pit=None, aggs=None, source=None, seq_no_primary_term=False, **kw):
+        if body:
+            query = body.get('query', query)
+            sort = body.get('sort', sort)
+            size = body.get('size', size)
+            aggs = body.get('aggs', body.get('aggregations', aggs))
+            source = body.get('_source', source)
+        if pit:
+            if pit['id'] not in self._pits:
+                raise _error(NotFoundError, 404, 'search_context_missing_exception')
+            index = self._pits[pit['id']]
+
+        keys = []
+        for spec in sort or []:
+            name, order = (spec, 'asc') if isinstance(spec, str) else next(iter(spec.items()))
+            keys.append((name, order['order'] if isinstance(order, dict) else order))
+        if pit and not any(name == '_shard_doc' for name, _ in keys):
+            keys.append(('_shard_doc', 'asc'))
+
+        with self._lock:
+            hits = []
+            for name in self._concrete(index):
+                for doc_id, doc in self._indices[name]['docs'].items():
+                    if matches(query, doc_id, doc['source']):
+                        values = [doc['seq_no'] if field == '_shard_doc' else _field(doc['source'], field)
+                                  for field, _ in keys]
+                        hit = {'_index': name, '_id': doc_id, '_source': doc['source'], 'sort': values}
+                        if seq_no_primary_term:
+                            hit.update(_seq_no=doc['seq_no'], _primary_term=1)
+                        hits.append(hit)
+
+        # Stable sorts from the last key to the first; missing values sort last
+        for position, (_, order) in reversed(list(enumerate(keys))):
+            present = [h for h in hits if h['sort'][position] is not None]
+            missing = [h for h in hits if h['sort'][position] is None]
+            present.sort(key=lambda h: h['sort'][position], reverse=(order == 'desc'))
+            hits = present + missing
+        if search_after:
+            hits = [h for h in hits if _after(h['sort'], search_after, keys)]
+
+        total = len(hits)
+        page = hits[from_:from_ + size]
+        result = {'hits': {'total': {'value': total, 'relation': 'eq'}, 'hits': page}}
+        if aggs:
+            result['aggregations'] = aggregate(aggs, [(h['_id'], h['_source']) for h in hits])
+        for hit in page:
+            hit['_source'] = copy.deepcopy(_select(hit['_source'], source))
+            if not keys:
+                del hit['sort']
+        if pit:
+            result['pit_id'] = pit['id']
+        return result
+
+
+def _after(values, after, keys):
+    for (_, order), value, bound in zip(keys, values, after):
+        if value == bound:
+            continue
+        if value is None or bound is None:
+            return value is None
+        return value < bound if order == 'desc' else value > bound
+    return False
@@ -0,0 +1,356 @@
+"""
+Load test for the whole stack, through the same public endpoints that
+test_transaction_api.py exercises.
+
+Provisions --users synthetic users with a card each, then drives a weighted
+mix of register, login, transfer, history and report requests:
+
+    python -m benchmarks.load_test --users 200 --concurrency 32 --duration 60
+    python -m benchmarks.load_test --rate 150 --mix transfer=70,history=20,report=10
+
+Without --rate the test is closed-loop: --concurrency clients each send
+their next request as soon as the last one returns. With --rate requests
+arrive at that average rate (Poisson), whatever the response times are. Latency
+is then measured from each request's scheduled start, so time spent
+waiting for a free client counts too, as it would for a real caller.
+
+For each endpoint the report gives throughput, p50/p95/p99/max latency, and
+error rate. An error is a 5xx or a failed connection. Expected 4xx answers,
+such as a transfer rejected for balance, are counted separately as
+`rejected`. --json writes the results with the run's settings and git
+commit. --compare prints the change against an earlier results file:
+
+    python -m benchmarks.load_test --json before.json
+    python -m benchmarks.load_test --json after.json --compare before.json
+
+The defaults point at the ports published by docker-compose-dev.yml.
+Nothing outside the stack is needed.
+"""
+import os
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OPERATIONS = ('register', 'login', 'transfer', 'history', 'report')
+DEFAULT_MIX = 'transfer=50,history=25,report=15,login=8,register=2'
+
+# Cards start rich and transfers are small, so balances never run out
+CARD_BALANCE = 1000000.0
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'unknown operation {name!r}; choose from {", ".join(OPERATIONS)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class Stack:
+    """URLs of the three public services and the users created for this run."""
+
+    def __init__(self, user_url, transaction_url, reporting_url, run_id, timeout):
+        self.user_url        = user_url.rstrip('/')
+        self.transaction_url = transaction_url.rstrip('/')
+        self.reporting_url   = reporting_url.rstrip('/')
+        self.run_id          = run_id
+        self.timeout         = timeout
+        self.users           = []
+        self._registered     = 0
+        self._lock           = threading.Lock()
+        self._local          = threading.local()
+
+    @property
+    def session(self):
+        # One keep-alive session per client thread
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def new_user(self, prefix):
+        with self._lock:
+            n = self._registered
+            self._registered += 1
+        phone = f'{prefix}{self.run_id:05d}{n:04d}'
+        return {
+            'email':     f'load-{self.run_id}-{prefix}{n}@example.com',
+            'phone':     phone,
+            'password':  f'load-{phone}',
+            'birthdate': '1990-01-01',
+            'fname':     'Load',
+            'lname':     f'User{n}',
+        }
+
+    def register(self, user):
+        return self.session.post(f'{self.user_url}/register', json=user, timeout=self.timeout)
+
+    def login(self, user):
+        return self.session.post(f'{self.user_url}/login', timeout=self.timeout,
+                                 json={'identifier': user['phone'], 'password': user['password']})
+
+    def create_card(self, user, token):
+        return self.session.post(f'{self.user_url}/cards', timeout=self.timeout,
+                                 headers={'Authorization': f'Bearer {token}'}, json={
+                                     'username':        user['username'],
+                                     'cvv':             '123',
+                                     'cardnumber':      f"4{user['phone']}{user['phone'][:5]}",
+                                     'exp_date':        '2030-12',
+                                     'cardholder_name': f"{user['fname']} {user['lname']}",
+                                     'balance':         CARD_BALANCE,
+                                     'phone':           user['phone'],
+                                     'pin':             '1234',
+                                 })
+
+    def provision(self, count, concurrency):
+        """Register, log in and give a card to `count` users; returns how many are usable."""
+        def setup(_):
+            user = self.new_user('9')
+            user['username'] = f"lt{self.run_id}u{user['phone'][-4:]}"
+            self.register(user)
+            resp = self.login(user)
+            if resp.status_code != 200:
+                return None
+            user['token'] = resp.json()['access_token']
+            resp = self.create_card(user, user['token'])
+            return user if resp.status_code == 201 else None
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            self.users = [u for u in pool.map(setup, range(count)) if u]
+        return len(self.users)
+
+    # ─── OPERATIONS ──────────────────────────────────────────────────────────
+    def op_register(self):
+        return self.register(self.new_user('8'))
+
+    def op_login(self):
+        return self.login(random.choice(self.users))
+
+    def op_transfer(self):
+        sender, receiver = random.sample(self.users, 2)
+        return self.session.post(
+            f'{self.transaction_url}/transactions', timeout=self.timeout,
+            headers={'Authorization': f"Bearer {sender['token']}"},
+            json={'sender_username': sender['username'], 'receiver_username': receiver['username'],
+                  'amount': round(random.uniform(0.01, 5.0), 2), 'pin': '1234'}
+        )
+
+    def op_history(self):
+        user = random.choice(self.users)
+        return self.session.get(f"{self.transaction_url}/transactions/{user['username']}", timeout=self.timeout,
+                                params={'limit': 50}, headers={'Authorization': f"Bearer {user['token']}"})
+
+    def op_report(self):
+        user = random.choice(self.users)
+        return self.session.get(f"{self.reporting_url}/report/{user['username']}", timeout=self.timeout,
+                                headers={'Authorization': f"Bearer {user['token']}"})
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.rejected  = defaultdict(int)
+        self.errors    = defaultdict(int)
+        self.statuses  = defaultdict(lambda: defaultdict(int))
+        self._lock     = threading.Lock()
+
+    def call(self, stack, op, started):
+        """Run `op`, timing it from `started` (perf_counter), and record the outcome."""
+        try:
+            status = getattr(stack, f'op_{op}')().status_code
+        except requests.RequestException:
+            status = 'error'
+        took = time.perf_counter() - started
+        with self._lock:
+            self.latencies[op].append(took)
+            self.statuses[op][status] += 1
+            if status == 'error' or status >= 500:
+                self.errors[op] += 1
+            elif status >= 400:
+                self.rejected[op] += 1
+
+    def summary(self, duration):
+        def pct(values, p):
+            return values[min(len(values) - 1, int(p * len(values)))] * 1000 if values else 0.0
+
+        result = {}
+        for op in sorted(self.latencies):
+            values = sorted(self.latencies[op])
+            result[op] = {
+                'requests':       len(values),
+                'throughput_rps': round(len(values) / duration, 2),
+                'p50_ms':         round(pct(values, 0.50), 2),
+                'p95_ms':         round(pct(values, 0.95), 2),
+                'p99_ms':         round(pct(values, 0.99), 2),
+                'max_ms':         round(values[-1] * 1000, 2) if values else 0.0,
+                'errors':         self.errors[op],
+                'error_rate':     round(self.errors[op] / len(values), 4) if values else 0.0,
+                'rejected':       self.rejected[op],
+                'statuses':       {str(k): v for k, v in self.statuses[op].items()},
+            }
+        return result
+
+
+def choose(mix):
+    names, weights = zip(*mix.items())
+    return lambda: random.choices(names, weights)[0]
+
+
+def closed_loop(stack, recorder, mix, concurrency, duration):
+    next_op = choose(mix)
+    stop_at = time.perf_counter() + duration
+
+    def client():
+        while time.perf_counter() < stop_at:
+            recorder.call(stack, next_op(), time.perf_counter())
+
+    run_threads(client, concurrency)
+
+
+def open_loop(stack, recorder, mix, concurrency, duration, rate):
+    """Schedule arrivals at `rate`/s; `concurrency` clients serve them in order."""
+    next_op = choose(mix)
+    arrivals = queue.Queue()
+    started = time.perf_counter()
+
+    def client():
+        while True:
+            item = arrivals.get()
+            if item is None:
+                return
+            due, op = item
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            recorder.call(stack, op, due)
+
+    def schedule():
+        due = started
+        while True:
+            due += random.expovariate(rate)
+            if due - started >= duration:
+                break
+            arrivals.put((due, next_op()))
+        for _ in range(concurrency):
+            arrivals.put(None)
+
+    threading.Thread(target=schedule, daemon=True).start()
+    run_threads(client, concurrency)
+
+
+def run_threads(target, count):
+    threads = [threading.Thread(target=target, daemon=True) for _ in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print(f"{'endpoint':<10} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} "
+          f"{'errors':>7} {'rejected':>9}")
+    for op, r in results.items():
+        print(f"{op:<10} {r['throughput_rps']:>9} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} "
+              f"{r['max_ms']:>9} {r['error_rate']:>7.1%} {r['rejected']:>9}")
+    if not baseline:
+        return
+    print(f"\nagainst {baseline.get('commit') or 'baseline'}:")
+    print(f"{'endpoint':<10} {'req/s':>9} {'p50':>9} {'p99':>9}")
+    for op, r in results.items():
+        old = baseline['endpoints'].get(op)
+        if not old:
+            continue
+        change = lambda key: f"{(r[key] / old[key] - 1):+.0%}" if old[key] else 'n/a'
+        print(f"{op:<10} {change('throughput_rps'):>9} {change('p50_ms'):>9} {change('p99_ms'):>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--user-url', default=os.getenv('USER_API', 'http://localhost:5000'))
+    parser.add_argument('--transaction-url', default=os.getenv('TRANSACTION_API', 'http://localhost:5001'))
+    parser.add_argument('--reporting-url', default=os.getenv('REPORTING_API', 'http://localhost:5002'))
+    parser.add_argument('--users', type=int, default=50, help='synthetic users (with cards) to provision')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'operation weights (default {DEFAULT_MIX})')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--rate', type=float, help='open loop: average arrivals per second')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of load before measuring')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    run_id = int(time.time()) % 100000
+    stack = Stack(args.user_url, args.transaction_url, args.reporting_url, run_id, args.timeout)
+
+    started = time.perf_counter()
+    ready = stack.provision(args.users, min(args.concurrency, 16))
+    print(f'provisioned {ready}/{args.users} users in {time.perf_counter() - started:.1f}s (run {run_id})')
+    if ready < 2:
+        raise SystemExit('need at least two users with cards; is the stack up?')
+
+    def run(recorder, duration):
+        if args.rate:
+            open_loop(stack, recorder, args.mix, args.concurrency, duration, args.rate)
+        else:
+            closed_loop(stack, recorder, args.mix, args.concurrency, duration)
+
+    if args.warmup:
+        run(Recorder(), args.warmup)
+    recorder = Recorder()
+    started = time.perf_counter()
+    run(recorder, args.duration)
+    elapsed = time.perf_counter() - started
+
+    results = recorder.summary(elapsed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'commit':      git_commit(),
+                'started_at':  time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'mode':        'open' if args.rate else 'closed',
+                'rate':        args.rate,
+                'concurrency': args.concurrency,
+                'duration':    round(elapsed, 2),
+                'users':       ready,
+                'mix':         args.mix,
+                'endpoints':   results,
+                'total': {
+                    'requests':       sum(r['requests'] for r in results.values()),
+                    'throughput_rps': round(sum(r['requests'] for r in results.values()) / elapsed, 2),
+                    'errors':         sum(r['errors'] for r in results.values()),
+                },
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
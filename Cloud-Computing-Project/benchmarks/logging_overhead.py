@@ -0,0 +1,139 @@
+"""
+Measure what logging costs the request thread for one transfer.
+
+Replays the log calls of one successful create_transaction for N requests
+from several threads, and reports the time spent inside logger calls:
+
+- before:   the old dozen f-string INFO lines through logging.basicConfig
+            (format and write on the request thread);
+- queue:    the same lines through common/log.py (queue hand-off only);
+- after:    the current lines (debug chatter sampled out) through common/log.py.
+
+Log output goes to a temporary file so terminal speed does not count.
+Each request also waits --io-ms outside the timed region, standing in for
+its Elasticsearch round trips; that is when the listener thread gets to
+format and write:
+
+    python -m benchmarks.logging_overhead --requests 20000 --threads 8 --io-ms 1
+
+No service or Elasticsearch is needed. Each mode runs in a fresh
+interpreter because logging configuration is process-wide.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from common import log
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ('before', 'queue', 'after')
+
+
+def old_lines(logger, tx_id, phone, sender, receiver, amount):
+    """The log calls create_transaction used to make on success."""
+    logger.info(f"Received transaction request from {phone}")
+    logger.info(f"Generated transaction ID: {tx_id}")
+    logger.info(f"Found sender card for {sender}")
+    logger.info(f"Found receiver card for {receiver}")
+    logger.info(f"Processing transaction {tx_id}: {amount} from {sender} to {receiver}")
+    logger.info(f"Successfully applied transaction {tx_id}")
+    logger.info(f"Queueing notification for transaction {tx_id} with status completed")
+
+
+def new_lines(logger, tx_id, phone, sender, receiver, amount):
+    """The log calls create_transaction makes now."""
+    log.bind_trans_id(tx_id)
+    logger.debug("Transaction request from %s", phone)
+    logger.debug("Processing transfer of %s from %s to %s", amount, sender, receiver)
+    logger.info("Transaction completed: %s from %s to %s", amount, sender, receiver)
+    logger.debug("Queueing notification for transaction %s with status %s (reason: %s)",
+                 tx_id, 'completed', None)
+
+
+def run_mode(mode, requests, threads, io_ms, path):
+    stream = open(path, 'a')
+    if mode == 'before':
+        logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s', stream=stream)
+        replay = old_lines
+    else:
+        log.configure('benchmark', stream=stream)
+        replay = old_lines if mode == 'queue' else new_lines
+    logger = logging.getLogger('transaction_service')
+
+    per_thread = requests // threads
+    spent = [0.0] * threads
+
+    def worker(n):
+        total = 0.0
+        for i in range(per_thread):
+            tx_id = f'{n:02d}{i:030x}'
+            started = time.perf_counter()
+            replay(logger, tx_id, '0500000000', 'alice', 'bob', 10.0)
+            total += time.perf_counter() - started
+            time.sleep(io_ms / 1000)
+        spent[n] = total
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    wall = time.perf_counter() - started
+    if mode != 'before':
+        stats = log.stats()
+
+    result = {
+        'mode':               mode,
+        'requests':           per_thread * threads,
+        'us_per_request':     round(sum(spent) / (per_thread * threads) * 1e6, 2),
+        'wall_seconds':       round(wall, 3),
+    }
+    if mode != 'before':
+        result['dropped'] = stats['dropped']
+        result['log_stats'] = stats
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--io-ms', type=float, default=1.0, help='simulated ES time per request')
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.requests, args.threads, args.io_ms, args.output)))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in MODES:
+            out = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.logging_overhead', '--mode', mode,
+                 '--requests', str(args.requests), '--threads', str(args.threads), '--io-ms', str(args.io_ms),
+                 '--output', os.path.join(tmp, f'{mode}.log')],
+                cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT), check=True,
+                capture_output=True, text=True
+            ).stdout
+            results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print(f"{'mode':<8} {'us/request':>11} {'wall s':>8} {'dropped':>8}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['us_per_request']:>11} {r['wall_seconds']:>8} {r.get('dropped', 0):>8}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'requests': args.requests, 'threads': args.threads, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
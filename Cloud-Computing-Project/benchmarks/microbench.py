@@ -0,0 +1,411 @@
+"""
+Per-endpoint microbenchmarks against an in-memory Elasticsearch.
+
+Loads all four services in one process, backs them with one
+FakeElasticsearch (benchmarks/fake_es.py) seeded with users, cards and
+transfers, and calls each route through the Flask test client. What is
+measured is the handler's own CPU time: routing, JWT checks, validation,
+the services' ES request building and response handling. Network, ES and
+the WSGI server are left out.
+
+    python -m benchmarks.microbench
+    python -m benchmarks.microbench --only transfer,usage --es-latency-ms 1
+    python -m benchmarks.microbench --json new.json --compare main.json --max-regression 0.2
+
+Each case runs for at least --min-time seconds and at least
+--min-iterations calls, after a short warm-up. `mean` is the whole
+request. `handler` leaves out the time spent inside the fake, which
+grows with the seeded data and is not the services' code. `es calls` is
+the number of client calls per request, so an added round trip shows
+up even though the fake makes it cheap. With --compare, the exit status
+is 1 when any case's handler time is more than --max-regression slower
+than in the baseline, so the suite can gate CI.
+
+Nothing outside this process is started. Notifications stay queued, since
+the outbox gets no dispatcher threads. Reporting reaches the transaction
+service through its test client rather than over HTTP.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import importlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Read by the services at import time
+ENV = {
+    'JWT_SECRET_KEY':          'microbench-secret-key-microbench-secret',
+    'SERVICE_SECRET':          'microbench-service-secret',
+    'SMTP_PORT':               '25',
+    'NOTIFY_URL':              'http://notification.invalid/transaction-notify',
+    'NOTIFY_WORKERS':          '0',
+    'NOTIFY_QUEUE_SIZE':       '10000000',
+    'TRANSACTION_SERVICE_URL': 'http://transaction.invalid',
+    'LOG_LEVEL':               'ERROR',
+    'TRACE_EXPORTER':          'none',
+}
+
+SERVICES = {
+    'user_management': 'user_management_service',
+    'transaction':     'transaction_service',
+    'reporting':       'reporting_service',
+    'notification':    'notification_service',
+}
+
+PIN = '1234'
+
+
+def load_services(fake):
+    """Import every service with `fake` as its Elasticsearch client."""
+    for key, value in ENV.items():
+        os.environ.setdefault(key, value)
+    import elasticsearch
+    elasticsearch.Elasticsearch = lambda *args, **kwargs: fake
+    sys.path.insert(0, ROOT)
+    modules = {}
+    for directory, module in SERVICES.items():
+        sys.path.insert(0, os.path.join(ROOT, directory))
+        modules[directory] = importlib.import_module(module)
+
+    register_scripts()
+    transaction = modules['transaction']
+    transaction.bootstrap.start()
+    if not transaction.bootstrap.wait(10):
+        raise RuntimeError(f"transaction bootstrap failed: {transaction.bootstrap.status()}")
+    modules['reporting'].transaction_client.session_factory = lambda: InProcessSession(
+        os.environ['TRANSACTION_SERVICE_URL'], transaction.app.test_client())
+    return modules
+
+
+def register_scripts():
+    import transfer_engine
+    import user_stats
+    import user_rollups
+    from benchmarks import fake_es
+
+    @fake_es.script(transfer_engine.DEBIT_SCRIPT)
+    def debit(ctx, params):
+        ctx['_source']['balance'] -= params['amt']
+
+    @fake_es.script(transfer_engine.CREDIT_SCRIPT)
+    def credit(ctx, params):
+        ctx['_source']['balance'] += params['amt']
+
+    @fake_es.script(transfer_engine.TRANSFER_CREDIT_SCRIPT)
+    def transfer_credit(ctx, params):
+        transfer_engine.credit_card(ctx['_source'], params['amt'], params['tx'], params['at'], params['cutoff'])
+
+    @fake_es.script(transfer_engine.REVERSE_CREDIT_SCRIPT)
+    def reverse_credit(ctx, params):
+        transfer_engine.reverse_credit_card(ctx['_source'], params['amt'], params['tx'])
+
+    @fake_es.script(transfer_engine.CHECKED_DEBIT_SCRIPT)
+    def checked_debit(ctx, params):
+        if not transfer_engine.debit_card(ctx['_source'], params['amt'], params['pending']):
+            ctx['op'] = 'noop'
+
+    @fake_es.script(transfer_engine.SETTLE_SCRIPT)
+    def settle(ctx, params):
+        transfer_engine.settle_card(ctx['_source'], params['ids'])
+
+    @fake_es.script(transfer_engine.REFUND_SCRIPT)
+    def refund(ctx, params):
+        transfer_engine.refund_card(ctx['_source'], params['amt'], params['ids'])
+
+    @fake_es.script(transfer_engine.RECONCILE_SCRIPT)
+    def reconcile(ctx, params):
+        if not transfer_engine.reconcile_card(ctx['_source'], params['ids'], params['owed']):
+            ctx['op'] = 'noop'
+
+    @fake_es.script(user_stats.STATS_SCRIPT)
+    def record_stats(ctx, params):
+        user_stats.record(ctx['_source'], params['add'], params['remove'], params['recent_size'])
+
+    @fake_es.script(user_rollups.ROLLUP_SCRIPT)
+    def record_rollup(ctx, params):
+        user_rollups.record(ctx['_source'], params['add'], params['remove'])
+
+
+class InProcessSession:
+    """The slice of requests.Session a ServiceClient uses, answered by a Flask test client."""
+
+    class Response:
+        def __init__(self, resp):
+            self.status_code = resp.status_code
+            self._data = resp.get_json(silent=True)
+
+        def json(self):
+            return self._data
+
+    def __init__(self, base_url, client):
+        self.base_url = base_url
+        self.client = client
+
+    def request(self, method, url, headers=None, params=None, json=None, **kwargs):
+        return self.Response(self.client.open(url[len(self.base_url):], method=method, headers=headers,
+                                              query_string=params, json=json))
+
+
+class Fixture:
+    """Seeded users, cards, transfers and the tokens to call the routes with."""
+
+    def __init__(self, modules, fake, users, transfers):
+        from werkzeug.security import generate_password_hash
+        from flask_jwt_extended import create_access_token
+
+        self.modules = modules
+        self.fake = fake
+        self.clients = {name: m.app.test_client() for name, m in modules.items()}
+        self.password = 'microbench-password'
+        password_hash = generate_password_hash(self.password)
+        self.users = []
+        with modules['transaction'].app.app_context():
+            for i in range(users):
+                phone = f'5{i:09d}'
+                username = f'user{i}'
+                fake.index(index='users', id=phone, document={
+                    'fname': 'Bench', 'lname': f'User{i}', 'password': password_hash,
+                    'email': f'user{i}@example.com', 'phone': phone, 'birthdate': '1990-01-01',
+                    'created_date': '2024-01-01T00:00:00'
+                })
+                fake.index(index='cards', id=username, document={
+                    'username': username, 'cvv': '123', 'cardnumber': f'4{i:015d}', 'exp_date': '2030-12',
+                    'cardholder_name': f'Bench User{i}', 'created_date': '2024-01-01T00:00:00',
+                    'balance': 1e9, 'phone': phone, 'pin': PIN
+                })
+                self.users.append({'username': username, 'phone': phone,
+                                   'headers': {'Authorization': f'Bearer {create_access_token(identity=phone)}'}})
+        self.counter = 0
+
+        rng = random.Random(7)
+        for _ in range(transfers):
+            sender, receiver = rng.sample(self.users, 2)
+            self.transfer(sender, receiver, expect=201)
+        self.trans_id = self.clients['transaction'].get(
+            f"/transactions/{self.users[0]['username']}?limit=1", headers=self.users[0]['headers']
+        ).get_json()['transactions'][0]['trans_id']
+
+    def next_id(self):
+        self.counter += 1
+        return self.counter
+
+    def pair(self):
+        return random.sample(self.users, 2)
+
+    def transfer(self, sender, receiver, expect):
+        return check(self.clients['transaction'].post('/transactions', headers=sender['headers'], json={
+            'sender_username': sender['username'], 'receiver_username': receiver['username'],
+            'amount': 1.0, 'pin': PIN
+        }), expect)
+
+
+def check(resp, expect):
+    if resp.status_code != expect:
+        raise AssertionError(f'expected {expect}, got {resp.status_code}: {resp.get_data(as_text=True)[:200]}')
+    return resp
+
+
+# ─── CASES ───────────────────────────────────────────────────────────────────
+def case_register(f):
+    n = f.next_id()
+    check(f.clients['user_management'].post('/register', json={
+        'email': f'new{n}@example.com', 'phone': f'6{n:09d}', 'password': 'pw',
+        'birthdate': '1990-01-01', 'fname': 'New', 'lname': 'User'
+    }), 201)
+
+
+def case_login(f):
+    user = random.choice(f.users)
+    check(f.clients['user_management'].post('/login', json={
+        'identifier': user['phone'], 'password': f.password}), 200)
+
+
+def case_create_card(f):
+    n = f.next_id()
+    user = random.choice(f.users)
+    check(f.clients['user_management'].post('/cards', headers=user['headers'], json={
+        'username': f'extra{n}', 'cvv': '123', 'cardnumber': f'9{n:015d}', 'exp_date': '2030-12',
+        'cardholder_name': 'Extra Card', 'balance': 10.0, 'phone': user['phone'], 'pin': PIN
+    }), 201)
+
+
+def case_get_card(f):
+    user = random.choice(f.users)
+    check(f.clients['user_management'].get(f"/cards/{user['username']}", headers=user['headers']), 200)
+
+
+def case_transfer(f):
+    sender, receiver = f.pair()
+    f.transfer(sender, receiver, expect=201)
+
+
+def case_transfer_bad_pin(f):
+    sender, receiver = f.pair()
+    check(f.clients['transaction'].post('/transactions', headers=sender['headers'], json={
+        'sender_username': sender['username'], 'receiver_username': receiver['username'],
+        'amount': 1.0, 'pin': '0000'
+    }), 401)
+
+
+def case_batch_10(f):
+    sender = random.choice(f.users)
+    receivers = random.sample([u for u in f.users if u is not sender], 10)
+    check(f.clients['transaction'].post('/transactions/batch', headers=sender['headers'], json={
+        'sender_username': sender['username'], 'pin': PIN,
+        'transfers': [{'receiver_username': r['username'], 'amount': 1.0} for r in receivers]
+    }), 201)
+
+
+def case_get_transaction(f):
+    user = f.users[0]
+    check(f.clients['transaction'].get(f'/transaction/{f.trans_id}', headers=user['headers']), 200)
+
+
+def case_history_page(f):
+    user = random.choice(f.users)
+    check(f.clients['transaction'].get(f"/transactions/{user['username']}?limit=50", headers=user['headers']), 200)
+
+
+def case_history_full(f):
+    user = random.choice(f.users)
+    check(f.clients['transaction'].get(f"/transactions/{user['username']}", headers=user['headers']), 200)
+
+
+def case_report(f):
+    user = random.choice(f.users)
+    check(f.clients['reporting'].get(f"/report/{user['username']}", headers=user['headers']), 200)
+
+
+def case_usage(f):
+    user = random.choice(f.users)
+    check(f.clients['reporting'].get(f"/report/{user['username']}/usage", headers=user['headers']), 200)
+
+
+def case_report_full(f):
+    user = random.choice(f.users)
+    check(f.clients['reporting'].get(f"/report/{user['username']}/full", headers=user['headers']), 200)
+
+
+def case_report_range(f):
+    user = random.choice(f.users)
+    check(f.clients['reporting'].get(f"/report/{user['username']}/usage?interval=week", headers=user['headers']), 200)
+
+
+def case_notify_batch_10(f):
+    events = []
+    for _ in range(10):
+        sender, receiver = f.pair()
+        events.append({'trans_id': f'bench{f.next_id()}', 'status': 'completed', 'amount': 1.0,
+                       'sender_doc': {'username': sender['username'], 'phone': sender['phone']},
+                       'receiver_doc': {'username': receiver['username'], 'phone': receiver['phone']}})
+    check(f.clients['notification'].post('/transaction-notify/batch', json={'events': events},
+                                         headers={'X-Service-Token': os.environ['SERVICE_SECRET']}), 200)
+
+
+CASES = {
+    'register':        case_register,
+    'login':           case_login,
+    'create_card':     case_create_card,
+    'get_card':        case_get_card,
+    'transfer':        case_transfer,
+    'transfer_bad_pin': case_transfer_bad_pin,
+    'batch_10':        case_batch_10,
+    'get_transaction': case_get_transaction,
+    'history_page':    case_history_page,
+    'history_full':    case_history_full,
+    'report':          case_report,
+    'usage':           case_usage,
+    'report_full':     case_report_full,
+    'report_range':    case_report_range,
+    'notify_batch_10': case_notify_batch_10,
+}
+
+
+def measure(fn, fixture, min_time, min_iterations, max_iterations, warmup=3):
+    for _ in range(warmup):
+        fn(fixture)
+    timings = []
+    calls_before, seconds_before = fixture.fake.calls, fixture.fake.seconds
+    deadline = time.perf_counter() + min_time
+    while len(timings) < max_iterations and (len(timings) < min_iterations or time.perf_counter() < deadline):
+        started = time.perf_counter()
+        fn(fixture)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    pct = lambda p: timings[min(len(timings) - 1, int(p * len(timings)))] * 1e6
+    mean = sum(timings) / len(timings)
+    in_fake = (fixture.fake.seconds - seconds_before) / len(timings)
+    return {
+        'iterations': len(timings),
+        'mean_us':    round(mean * 1e6, 1),
+        'handler_us': round((mean - in_fake) * 1e6, 1),
+        'p50_us':     round(pct(0.50), 1),
+        'p95_us':     round(pct(0.95), 1),
+        'es_calls':   round((fixture.fake.calls - calls_before) / len(timings), 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--only', help=f"comma-separated cases ({', '.join(CASES)})")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--transfers', type=int, default=500, help='transfers seeded before measuring')
+    parser.add_argument('--es-latency-ms', type=float, default=0.0, help='added to every fake ES call')
+    parser.add_argument('--min-time', type=float, default=1.0)
+    parser.add_argument('--min-iterations', type=int, default=5)
+    parser.add_argument('--max-iterations', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results file to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='with --compare, fail when a handler time is this much slower (0.25 = 25%%)')
+    args = parser.parse_args(argv)
+
+    names = args.only.split(',') if args.only else list(CASES)
+    unknown = [n for n in names if n not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}")
+
+    from benchmarks.fake_es import FakeElasticsearch
+    random.seed(args.seed)
+    fake = FakeElasticsearch()
+    modules = load_services(fake)
+    fixture = Fixture(modules, fake, args.users, args.transfers)
+    fake.latency = args.es_latency_ms / 1000
+
+    results = {name: measure(CASES[name], fixture, args.min_time, args.min_iterations, args.max_iterations)
+               for name in names}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['cases']
+    print(f"{'case':<17} {'iters':>6} {'mean us':>10} {'handler us':>11} {'p50 us':>10} {'p95 us':>10} "
+          f"{'es calls':>9}"
+          + (f" {'vs base':>8}" if baseline else ''))
+    regressions = []
+    for name, r in results.items():
+        line = (f"{name:<17} {r['iterations']:>6} {r['mean_us']:>10} {r['handler_us']:>11} "
+                f"{r['p50_us']:>10} {r['p95_us']:>10} {r['es_calls']:>9}")
+        old = (baseline or {}).get(name)
+        if old:
+            change = r['handler_us'] / old['handler_us'] - 1
+            line += f" {change:>+8.0%}"
+            if change > args.max_regression:
+                regressions.append(name)
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'es_latency_ms': args.es_latency_ms, 'users': args.users,
+                       'transfers': args.transfers, 'cases': results}, f, indent=2)
+    if regressions:
+        print(f"slower than baseline by more than {args.max_regression:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
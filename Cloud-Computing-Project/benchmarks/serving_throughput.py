@@ -0,0 +1,144 @@
+"""
+Compare a service's throughput under the Werkzeug dev server and under the
+gunicorn entry point (common/serve.py).
+
+Each mode is started as a subprocess against the same environment (ES_*,
+JWT_SECRET_KEY, ... must point at a running stack). The script then sends
+requests to one path from a pool of concurrent clients for a fixed time:
+
+    python -m benchmarks.serving_throughput --service transaction \
+        --path /healthz --concurrency 32 --duration 10
+
+The default path does not touch Elasticsearch, so the numbers measure the
+serving stack itself. Pass --header 'Authorization: Bearer ...' to
+benchmark authenticated routes.
+"""
+import os
+import sys
+import time
+import json
+import socket
+import signal
+import argparse
+import threading
+import subprocess
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVICES = {
+    'transaction':     ('transaction_service', 'TRANS_PORT'),
+    'user_management': ('user_management_service', 'USER_PORT'),
+    'reporting':       ('reporting_service', 'REPORT_PORT'),
+    'notification':    ('notification_service', 'NOTIFY_PORT'),
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start(service, mode, port, workers, threads):
+    module, port_env = SERVICES[service]
+    env = dict(os.environ, PYTHONPATH=ROOT, **{port_env: str(port)})
+    if mode == 'dev':
+        cmd = [sys.executable, f'{module}.py']
+    else:
+        cmd = [sys.executable, '-m', 'common.serve', f'{module}:app', '--port-env', port_env,
+               '--workers', str(workers), '--threads', str(threads)]
+    # Own process group, so the dev server's reloader child is stopped too
+    return subprocess.Popen(cmd, cwd=os.path.join(ROOT, service), env=env, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up within {timeout}s')
+
+
+def run_load(url, headers, concurrency, duration):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def client():
+        session = requests.Session()
+        local, failed = [], 0
+        while time.time() < stop_at:
+            start = time.perf_counter()
+            try:
+                if session.get(url, headers=headers, timeout=10).status_code >= 500:
+                    failed += 1
+            except requests.RequestException:
+                failed += 1
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0.0
+    return {
+        'requests':       len(latencies),
+        'errors':         errors[0],
+        'throughput_rps': round(len(latencies) / duration, 1),
+        'p50_ms':         round(pct(0.50), 2),
+        'p99_ms':         round(pct(0.99), 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--service', choices=sorted(SERVICES), default='transaction')
+    parser.add_argument('--path', default='/healthz')
+    parser.add_argument('--header', action='append', default=[], help="extra header, 'Name: value'")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--modes', default='dev,prod')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    headers = dict(h.split(':', 1) for h in args.header)
+    headers = {k.strip(): v.strip() for k, v in headers.items()}
+
+    results = {}
+    for mode in args.modes.split(','):
+        port = free_port()
+        proc = start(args.service, mode, port, args.workers, args.threads)
+        try:
+            url = f'http://127.0.0.1:{port}{args.path}'
+            wait_ready(url)
+            run_load(url, headers, args.concurrency, 1)  # warm up
+            results[mode] = run_load(url, headers, args.concurrency, args.duration)
+        finally:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait(timeout=30)
+
+    print(f"{'mode':<6} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>8}")
+    for mode, r in results.items():
+        print(f"{mode:<6} {r['throughput_rps']:>10} {r['p50_ms']:>10} {r['p99_ms']:>10} {r['errors']:>8}")
+    if 'dev' in results and 'prod' in results and results['dev']['throughput_rps']:
+        print(f"speedup: {results['prod']['throughput_rps'] / results['dev']['throughput_rps']:.1f}x")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'service': args.service, 'path': args.path, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
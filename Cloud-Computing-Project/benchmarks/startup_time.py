@@ -0,0 +1,112 @@
+"""
+Measure how long each service takes to import and to answer /healthz.
+
+Each service is imported, then started under the gunicorn entry point
+(common/serve.py), in a fresh subprocess. Elasticsearch is NOT needed.
+By default every ES_* variable points at a closed port, which shows that
+startup no longer waits on the cluster:
+
+    python -m benchmarks.startup_time --runs 5
+
+Pass --use-env to keep the current ES_* settings and time a start against
+a real cluster instead.
+"""
+import os
+import sys
+import time
+import json
+import signal
+import argparse
+import statistics
+import subprocess
+import requests
+from benchmarks.serving_throughput import ROOT, SERVICES, free_port
+
+# A port nothing listens on, so every ES call fails fast
+UNREACHABLE_ES = {
+    'ES_HOST': '127.0.0.1',
+    'ES_PORT': '9',
+    'ES_URL':  'http://127.0.0.1:9',
+}
+# Settings the services refuse to import without
+DEFAULT_ENV = {
+    'JWT_SECRET_KEY': 'startup-benchmark',
+    'SMTP_PORT':      '25',
+    'NOTIFY_URL':     'http://127.0.0.1:9/transaction-notify',
+}
+
+IMPORT_SNIPPET = (
+    'import time, importlib; t = time.perf_counter(); '
+    'importlib.import_module({module!r}); print(time.perf_counter() - t)'
+)
+
+
+def service_env(service, use_env):
+    env = dict(DEFAULT_ENV, **os.environ)
+    if not use_env:
+        env.update(UNREACHABLE_ES)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, os.path.join(ROOT, service)])
+    return env
+
+
+def time_import(service, env):
+    module, _ = SERVICES[service]
+    out = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET.format(module=module)],
+                         cwd=os.path.join(ROOT, service), env=env, check=True,
+                         capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def time_first_response(service, env, timeout=30):
+    module, port_env = SERVICES[service]
+    port = free_port()
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'common.serve', f'{module}:app', '--port-env', port_env,
+         '--workers', '1', '--threads', '2'],
+        cwd=os.path.join(ROOT, service), env=dict(env, **{port_env: str(port)}),
+        start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        url = f'http://127.0.0.1:{port}/healthz'
+        while time.perf_counter() - started < timeout:
+            try:
+                if requests.get(url, timeout=1).status_code == 200:
+                    return time.perf_counter() - started
+            except requests.RequestException:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError(f'{service} did not answer /healthz within {timeout}s')
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=30)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--services', default=','.join(sorted(SERVICES)))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--use-env', action='store_true', help='use the ES_* settings from the environment')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for service in args.services.split(','):
+        env = service_env(service, args.use_env)
+        imports = [time_import(service, env) for _ in range(args.runs)]
+        first = [time_first_response(service, env) for _ in range(args.runs)]
+        results[service] = {
+            'import_ms':         round(statistics.median(imports) * 1000, 1),
+            'first_response_ms': round(statistics.median(first) * 1000, 1),
+        }
+
+    print(f"{'service':<16} {'import ms':>10} {'healthz ms':>11}")
+    for service, r in results.items():
+        print(f"{service:<16} {r['import_ms']:>10} {r['first_response_ms']:>11}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'runs': args.runs, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
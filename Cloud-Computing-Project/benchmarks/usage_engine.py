@@ -0,0 +1,146 @@
+"""
+Compare the columnar usage analysis (reporting/usage_engine.py) with the
+per-transaction loop get_usage_analysis used before it.
+
+Generates a synthetic history per size, checks that both produce the same
+result, and reports the best of --repeat runs for each:
+
+    python -m benchmarks.usage_engine
+    python -m benchmarks.usage_engine --sizes 10000,100000,1000000 --repeat 3
+
+The history looks like what GET /transactions/<username> returns: newest
+first, about 10% failed, a few hundred counterparties with a skewed
+distribution, spread over --days days. Only the analysis is timed; the
+JSON decode of the response costs the same in both.
+
+No service or Elasticsearch is needed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'reporting'))
+
+from usage_engine import usage_analysis  # noqa: E402
+
+USERNAME = 'alice'
+
+
+def loop_usage_analysis(transactions, username):
+    """get_usage_analysis as it was: one Python pass with a datetime per transaction."""
+    usage = {
+        'daily_activity': {},
+        'transaction_patterns': {'morning': 0, 'afternoon': 0, 'evening': 0, 'night': 0},
+        'common_recipients': {},
+        'common_senders': {},
+        'transaction_frequency': {'daily': 0, 'weekly': 0, 'monthly': 0}
+    }
+    for tx in transactions:
+        if tx.get('status') != 'completed':
+            continue
+        timestamp = datetime.fromisoformat(tx.get('timestamp').replace('Z', '+00:00'))
+        date_str = timestamp.strftime('%Y-%m-%d')
+        hour = timestamp.hour
+        if date_str not in usage['daily_activity']:
+            usage['daily_activity'][date_str] = {'count': 0, 'total_amount': 0}
+        usage['daily_activity'][date_str]['count'] += 1
+        usage['daily_activity'][date_str]['total_amount'] += float(tx.get('amount', 0))
+        if 6 <= hour < 12:
+            usage['transaction_patterns']['morning'] += 1
+        elif 12 <= hour < 18:
+            usage['transaction_patterns']['afternoon'] += 1
+        elif 18 <= hour < 24:
+            usage['transaction_patterns']['evening'] += 1
+        else:
+            usage['transaction_patterns']['night'] += 1
+        if tx['sender_username'] == username:
+            recipient = tx['receiver_username']
+            usage['common_recipients'][recipient] = usage['common_recipients'].get(recipient, 0) + 1
+        else:
+            sender = tx['sender_username']
+            usage['common_senders'][sender] = usage['common_senders'].get(sender, 0) + 1
+    if usage['daily_activity']:
+        days_with_transactions = len(usage['daily_activity'])
+        total_days = (datetime.now() - min(datetime.fromisoformat(d) for d in usage['daily_activity'].keys())).days + 1
+        if total_days > 0:
+            usage['transaction_frequency']['daily'] = days_with_transactions / total_days
+            usage['transaction_frequency']['weekly'] = days_with_transactions / (total_days / 7)
+            usage['transaction_frequency']['monthly'] = days_with_transactions / (total_days / 30)
+    usage['common_recipients'] = dict(sorted(usage['common_recipients'].items(), key=lambda x: x[1], reverse=True)[:5])
+    usage['common_senders'] = dict(sorted(usage['common_senders'].items(), key=lambda x: x[1], reverse=True)[:5])
+    return usage
+
+
+def history(size, days, rng):
+    """`size` transactions of USERNAME, newest first."""
+    peers = [f'user{i}' for i in range(500)]
+    weights = [1 / (i + 1) for i in range(len(peers))]
+    now = datetime.utcnow()
+    offsets = sorted((rng.random() * days * 86400 for _ in range(size)))
+    counterparties = rng.choices(peers, weights, k=size)
+    transactions = []
+    for offset, peer in zip(offsets, counterparties):
+        sent = rng.random() < 0.6
+        transactions.append({
+            'trans_id': f'{rng.getrandbits(64):016x}',
+            'sender_username': USERNAME if sent else peer,
+            'receiver_username': peer if sent else USERNAME,
+            'timestamp': (now - timedelta(seconds=offset)).isoformat() + 'Z',
+            'status': 'failed' if rng.random() < 0.1 else 'completed',
+            'amount': round(rng.uniform(1, 500), 2)
+        })
+    return transactions
+
+
+def best_of(fn, transactions, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(transactions, USERNAME)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma-separated history sizes')
+    parser.add_argument('--days', type=int, default=730, help='span of the generated history')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    results = []
+    print(f"{'transactions':>12} {'loop ms':>10} {'columnar ms':>12} {'speedup':>8} {'identical':>10}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        transactions = history(size, args.days, rng)
+        loop_seconds, expected = best_of(loop_usage_analysis, transactions, args.repeat)
+        columnar_seconds, actual = best_of(usage_analysis, transactions, args.repeat)
+        identical = json.dumps(expected, sort_keys=True) == json.dumps(actual, sort_keys=True)
+        results.append({
+            'transactions': size,
+            'loop_ms': round(loop_seconds * 1000, 2),
+            'columnar_ms': round(columnar_seconds * 1000, 2),
+            'speedup': round(loop_seconds / columnar_seconds, 2),
+            'identical': identical
+        })
+        r = results[-1]
+        print(f"{size:>12} {r['loop_ms']:>10} {r['columnar_ms']:>12} {r['speedup']:>7}x {str(identical):>10}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'days': args.days, 'results': results}, f, indent=2)
+    if not all(r['identical'] for r in results):
+        print("columnar result differs from the loop")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+"""
+Helpers shared by the Python services. Each service image copies this
+package next to its own code, so import it as `common.<module>`.
+"""
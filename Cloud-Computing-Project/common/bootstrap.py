@@ -0,0 +1,281 @@
+"""
+Non-blocking Elasticsearch bootstrap and health endpoints.
+
+Services used to ping ES and create their indices at import time, and
+raised if it was not up yet, so pods crash-looped while the cluster warmed
+up and every new replica paid those round trips before serving. Now the
+setup steps are registered with a Bootstrap, which runs them once in a
+background thread and keeps retrying until they succeed. Liveness
+(/healthz) is answered immediately. Readiness (/readyz) reports whether
+ES is reachable and the bootstrap has finished.
+
+Routes that write must not run before then: a transfer indexed before the
+partition template is installed makes ES auto-create the month's index
+with dynamic mappings and no alias. Wrap them in bootstrap_required, which
+waits up to ES_BOOTSTRAP_WAIT seconds and then answers 503 with
+Retry-After.
+
+AsyncBootstrap does the same on the event loop of an asyncio service,
+with coroutine steps and an AsyncElasticsearch client.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from functools import wraps
+from flask import jsonify
+from common import lifecycle
+
+logger = logging.getLogger(__name__)
+
+BOOTSTRAP_BACKOFF_MAX = float(os.getenv('ES_BOOTSTRAP_BACKOFF_MAX', 30))
+# How long a readiness ping result is reused, so probes do not hammer ES
+READY_PING_TTL = float(os.getenv('ES_READY_PING_TTL', 2))
+# How long a write waits for an unfinished bootstrap before answering 503
+BOOTSTRAP_WAIT        = float(os.getenv('ES_BOOTSTRAP_WAIT', 1))
+BOOTSTRAP_RETRY_AFTER = int(os.getenv('ES_BOOTSTRAP_RETRY_AFTER', 2))
+
+
+class Bootstrap:
+    """
+    Runs idempotent setup steps (index creation and the like) against ES
+    once per deployment, off the import path.
+
+    The thread is started lazily and again in every forked worker that
+    inherits an unfinished bootstrap, like the notification outbox.
+    """
+
+    restart_after_fork = True
+
+    def __init__(self, es, name, started_at=None):
+        self.es          = es
+        self.name        = name
+        self.started_at  = started_at or time.perf_counter()
+        self.import_seconds = None
+        self._steps      = []
+        self._done       = threading.Event()
+        self._lock       = threading.Lock()
+        self._pid        = None
+        self._attempts   = 0
+        self._last_error = None
+        self._ping       = (0.0, False)
+        if self.restart_after_fork:
+            lifecycle.after_fork(self.start)
+
+    def step(self, fn):
+        """Register `fn(es)` as a setup step. Steps must be safe to re-run."""
+        self._steps.append(fn)
+        return fn
+
+    def ensure_index(self, index, **body):
+        """Register creation of `index` (with optional mappings/settings)."""
+        def create_index(es):
+            if not es.indices.exists(index=index):
+                logger.info("Creating index: %s", index)
+                es.indices.create(index=index, **body)
+        create_index.__name__ = f'create_{index}'
+        return self.step(create_index)
+
+    def start(self):
+        """Start the background bootstrap unless it already ran or is running here."""
+        self._record_import()
+        if self._done.is_set() or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._done.is_set() or self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name=f'{self.name}-bootstrap', daemon=True).start()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _run(self):
+        for pause in _backoff():
+            self._attempts += 1
+            try:
+                for fn in self._steps:
+                    fn(self.es)
+                self._finished()
+                return
+            except Exception as e:
+                self._failed(e)
+            time.sleep(pause)
+
+    def _record_import(self):
+        if self.import_seconds is None:
+            self.import_seconds = time.perf_counter() - self.started_at
+            logger.info("%s imported in %.1f ms", self.name, self.import_seconds * 1000)
+
+    def _finished(self):
+        self._last_error = None
+        self._done.set()
+        logger.info("%s bootstrap finished after %s attempt(s)", self.name, self._attempts)
+
+    def _failed(self, e):
+        self._last_error = str(e)
+        logger.warning("%s bootstrap attempt %s failed: %s", self.name, self._attempts, e)
+
+    # ─── HEALTH ──────────────────────────────────────────────────────────────
+    def es_available(self):
+        checked_at, ok = self._ping
+        if time.monotonic() - checked_at < READY_PING_TTL:
+            return ok
+        try:
+            ok = bool(self.es.ping())
+        except Exception:
+            ok = False
+        self._ping = (time.monotonic(), ok)
+        return ok
+
+    def status(self):
+        return self._status(self.es_available())
+
+    def _status(self, es_up):
+        return {
+            'service':         self.name,
+            'elasticsearch':   'up' if es_up else 'down',
+            'bootstrapped':    self._done.is_set(),
+            'attempts':        self._attempts,
+            'last_error':      self._last_error,
+            'import_seconds':  round(self.import_seconds, 4) if self.import_seconds is not None else None,
+        }
+
+
+class AsyncBootstrap(Bootstrap):
+    """
+    Bootstrap for an asyncio service. Steps are coroutine functions
+    `fn(es)`; start(es) runs them as a task on the calling event loop, with
+    the client created there, and stop() cancels it.
+    """
+
+    # The task lives and dies with its event loop
+    restart_after_fork = False
+
+    def __init__(self, name, started_at=None):
+        super().__init__(None, name, started_at=started_at)
+        self._task = None
+
+    def start(self, es):
+        self.es = es
+        self._record_import()
+        if not self._done.is_set() and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._done.is_set():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    async def _run(self):
+        for pause in _backoff():
+            self._attempts += 1
+            try:
+                for fn in self._steps:
+                    await fn(self.es)
+                self._finished()
+                return
+            except Exception as e:
+                self._failed(e)
+            await asyncio.sleep(pause)
+
+    async def es_available(self):
+        checked_at, ok = self._ping
+        if time.monotonic() - checked_at < READY_PING_TTL:
+            return ok
+        try:
+            ok = bool(await self.es.ping())
+        except Exception:
+            ok = False
+        self._ping = (time.monotonic(), ok)
+        return ok
+
+    async def status(self):
+        return self._status(await self.es_available())
+
+
+def _backoff():
+    """Jittered pauses between bootstrap attempts, doubling up to BOOTSTRAP_BACKOFF_MAX."""
+    delay = 0.5
+    while True:
+        yield delay * random.uniform(0.5, 1.0)
+        delay = min(delay * 2, BOOTSTRAP_BACKOFF_MAX)
+
+
+def readiness(status):
+    """(status, HTTP code) for /readyz."""
+    ready = status['bootstrapped'] and status['elasticsearch'] == 'up'
+    status['status'] = 'ready' if ready else 'unavailable'
+    return status, 200 if ready else 503
+
+
+def _not_ready(bootstrap):
+    body = {'message': f'{bootstrap.name} is starting; try again shortly'}
+    return body, 503, {'Retry-After': str(BOOTSTRAP_RETRY_AFTER)}
+
+
+def bootstrap_required(bootstrap):
+    """Flask view decorator: run the view only once the bootstrap has finished, else 503."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not bootstrap.wait(BOOTSTRAP_WAIT):
+                body, status, headers = _not_ready(bootstrap)
+                return jsonify(body), status, headers
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def quart_bootstrap_required(bootstrap):
+    """bootstrap_required for a Quart view and an AsyncBootstrap."""
+    from quart import jsonify
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            if not await bootstrap.wait(BOOTSTRAP_WAIT):
+                body, status, headers = _not_ready(bootstrap)
+                return jsonify(body), status, headers
+            return await view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_health_routes(app, bootstrap):
+    """Add /healthz (liveness) and /readyz (readiness) to a Flask app, and start the bootstrap."""
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({'status': 'ok', 'service': bootstrap.name}), 200
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        status, code = readiness(bootstrap.status())
+        return jsonify(status), code
+
+    bootstrap.start()
+
+
+def register_quart_health_routes(app, bootstrap):
+    """register_health_routes for a Quart app and an AsyncBootstrap, which startup starts with its client."""
+    from quart import jsonify
+
+    @app.route('/healthz', methods=['GET'])
+    async def healthz():
+        return jsonify({'status': 'ok', 'service': bootstrap.name}), 200
+
+    @app.route('/readyz', methods=['GET'])
+    async def readyz():
+        status, code = readiness(await bootstrap.status())
+        return jsonify(status), code
@@ -0,0 +1,156 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from common import metrics
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+    A named cache also counts its hits and misses in cache_lookups_total.
+    """
+
+    def __init__(self, maxsize, ttl, name=None):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self._data   = OrderedDict()
+        self._lock   = threading.Lock()
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        self.expirations = 0
+        self._lookups = (metrics.CACHE_LOOKUPS.labels(name, 'miss'), metrics.CACHE_LOOKUPS.labels(name, 'hit')) \
+            if name else None
+
+    def get(self, key):
+        with self._lock:
+            value = self._get(key)
+        if self._lookups:
+            self._lookups[value is not None].inc()
+        return value
+
+    def _get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size':        len(self._data),
+                'maxsize':     self.maxsize,
+                'ttl_seconds': self.ttl,
+                'hits':        self.hits,
+                'misses':      self.misses,
+                'hit_ratio':   round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions':   self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class CardCache:
+    """
+    Read-through cache in front of the `cards` index.
+
+    Two tiers are kept: whole card documents (short TTL, since balances
+    change) and the username -> phone mapping used for ownership checks
+    (long TTL, since a card's phone never changes). Cached documents are
+    for ownership only; a response that shows a balance reads the card
+    fresh. `fetch(username)` must
+    return the card's _source or None when the card does not exist; misses
+    are not cached so a newly created card is visible immediately.
+
+    Invalidation is per process: call invalidate() wherever this process
+    changes a card. Other processes see the change within the card TTL.
+
+    `fetch_many(usernames)`, when given, returns {username: _source or None}
+    and lets owns_all() read every missing card in one call.
+    """
+
+    def __init__(self, fetch, maxsize=10000, ttl=5.0, phone_ttl=3600.0, fetch_many=None):
+        self.fetch      = fetch
+        self.fetch_many = fetch_many
+        self.cards      = TTLCache(maxsize, ttl, name='cards')
+        self.phones     = TTLCache(maxsize, phone_ttl, name='card_phones')
+
+    @classmethod
+    def from_env(cls, fetch, fetch_many=None):
+        return cls(
+            fetch,
+            maxsize=int(os.getenv('CARD_CACHE_SIZE', 10000)),
+            ttl=float(os.getenv('CARD_CACHE_TTL', 5)),
+            phone_ttl=float(os.getenv('CARD_PHONE_TTL', 3600)),
+            fetch_many=fetch_many,
+        )
+
+    def get_card(self, username):
+        card = self.cards.get(username)
+        if card is None:
+            card = self.fetch(username)
+            if card is not None:
+                self.prime(username, card)
+        return card
+
+    def get_phone(self, username):
+        phone = self.phones.get(username)
+        if phone is None:
+            card = self.get_card(username)
+            phone = card.get('phone') if card else None
+        return phone
+
+    def is_owner(self, username, phone):
+        return phone is not None and self.get_phone(username) == phone
+
+    def owns_all(self, usernames, phone):
+        """is_owner for several cards, reading the uncached ones together."""
+        if phone is None:
+            return False
+        missing = [u for u in usernames if self.phones.get(u) is None]
+        if missing and self.fetch_many is not None:
+            for username, card in self.fetch_many(missing).items():
+                if card is not None:
+                    self.prime(username, card)
+        return all(self.get_phone(u) == phone for u in usernames)
+
+    def prime(self, username, card):
+        """Store a card document this process has just read or written."""
+        self.cards.set(username, card)
+        if card.get('phone') is not None:
+            self.phones.set(username, card['phone'])
+
+    def invalidate(self, username, phone=False):
+        """Drop the cached card; pass phone=True when the card was (re)created."""
+        self.cards.invalidate(username)
+        if phone:
+            self.phones.invalidate(username)
+
+    def stats(self):
+        return {'cards': self.cards.stats(), 'phones': self.phones.stats()}
@@ -0,0 +1,60 @@
+"""
+gzip for JSON responses, when the caller asks for it in Accept-Encoding.
+
+    compression.init_app(app)          # Flask
+    compression.init_quart_app(app)    # Quart
+
+A full history or a report spanning years of daily activity is mostly
+repeated keys and compresses several times over. Bodies under
+GZIP_MIN_SIZE bytes are sent as they are, since there the header and CPU
+cost outweigh the saving. A compressed response's ETag becomes weak: its
+bytes differ from the uncompressed ones, and If-None-Match uses the weak
+comparison anyway.
+"""
+import os
+import gzip
+
+GZIP_MIN_SIZE = int(os.getenv('GZIP_MIN_SIZE', 1024))
+GZIP_LEVEL    = int(os.getenv('GZIP_LEVEL', 5))
+
+
+def _wanted(request, response):
+    return (response.status_code == 200
+            and response.mimetype == 'application/json'
+            and 'Content-Encoding' not in response.headers
+            and not getattr(response, 'direct_passthrough', False)
+            and request.accept_encodings.quality('gzip') > 0)
+
+
+def _compress(response, data):
+    response.set_data(gzip.compress(data, GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    tag, weak = response.get_etag()
+    if tag and not weak:
+        response.set_etag(tag, weak=True)
+
+
+def init_app(app):
+    from flask import request
+
+    @app.after_request
+    def _gzip(response):
+        if _wanted(request, response):
+            data = response.get_data()
+            if len(data) >= GZIP_MIN_SIZE:
+                _compress(response, data)
+        return response
+
+
+def init_quart_app(app):
+    """init_app for the Quart (asyncio) variant of the transaction service."""
+    from quart import request
+
+    @app.after_request
+    async def _gzip(response):
+        if _wanted(request, response):
+            data = await response.get_data()
+            if len(data) >= GZIP_MIN_SIZE:
+                _compress(response, data)
+        return response
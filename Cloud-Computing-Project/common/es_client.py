@@ -0,0 +1,40 @@
+import os
+import threading
+from common import tracing
+from common.metrics import instrument_es
+
+
+class ProcessLocalClient:
+    """
+    Lazily creates one Elasticsearch client per process.
+
+    Services keep a module-level `es` object, but the real client (and its
+    connection pool) is only built on first use, and built again in every
+    process forked afterwards, so a pre-forking server never shares sockets
+    between workers. Every client is instrumented for Prometheus and
+    tracing (see common/metrics.py and common/tracing.py).
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client  = None
+        self._pid     = None
+        self._lock    = threading.Lock()
+
+    @property
+    def client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = tracing.instrument_es(instrument_es(self._factory()))
+                    self._pid = os.getpid()
+        return self._client
+
+    def reset(self):
+        """Drop the current client; the next call creates a new one."""
+        with self._lock:
+            self._client = None
+            self._pid = None
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
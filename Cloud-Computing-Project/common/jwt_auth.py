@@ -0,0 +1,73 @@
+"""
+Access-token checks for the services that are not Flask apps.
+
+Tokens are issued by user_management through flask-jwt-extended, and the
+Flask services check them with its jwt_required. Rather than re-implement
+that extension's decoding, header parsing and error bodies, TokenVerifier
+runs the extension itself against a bare Flask app configured the same
+way, so every service accepts and rejects exactly the same tokens.
+
+    verifier = TokenVerifier.from_env()
+
+    @app.route('/transactions', methods=['POST'])
+    @jwt_required(verifier)                 # Quart
+    async def create_transaction():
+        current_phone = get_jwt_identity()
+"""
+import os
+from functools import wraps
+from flask import Flask
+from flask_jwt_extended import JWTManager, verify_jwt_in_request
+from flask_jwt_extended import get_jwt_identity as _flask_identity
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import PyJWTError
+
+
+class TokenVerifier:
+    """flask-jwt-extended's access-token check, callable outside a Flask request."""
+
+    def __init__(self, secret):
+        self._app = Flask(__name__)
+        self._app.config['JWT_SECRET_KEY'] = secret
+        JWTManager(self._app)
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv('JWT_SECRET_KEY'))
+
+    def verify(self, authorization):
+        """
+        (identity, None) for a valid Authorization header value, else
+        (None, (body, status)) with the response jwt_required would send.
+        """
+        headers = {'Authorization': authorization} if authorization else {}
+        with self._app.test_request_context(headers=headers):
+            try:
+                verify_jwt_in_request()
+                return _flask_identity(), None
+            except (JWTExtendedException, PyJWTError) as e:
+                response = self._app.make_response(self._app.handle_user_exception(e))
+                return None, (response.get_json(), response.status_code)
+
+
+def jwt_required(verifier):
+    """Quart view decorator: 401/422 like flask-jwt-extended, else the identity in get_jwt_identity()."""
+    from quart import request, jsonify, g
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            identity, error = verifier.verify(request.headers.get('Authorization'))
+            if error is not None:
+                body, status = error
+                return jsonify(body), status
+            g.jwt_identity = identity
+            return await view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_jwt_identity():
+    """The identity jwt_required verified for the current Quart request."""
+    from quart import g
+    return g.jwt_identity
@@ -0,0 +1,56 @@
+"""
+Process lifecycle hooks.
+
+Services register callbacks here instead of talking to the web server
+directly. The production entry point (common/serve.py) runs them from
+gunicorn's post_fork/worker_exit hooks. Shutdown callbacks also run at
+interpreter exit, so the Werkzeug dev server gets them too.
+"""
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_after_fork = []
+_shutdown   = []
+_lock       = threading.Lock()
+_shut_down  = False
+
+
+def after_fork(fn):
+    """Register `fn` to run in every worker process right after it is forked."""
+    _after_fork.append(fn)
+    return fn
+
+
+def on_shutdown(fn):
+    """Register `fn` to run once when the process is about to exit."""
+    _shutdown.append(fn)
+    return fn
+
+
+def run_after_fork():
+    global _shut_down
+    _shut_down = False
+    for fn in _after_fork:
+        try:
+            fn()
+        except Exception as e:
+            logger.error("after_fork hook %s failed: %s", fn.__name__, e)
+
+
+def run_shutdown():
+    global _shut_down
+    with _lock:
+        if _shut_down:
+            return
+        _shut_down = True
+    for fn in reversed(_shutdown):
+        try:
+            fn()
+        except Exception as e:
+            logger.error("shutdown hook %s failed: %s", fn.__name__, e)
+
+
+atexit.register(run_shutdown)
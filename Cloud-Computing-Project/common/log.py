@@ -0,0 +1,242 @@
+"""
+Logging shared by the services.
+
+configure() replaces logging.basicConfig. Records are put on a bounded
+in-memory queue on the calling (request) thread, with only the message
+interpolated there. A QueueListener thread does the JSON formatting,
+secret masking and the write to stdout. If the queue is full, records
+are dropped and counted; a request never blocks on log I/O.
+
+Every record carries `trans_id` when the code handling it called
+bind_trans_id(), so all lines of one transfer can be grepped together,
+and `trace_id` when it was logged inside a span (see common/tracing.py).
+DEBUG records are sampled per transaction (LOG_DEBUG_SAMPLE_RATE): a
+sampled transaction keeps all its debug lines, the rest keep none.
+
+stats() reports how much time callers spent handing records over, so the
+logging cost of a request can be measured; see benchmarks/logging_overhead.py.
+Dropped records are also counted in telemetry_dropped_total.
+"""
+import os
+import re
+import sys
+import json
+import time
+import queue
+import zlib
+import random
+import logging
+import threading
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from common import lifecycle, metrics, tracing
+
+LOG_LEVEL             = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT            = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE        = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0.01))
+
+# Environment variables whose values never appear in a log line
+SECRET_ENV = ('ELASTIC_PASSWORD', 'SMTP_PASSWORD', 'JWT_SECRET_KEY')
+SECRET_PATTERNS = [
+    (re.compile(r'(?i)\b(password|passwd|secret|token|api[_-]?key|pin)(["\']?\s*[:=]\s*["\']?)[^\s,"\'}]+'),
+     r'\1\2***'),
+    (re.compile(r'(?i)\bBearer\s+[A-Za-z0-9._~+/=-]+'), 'Bearer ***'),
+]
+
+trans_id_var = contextvars.ContextVar('trans_id', default=None)
+
+
+def bind_trans_id(trans_id):
+    """Tag every record logged from the current request/task with `trans_id`."""
+    trans_id_var.set(trans_id)
+
+
+def init_app(app):
+    """Clear the bound trans_id at the start of each request (worker threads are reused)."""
+    app.before_request(lambda: bind_trans_id(None))
+
+
+def mask_secrets(text, secrets=()):
+    for value in secrets:
+        text = text.replace(value, '***')
+    for pattern, repl in SECRET_PATTERNS:
+        text = pattern.sub(repl, text)
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+        self.secrets = [v for v in (os.getenv(name) for name in SECRET_ENV) if v and len(v) >= 4]
+
+    def format(self, record):
+        entry = {
+            'ts':      datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level':   record.levelname,
+            'service': self.service,
+            'logger':  record.name,
+            'msg':     mask_secrets(record.getMessage(), self.secrets),
+        }
+        if getattr(record, 'trans_id', None):
+            entry['trans_id'] = record.trans_id
+        if getattr(record, 'trace_id', None):
+            entry['trace_id'] = record.trace_id
+        if record.exc_text:
+            entry['exc'] = mask_secrets(record.exc_text, self.secrets)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The old `LEVEL - message` lines, for reading logs in a terminal."""
+
+    def __init__(self):
+        super().__init__('%(levelname)s - %(message)s')
+        self.secrets = [v for v in (os.getenv(name) for name in SECRET_ENV) if v and len(v) >= 4]
+
+    def format(self, record):
+        line = super().format(record)
+        if getattr(record, 'trans_id', None):
+            line = f'{line} [trans_id={record.trans_id}]'
+        return mask_secrets(line, self.secrets)
+
+
+class StreamWriter(logging.StreamHandler):
+    """Writes for the listener, flushing once the queue is drained rather than per record."""
+
+    def __init__(self, stream, backlog):
+        super().__init__(stream)
+        self.backlog = backlog
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if not self.backlog():
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class ContextFilter(logging.Filter):
+    """Attach the bound trans_id and current trace_id, and sample DEBUG records."""
+
+    def __init__(self, sample_rate):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.sampled_out = 0
+
+    def filter(self, record):
+        trans_id = trans_id_var.get()
+        record.trans_id = trans_id
+        span = tracing.current_span.get()
+        record.trace_id = span.trace_id if span is not None else None
+        if record.levelno > logging.DEBUG or self.sample_rate >= 1:
+            return True
+        if trans_id:
+            # Same decision for every line of one transaction
+            keep = zlib.crc32(trans_id.encode()) % 10000 < self.sample_rate * 10000
+        else:
+            keep = random.random() < self.sample_rate
+        if not keep:
+            self.sampled_out += 1
+        return keep
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler that only interpolates the message on the caller's thread,
+    drops records when the queue is full, and times itself.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.records  = 0
+        self.dropped  = 0
+        self.seconds  = 0.0
+
+    def prepare(self, record):
+        # The listener formats; here only what cannot cross threads safely
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.TELEMETRY_DROPPED.labels('log_record').inc()
+
+    def emit(self, record):
+        started = time.perf_counter()
+        super().emit(record)
+        self.seconds += time.perf_counter() - started
+        self.records += 1
+
+
+_state = {'handler': None, 'listener': None, 'filter': None, 'target': None}
+_lock = threading.Lock()
+
+
+def _start_listener():
+    handler = _state['handler']
+    handler.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    listener = QueueListener(handler.queue, _state['target'], respect_handler_level=True)
+    listener.start()
+    _state['listener'] = listener
+
+
+def _stop_listener():
+    listener = _state['listener']
+    if listener is not None:
+        _state['listener'] = None
+        # Flushes what is still queued before returning
+        listener.stop()
+
+
+def configure(service, level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None):
+    """
+    Route the root logger through the queue. Idempotent; the listener is
+    restarted in forked workers (its thread does not survive the fork) and
+    drained at shutdown.
+    """
+    with _lock:
+        if _state['handler'] is not None:
+            return
+        # Record fields nothing here prints; skipping them makes each call cheaper
+        logging._srcfile = None
+        logging.logMultiprocessing = False
+
+        context = ContextFilter(LOG_DEBUG_SAMPLE_RATE)
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        handler.addFilter(context)
+        target = StreamWriter(stream or sys.stdout, backlog=lambda: not handler.queue.empty())
+        target.setFormatter(JsonFormatter(service) if fmt == 'json' else TextFormatter())
+
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            root.removeHandler(h)
+        root.addHandler(handler)
+        root.setLevel(level)
+        _state.update(handler=handler, filter=context, target=target)
+        _start_listener()
+        lifecycle.after_fork(_start_listener)
+        lifecycle.on_shutdown(_stop_listener)
+
+
+def stats():
+    handler, context = _state['handler'], _state['filter']
+    if handler is None:
+        return {}
+    return {
+        'records':      handler.records,
+        'dropped':      handler.dropped,
+        'sampled_out':  context.sampled_out,
+        'queue_depth':  handler.queue.qsize(),
+        'emit_us_avg':  round(handler.seconds / handler.records * 1e6, 2) if handler.records else 0.0,
+    }
@@ -0,0 +1,279 @@
+"""
+Prometheus metrics shared by the services.
+
+    metrics.init_app(app)                 # Flask: request histograms + /metrics
+    with metrics.outbound('notification') as call:
+        resp = session.post(...)
+        call.status = resp.status_code
+
+common/service_client.py does the outbound() part for its callers.
+
+Elasticsearch calls are timed without touching call sites:
+common/es_client.py instruments every client it creates (instrument_es),
+labelled by HTTP method and API (`GET _doc`, `POST _bulk`, ...).
+
+Under gunicorn each worker keeps its own values. When
+PROMETHEUS_MULTIPROC_DIR is set (the k8s manifest does), values are
+shared through files in that directory, so /metrics on any worker reports
+the whole pod. common/serve.py empties the directory before the app is
+imported and retires each worker's files when it exits.
+"""
+import os
+import time
+import inspect
+from contextlib import contextmanager
+from prometheus_client import (
+    Histogram, Gauge, Counter, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+)
+
+MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+# Internal calls are mostly single-digit milliseconds; the defaults start at 5 ms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time to serve an HTTP request',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'Requests being served',
+    ['route'], multiprocess_mode='livesum'
+)
+ES_LATENCY = Histogram(
+    'es_request_duration_seconds', 'Elasticsearch request time, by API',
+    ['operation', 'status'], buckets=LATENCY_BUCKETS
+)
+ES_IN_FLIGHT = Gauge(
+    'es_requests_in_flight', 'Elasticsearch requests waiting for a response',
+    multiprocess_mode='livesum'
+)
+OUTBOUND_LATENCY = Histogram(
+    'http_client_request_duration_seconds', 'Time of calls to other services',
+    ['target', 'status'], buckets=LATENCY_BUCKETS
+)
+OUTBOUND_IN_FLIGHT = Gauge(
+    'http_client_requests_in_flight', 'Calls to other services waiting for a response',
+    ['target'], multiprocess_mode='livesum'
+)
+CIRCUIT_OPEN = Gauge(
+    'http_client_circuit_open', '1 while calls to the target fail fast (see common/service_client.py)',
+    ['target'], multiprocess_mode='max'
+)
+HEDGED = Counter(
+    'http_client_hedged_total', 'Calls that sent a second, hedged request, by which one answered first',
+    ['target', 'winner']
+)
+SMTP_LATENCY = Histogram(
+    'smtp_send_duration_seconds', 'Time to hand one email to the SMTP server',
+    ['status'], buckets=LATENCY_BUCKETS
+)
+SMTP_IN_FLIGHT = Gauge(
+    'smtp_sends_in_flight', 'Emails being sent',
+    multiprocess_mode='livesum'
+)
+ERRORS = Counter(
+    'service_errors_total', 'Failures of outbound calls, by kind',
+    ['kind']
+)
+REPORT_CACHE_LOOKUPS = Counter(
+    'report_cache_lookups_total', 'Report lookups: hit, miss, not_modified (304), or bypass while user_stats is rebuilt',
+    ['report', 'result']
+)
+REPORT_CACHE_SAVED = Counter(
+    'report_cache_saved_seconds_total', 'Time the cached reports took to build, summed over their hits',
+    ['report']
+)
+OUTBOX_DEPTH = Gauge(
+    'notification_outbox_depth', 'Notification events queued, waiting for a retry or being delivered',
+    multiprocess_mode='livesum'
+)
+OUTBOX_LAG = Histogram(
+    'notification_outbox_lag_seconds', 'Time from queueing a notification event to its delivery or rejection',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+TRANSFER_EVENTS = Counter(
+    'transfer_events_total',
+    'Transfer engine events: transfers, version conflicts, retries, exhausted retry budgets, '
+    'insufficient balance, compensations, unsettled (see transaction/transfer_engine.py)',
+    ['event']
+)
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total', 'Lookups in the in-process caches (see common/card_cache.py)',
+    ['cache', 'result']
+)
+IDEMPOTENT_REQUESTS = Counter(
+    'idempotent_requests_total', 'Requests carrying an Idempotency-Key: executed, or replayed from a record',
+    ['outcome']
+)
+TELEMETRY_DROPPED = Counter(
+    'telemetry_dropped_total', 'Log records and spans dropped because their queue was full',
+    ['kind']
+)
+OUTBOX_EVENTS = Counter(
+    'notification_outbox_events_total',
+    'Notification events by outcome: delivered, rejected, retried, swept (queued again from the '
+    'notification_outbox index), and left to the next sweep as dropped (queue full), dead_lettered '
+    '(out of retries) or abandoned (still queued at shutdown)',
+    ['outcome']
+)
+
+
+# ─── HTTP SERVER ─────────────────────────────────────────────────────────────
+def _status_class(code):
+    return f'{code // 100}xx' if isinstance(code, int) else str(code)
+
+
+def init_app(app):
+    """Time every Flask request by route template and serve /metrics."""
+    from flask import request, g, Response
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+        g._metrics_started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.labels(g._metrics_route).inc()
+
+    @app.after_request
+    def _observe(response):
+        _finish(request.method, response.status_code)
+        return response
+
+    @app.teardown_request
+    def _teardown(exc):
+        # after_request does not run when the view raised
+        if exc is not None:
+            _finish(request.method, 500)
+
+    def _finish(method, status):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return
+        REQUEST_LATENCY.labels(method, g._metrics_route, _status_class(status)).observe(
+            time.perf_counter() - started)
+        REQUESTS_IN_FLIGHT.labels(g._metrics_route).dec()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_quart_app(app):
+    """init_app for the Quart (asyncio) variant of the transaction service."""
+    from quart import request, g, Response
+
+    @app.before_request
+    async def _start_timer():
+        g._metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+        g._metrics_started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.labels(g._metrics_route).inc()
+
+    @app.after_request
+    async def _observe(response):
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            REQUEST_LATENCY.labels(request.method, g._metrics_route, _status_class(response.status_code)).observe(
+                time.perf_counter() - started)
+            REQUESTS_IN_FLIGHT.labels(g._metrics_route).dec()
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    async def metrics():
+        return Response(render(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def render():
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+
+# ─── OUTBOUND CALLS ──────────────────────────────────────────────────────────
+class _Call:
+    status = 'error'
+
+
+@contextmanager
+def outbound(target):
+    """
+    Time one call to another service. Set `.status` to the HTTP status on
+    the yielded object (or a word such as `circuit_open`); calls that raise
+    without one are recorded as `error`.
+    """
+    call = _Call()
+    OUTBOUND_IN_FLIGHT.labels(target).inc()
+    started = time.perf_counter()
+    try:
+        yield call
+    finally:
+        OUTBOUND_LATENCY.labels(target, _status_class(call.status)).observe(time.perf_counter() - started)
+        OUTBOUND_IN_FLIGHT.labels(target).dec()
+        if call.status == 'error' or (isinstance(call.status, int) and call.status >= 500):
+            ERRORS.labels(target).inc()
+
+
+@contextmanager
+def smtp_send():
+    """Time one email hand-off; failures are recorded as `error`."""
+    SMTP_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        SMTP_LATENCY.labels(status).observe(time.perf_counter() - started)
+        SMTP_IN_FLIGHT.dec()
+        if status == 'error':
+            ERRORS.labels('smtp').inc()
+
+
+# ─── ELASTICSEARCH ───────────────────────────────────────────────────────────
+def es_operation(method, target):
+    """`GET _doc`, `POST _bulk`, `HEAD <index>`: the API, never the index or id."""
+    path = target.split('?', 1)[0]
+    api = next((part for part in path.split('/') if part.startswith('_')), None)
+    return f'{method} {api or "<index>"}'
+
+
+def instrument_es(client):
+    """
+    Time every request `client` sends. The transport is shared with the
+    clients returned by .options() and the namespaced APIs (es.indices...),
+    so they are covered too.
+    """
+    transport = client.transport
+    send = transport.perform_request
+    if getattr(send, '_instrumented', False):
+        return client
+
+    if inspect.iscoroutinefunction(send):
+        async def perform_request(method, target, *args, **kwargs):
+            ES_IN_FLIGHT.inc()
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                resp = await send(method, target, *args, **kwargs)
+                status = _status_class(resp.meta.status)
+                return resp
+            finally:
+                ES_LATENCY.labels(es_operation(method, target), status).observe(time.perf_counter() - started)
+                ES_IN_FLIGHT.dec()
+    else:
+        def perform_request(method, target, *args, **kwargs):
+            ES_IN_FLIGHT.inc()
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                resp = send(method, target, *args, **kwargs)
+                status = _status_class(resp.meta.status)
+                return resp
+            finally:
+                ES_LATENCY.labels(es_operation(method, target), status).observe(time.perf_counter() - started)
+                ES_IN_FLIGHT.dec()
+
+    perform_request._instrumented = True
+    transport.perform_request = perform_request
+    return client
+
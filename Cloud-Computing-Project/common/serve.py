@@ -0,0 +1,107 @@
+"""
+Production entry point shared by the Python services.
+
+Runs a service's Flask app under gunicorn with the gthread worker:
+
+    python -m common.serve transaction_service:app --port-env TRANS_PORT
+
+The app is imported once in the master (preload) and forked into
+WEB_WORKERS processes with WEB_THREADS threads each. Elasticsearch clients
+are created per process after the fork (see common/es_client.py). On
+SIGTERM, workers stop accepting connections and finish in-flight requests
+within WEB_GRACEFUL_TIMEOUT seconds. They then run the shutdown hooks
+registered in common/lifecycle.py, for example draining the notification
+outbox.
+"""
+import os
+import argparse
+import importlib
+from gunicorn.app.base import BaseApplication
+from common import lifecycle
+
+
+def post_fork(server, worker):
+    lifecycle.run_after_fork()
+
+
+def worker_exit(server, worker):
+    lifecycle.run_shutdown()
+
+
+def child_exit(server, worker):
+    # Runs in the master, also for workers that died without worker_exit
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def prepare_metrics_dir():
+    """
+    Start with an empty PROMETHEUS_MULTIPROC_DIR (files left by a previous
+    run would be counted again). Must run before prometheus_client is
+    imported, so before the app is loaded.
+    """
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if not path:
+        return
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith('.db'):
+            os.remove(os.path.join(path, name))
+
+
+def options_from_env(port):
+    return {
+        'bind':                f"0.0.0.0:{port}",
+        'worker_class':        'gthread',
+        'workers':             int(os.getenv('WEB_WORKERS', 2)),
+        'threads':             int(os.getenv('WEB_THREADS', 8)),
+        'preload_app':         True,
+        'timeout':             int(os.getenv('WEB_TIMEOUT', 30)),
+        'graceful_timeout':    int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30)),
+        'keepalive':           int(os.getenv('WEB_KEEPALIVE', 5)),
+        'backlog':             int(os.getenv('WEB_BACKLOG', 2048)),
+        'max_requests':        int(os.getenv('WEB_MAX_REQUESTS', 0)),
+        'max_requests_jitter': int(os.getenv('WEB_MAX_REQUESTS_JITTER', 0)),
+        'accesslog':           os.getenv('WEB_ACCESS_LOG') or None,
+        'post_fork':           post_fork,
+        'worker_exit':         worker_exit,
+        'child_exit':          child_exit,
+    }
+
+
+class ServiceApplication(BaseApplication):
+    def __init__(self, app_uri, options):
+        self.app_uri = app_uri
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        module, _, attr = self.app_uri.partition(':')
+        return getattr(importlib.import_module(module), attr or 'app')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a service under gunicorn')
+    parser.add_argument('app', help='module:attribute of the Flask app, e.g. transaction_service:app')
+    parser.add_argument('--port-env', required=True, help='environment variable holding the port')
+    parser.add_argument('--workers', type=int, help='override WEB_WORKERS')
+    parser.add_argument('--threads', type=int, help='override WEB_THREADS')
+    args = parser.parse_args(argv)
+
+    prepare_metrics_dir()
+    options = options_from_env(os.environ[args.port_env])
+    if args.workers:
+        options['workers'] = args.workers
+    if args.threads:
+        options['threads'] = args.threads
+    ServiceApplication(args.app, options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""
+HTTP client for calls from one service to another.
+
+    transactions = ServiceClient.from_env('transaction', TRANSACTION_SERVICE_URL, 'TRANSACTION_CLIENT')
+    resp = transactions.get(f'/transactions/{username}', headers=headers)
+
+- Keep-alive: one requests.Session per process, built on first use and
+  again after a fork (like ProcessLocalClient), with a connection pool of
+  `pool_size` so every worker thread can hold a connection open.
+- Deadlines: a call gets `timeout` seconds in total unless it passes its
+  own `deadline`. The connect and read timeouts are cut to what is left,
+  and a hedged request shares the first one's deadline. The read timeout
+  counts from the last byte received, so a response trickling in can run
+  a little past it.
+- Circuit breaker: after `failure_threshold` consecutive failures
+  (connection errors, timeouts, 5xx) calls raise CircuitOpenError without
+  touching the network for `reset_timeout` seconds. Then one call is let
+  through; its outcome closes the circuit or opens it again.
+- Hedging, off unless `hedge_after` is set, and only for GETs: when the
+  first request has not answered after `hedge_after` seconds a second one
+  is sent, and whichever answers first is used. Set it near the target's
+  p95 so about one call in twenty sends two.
+- gzip: responses are asked for gzipped (see common/compression.py) and
+  decoded by requests.
+
+Every call is timed with metrics.outbound(target) and carries the current
+`traceparent`. Failures raise requests exceptions, or CircuitOpenError.
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from requests.adapters import HTTPAdapter
+from common import metrics, tracing
+
+
+class CircuitOpenError(Exception):
+    """The target has been failing; the call was not made."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> half_open -> closed or open."""
+
+    def __init__(self, target, failure_threshold=5, reset_timeout=10.0):
+        self.target            = target
+        self.failure_threshold = failure_threshold
+        self.reset_timeout     = reset_timeout
+        self.state     = 'closed'
+        self.failures  = 0
+        self.opened_at = 0.0
+        self._probing  = False
+        self._lock     = threading.Lock()
+        self.opened    = 0
+        self.rejected  = 0
+
+    def allow(self):
+        """Whether a call may go out now; counts it as rejected otherwise."""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                # One probe at a time; the rest keep failing fast until it returns
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                if self.state != 'closed':
+                    metrics.CIRCUIT_OPEN.labels(self.target).set(0)
+                self.state    = 'closed'
+                self.failures = 0
+                self._probing = False
+                return
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.opened += 1
+                    metrics.CIRCUIT_OPEN.labels(self.target).set(1)
+                self.state     = 'open'
+                self.opened_at = time.monotonic()
+                self._probing  = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state':    self.state,
+                'failures': self.failures,
+                'opened':   self.opened,
+                'rejected': self.rejected,
+            }
+
+
+class ServiceClient:
+    """Pooled, deadline-bound, circuit-broken HTTP calls to one service."""
+
+    def __init__(self, target, base_url, timeout=5.0, connect_timeout=1.0, pool_size=10,
+                 hedge_after=None, failure_threshold=5, reset_timeout=10.0, session_factory=None):
+        self.target          = target
+        self.base_url        = (base_url or '').rstrip('/')
+        self.timeout         = timeout
+        self.connect_timeout = connect_timeout
+        self.pool_size       = pool_size
+        self.hedge_after     = hedge_after
+        self.breaker         = CircuitBreaker(target, failure_threshold, reset_timeout)
+        # Builds the per-process session; the benchmarks swap in a test client
+        self.session_factory = session_factory or self._new_session
+
+        self._session  = None
+        self._executor = None
+        self._pid      = None
+        self._lock     = threading.Lock()
+        self.hedged     = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_env(cls, target, base_url, prefix, **defaults):
+        """Options from `<prefix>_TIMEOUT`, `_CONNECT_TIMEOUT`, `_POOL_SIZE`, `_HEDGE_AFTER`,
+        `_FAILURE_THRESHOLD` and `_RESET_TIMEOUT`, falling back to `defaults`."""
+        def option(name, cast, default):
+            value = os.getenv(f'{prefix}_{name.upper()}')
+            return cast(value) if value else defaults.get(name, default)
+        return cls(
+            target, base_url,
+            timeout=option('timeout', float, 5.0),
+            connect_timeout=option('connect_timeout', float, 1.0),
+            pool_size=option('pool_size', int, 10),
+            hedge_after=option('hedge_after', float, None),
+            failure_threshold=option('failure_threshold', int, 5),
+            reset_timeout=option('reset_timeout', float, 10.0),
+        )
+
+    # ─── PER-PROCESS STATE ───────────────────────────────────────────────────
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip'
+        return session
+
+    def _ensure_process(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A forked child must not share the parent's sockets or threads
+            self._session  = self.session_factory()
+            self._executor = None
+            self._pid      = os.getpid()
+
+    @property
+    def session(self):
+        self._ensure_process()
+        return self._session
+
+    def _hedge_executor(self):
+        self._ensure_process()
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.pool_size, thread_name_prefix=f'{self.target}-client')
+        return self._executor
+
+    # ─── CALLS ───────────────────────────────────────────────────────────────
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def request(self, method, path, headers=None, deadline=None, hedge=True, **kwargs):
+        """
+        One call to `base_url + path`, answered within `deadline` seconds
+        (default: timeout). Extra arguments go to requests (json, params, ...).
+        """
+        budget  = self.timeout if deadline is None else deadline
+        expires = time.monotonic() + budget
+        url     = self.base_url + path
+        headers = tracing.inject(headers)
+        with metrics.outbound(self.target) as call:
+            if not self.breaker.allow():
+                call.status = 'circuit_open'
+                raise CircuitOpenError(f"{self.target} is failing; not calling it for now")
+            try:
+                if method == 'GET' and hedge and self.hedge_after is not None and self.hedge_after < budget:
+                    resp = self._hedged(method, url, headers, expires, kwargs)
+                else:
+                    resp = self._send(method, url, headers, expires, kwargs)
+            except Exception:
+                self.breaker.record(False)
+                raise
+            call.status = resp.status_code
+            self.breaker.record(resp.status_code < 500)
+            return resp
+
+    def _send(self, method, url, headers, expires, kwargs):
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout(f"{self.target} call ran out of time")
+        return self.session.request(method, url, headers=headers,
+                                    timeout=(min(self.connect_timeout, remaining), remaining), **kwargs)
+
+    def _hedged(self, method, url, headers, expires, kwargs):
+        executor = self._hedge_executor()
+        first = executor.submit(self._send, method, url, headers, expires, kwargs)
+        done, _ = wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+
+        second = executor.submit(self._send, method, url, headers, expires, kwargs)
+        with self._lock:
+            self.hedged += 1
+        pending, last = [first, second], None
+        while pending:
+            done, _ = wait(pending, timeout=max(expires - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                metrics.HEDGED.labels(self.target, 'none').inc()
+                raise requests.Timeout(f"{self.target} call ran out of time")
+            for future in done:
+                pending.remove(future)
+                last = future
+                if future.exception() is None and future.result().status_code < 500:
+                    # The loser is left to finish on its own; its response is dropped
+                    winner = 'first' if future is first else 'second'
+                    if future is second:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    metrics.HEDGED.labels(self.target, winner).inc()
+                    return future.result()
+        metrics.HEDGED.labels(self.target, 'none').inc()
+        return last.result()
+
+    def stats(self):
+        with self._lock:
+            hedged, hedge_wins = self.hedged, self.hedge_wins
+        return {
+            'target':      self.target,
+            'pool_size':   self.pool_size,
+            'timeout':     self.timeout,
+            'hedge_after': self.hedge_after,
+            'hedged':      hedged,
+            'hedge_wins':  hedge_wins,
+            'circuit':     self.breaker.stats(),
+        }
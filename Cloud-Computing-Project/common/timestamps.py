@@ -0,0 +1,19 @@
+"""
+ISO-8601 query values as the naive UTC datetimes the services compare and
+store (audit timestamps are UTC with a trailing 'Z').
+
+    parse_utc('2024-05-01')                   -> 2024-05-01 00:00
+    parse_utc('2024-05-01T00:00:00Z')         -> 2024-05-01 00:00
+    parse_utc('2024-05-01T00:00:00+02:00')    -> 2024-04-30 22:00
+"""
+from datetime import datetime, timezone
+
+
+def parse_utc(value):
+    """Naive UTC datetime of `value`, or None if it is empty. Raises ValueError if it is malformed."""
+    if not value:
+        return None
+    moment = datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    return moment.replace(tzinfo=None)
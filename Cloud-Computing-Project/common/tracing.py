@@ -0,0 +1,501 @@
+"""
+Request tracing shared by the services.
+
+    tracing.init_app(app, 'reporting')        # Flask: one server span per request
+    with tracing.span('GET transaction', kind='client') as span:
+        resp = requests.get(url, headers=tracing.inject(headers))
+
+Trace context travels between services in the W3C `traceparent` header.
+init_app() continues the caller's trace and inject() adds the header to an
+outbound call. Elasticsearch requests get a client span each, without
+touching call sites: common/es_client.py instruments every client it
+creates (instrument_es). Notification events carry the `traceparent` of
+the transfer that queued them, so the notification service can attach the
+email work to that transfer's trace even though the outbox delivers events
+in batches.
+
+Finished spans are handed to an exporter by a background thread, so a
+request never waits on export. TRACE_EXPORTER chooses it:
+
+- `none` (default): context is still propagated, nothing is recorded;
+- `file`: JsonFileExporter, one JSON span per line in TRACE_FILE. Needs no
+  collector, and several workers or services can share one file;
+- `module:attr`: any SpanExporter subclass (or factory) importable here.
+
+To see where the time of a slow request went:
+
+    python -m common.tracing traces.jsonl --slowest 5 --root 'POST /transactions'
+"""
+import os
+import re
+import sys
+import json
+import time
+import queue
+import random
+import inspect
+import logging
+import argparse
+import importlib
+import threading
+import contextvars
+from collections import namedtuple, defaultdict
+from contextlib import contextmanager
+from collections.abc import Mapping
+from common import lifecycle, metrics
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTER        = os.getenv('TRACE_EXPORTER', 'none')
+TRACE_FILE            = os.getenv('TRACE_FILE', 'traces.jsonl')
+TRACE_SAMPLE_RATE     = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))
+TRACE_QUEUE_SIZE      = int(os.getenv('TRACE_QUEUE_SIZE', 10000))
+TRACE_BATCH_SIZE      = int(os.getenv('TRACE_BATCH_SIZE', 512))
+TRACE_EXPORT_INTERVAL = float(os.getenv('TRACE_EXPORT_INTERVAL', 1.0))
+
+TRACEPARENT_HEADER = 'traceparent'
+_TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$')
+
+# A span received from another process: enough to continue its trace
+SpanContext = namedtuple('SpanContext', 'trace_id span_id sampled')
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+# ─── CONTEXT ─────────────────────────────────────────────────────────────────
+def parse_traceparent(value):
+    """SpanContext from a `traceparent` value, or None if it is missing or invalid."""
+    m = _TRACEPARENT.match(value.strip()) if value else None
+    if not m:
+        return None
+    version, trace_id, span_id, flags, rest = m.groups()
+    if version == 'ff' or (version == '00' and rest) or not int(trace_id, 16) or not int(span_id, 16):
+        return None
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1))
+
+
+def format_traceparent(context):
+    return f"00-{context.trace_id}-{context.span_id}-{'01' if context.sampled else '00'}"
+
+
+def traceparent():
+    """`traceparent` of the current span, or None outside any span."""
+    span = current_span.get()
+    return format_traceparent(span) if span is not None else None
+
+
+def inject(headers=None):
+    """Copy of `headers` with the current `traceparent` added."""
+    headers = dict(headers or {})
+    span = current_span.get()
+    if span is not None:
+        headers[TRACEPARENT_HEADER] = format_traceparent(span)
+    return headers
+
+
+# ─── SPANS ───────────────────────────────────────────────────────────────────
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'sampled', 'name', 'kind',
+                 'attributes', 'links', 'error', 'start', '_started')
+
+    def __init__(self, name, kind='internal', parent=None, links=(), attributes=None):
+        if parent is None:
+            self.trace_id  = f'{random.getrandbits(128):032x}'
+            self.parent_id = None
+            self.sampled   = random.random() < TRACE_SAMPLE_RATE
+        else:
+            self.trace_id  = parent.trace_id
+            self.parent_id = parent.span_id
+            self.sampled   = parent.sampled
+        self.span_id    = f'{random.getrandbits(64):016x}'
+        self.name       = name
+        self.kind       = kind
+        self.attributes = attributes or {}
+        self.links      = list(links)
+        self.error      = None
+        self.start      = time.time()
+        self._started   = time.perf_counter()
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, exc):
+        self.error = f'{type(exc).__name__}: {exc}'
+
+    def end(self):
+        processor = _state['processor']
+        if self.sampled and processor is not None:
+            processor.submit(self, time.perf_counter() - self._started)
+
+
+def start(name, kind='internal', parent=None, links=(), attributes=None):
+    """
+    Open a span and make it current, for code that cannot use span() as a
+    context manager. Returns the (span, token) pair finish() expects.
+    """
+    span = Span(name, kind, parent if parent is not None else current_span.get(), links, attributes)
+    return span, current_span.set(span)
+
+
+def finish(span, token, exc=None):
+    if exc is not None:
+        span.record_error(exc)
+    try:
+        current_span.reset(token)
+    except ValueError:
+        # Ended from another context (a server hook); that context is discarded anyway
+        pass
+    span.end()
+
+
+@contextmanager
+def span(name, kind='internal', parent=None, links=(), attributes=None):
+    """
+    Time the block as a child of the current span (or of `parent`, a Span or
+    SpanContext). Exceptions raised in the block are recorded on the span.
+    """
+    s, token = start(name, kind, parent, links, attributes)
+    try:
+        yield s
+    except Exception as e:
+        s.record_error(e)
+        raise
+    finally:
+        current_span.reset(token)
+        s.end()
+
+
+# ─── HTTP SERVER ─────────────────────────────────────────────────────────────
+def _server_span(request):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    return start(
+        f'{request.method} {route}', 'server',
+        parent=parse_traceparent(request.headers.get(TRACEPARENT_HEADER)),
+        attributes={'http.method': request.method, 'http.route': route}
+    )
+
+
+def init_app(app, service):
+    """Trace every Flask request, continuing the caller's trace when it sent one."""
+    from flask import request, g
+    configure(service)
+
+    @app.before_request
+    def _start_span():
+        g._trace = _server_span(request)
+
+    @app.after_request
+    def _record_status(response):
+        trace = g.get('_trace')
+        if trace is not None:
+            trace[0].set_attribute('http.status_code', response.status_code)
+        return response
+
+    @app.teardown_request
+    def _end_span(exc):
+        trace = g.pop('_trace', None)
+        if trace is not None:
+            finish(*trace, exc=exc)
+
+
+def init_quart_app(app, service):
+    """init_app for the Quart (asyncio) variant of the transaction service."""
+    from quart import request, g
+    configure(service)
+
+    @app.before_request
+    async def _start_span():
+        g._trace = _server_span(request)
+
+    @app.after_request
+    async def _record_status(response):
+        trace = g.get('_trace')
+        if trace is not None:
+            trace[0].set_attribute('http.status_code', response.status_code)
+        return response
+
+    @app.teardown_request
+    async def _end_span(exc):
+        trace = g.pop('_trace', None)
+        if trace is not None:
+            finish(*trace, exc=exc)
+
+
+# ─── ELASTICSEARCH ───────────────────────────────────────────────────────────
+def instrument_es(client):
+    """
+    Give every request `client` sends a client span, and pass the trace on
+    to Elasticsearch in its `traceparent` header. Like metrics.instrument_es,
+    this covers .options() clients and es.indices... as well.
+    """
+    from common.metrics import es_operation
+    transport = client.transport
+    send = transport.perform_request
+    if getattr(send, '_traced', False):
+        return client
+
+    def with_header(kwargs, s):
+        headers = kwargs.get('headers')
+        kwargs['headers'] = {**(headers if isinstance(headers, Mapping) else {}),
+                             TRACEPARENT_HEADER: format_traceparent(s)}
+        return kwargs
+
+    if inspect.iscoroutinefunction(send):
+        async def perform_request(method, target, *args, **kwargs):
+            with span(es_operation(method, target), 'client', attributes={'db.system': 'elasticsearch'}) as s:
+                resp = await send(method, target, *args, **with_header(kwargs, s))
+                s.set_attribute('http.status_code', resp.meta.status)
+                return resp
+    else:
+        def perform_request(method, target, *args, **kwargs):
+            with span(es_operation(method, target), 'client', attributes={'db.system': 'elasticsearch'}) as s:
+                resp = send(method, target, *args, **with_header(kwargs, s))
+                s.set_attribute('http.status_code', resp.meta.status)
+                return resp
+
+    perform_request._traced = True
+    transport.perform_request = perform_request
+    return client
+
+
+# ─── EXPORT ──────────────────────────────────────────────────────────────────
+class SpanExporter:
+    """Receives finished spans, as dicts, in batches from the export thread."""
+
+    def export(self, spans):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class JsonFileExporter(SpanExporter):
+    """
+    Appends one JSON span per line to `path`. Each batch is a single
+    O_APPEND write, so processes sharing the file never interleave lines.
+    """
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def export(self, spans):
+        data = ''.join(json.dumps(s, default=str) + '\n' for s in spans).encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+def exporter_from_env(name=TRACE_EXPORTER):
+    if not name or name == 'none':
+        return None
+    if name == 'file':
+        return JsonFileExporter(TRACE_FILE)
+    module, _, attr = name.partition(':')
+    return getattr(importlib.import_module(module), attr)()
+
+
+class BatchProcessor:
+    """
+    Queues finished spans and exports them from a daemon thread, started
+    lazily and again in every forked worker. When the queue is full, spans
+    are dropped and counted.
+    """
+
+    def __init__(self, exporter, max_queue=TRACE_QUEUE_SIZE, batch_size=TRACE_BATCH_SIZE,
+                 interval=TRACE_EXPORT_INTERVAL):
+        self.exporter   = exporter
+        self.max_queue  = max_queue
+        self.batch_size = batch_size
+        self.interval   = interval
+
+        self._queue  = queue.Queue(maxsize=max_queue)
+        self._lock   = threading.Lock()
+        self._stop   = threading.Event()
+        self._thread = None
+        self._pid    = None
+
+        self.exported = 0
+        self.dropped  = 0
+        self.failed   = 0
+
+    def submit(self, span, duration):
+        if self._pid != os.getpid():
+            self._ensure_started()
+        try:
+            self._queue.put_nowait((span, duration))
+        except queue.Full:
+            self.dropped += 1
+            metrics.TELEMETRY_DROPPED.labels('span').inc()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Spans queued before a fork belong to the parent, which exports them
+            self._pid    = os.getpid()
+            self._queue  = queue.Queue(maxsize=self.max_queue)
+            self._stop   = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='trace-export', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._drain(self.interval)
+            if batch:
+                self._export(batch)
+
+    def _drain(self, timeout):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+        except queue.Empty:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _export(self, batch):
+        service = _state['service']
+        try:
+            self.exporter.export([_to_dict(s, duration, service) for s, duration in batch])
+            self.exported += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            logger.warning("Exporting %d spans failed: %s", len(batch), e)
+
+    def shutdown(self, timeout=5.0):
+        """Stop the thread and export what is still queued."""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        while True:
+            batch = self._drain(0)
+            if not batch:
+                break
+            self._export(batch)
+        self.exporter.shutdown()
+
+    def stats(self):
+        return {
+            'exported':    self.exported,
+            'dropped':     self.dropped,
+            'failed':      self.failed,
+            'queue_depth': self._queue.qsize(),
+        }
+
+
+def _to_dict(span, duration, service):
+    entry = {
+        'trace_id':    span.trace_id,
+        'span_id':     span.span_id,
+        'parent_id':   span.parent_id,
+        'service':     service,
+        'name':        span.name,
+        'kind':        span.kind,
+        'start':       round(span.start, 6),
+        'duration_ms': round(duration * 1000, 3),
+        'attributes':  span.attributes,
+    }
+    if span.links:
+        entry['links'] = [{'trace_id': c.trace_id, 'span_id': c.span_id} for c in span.links]
+    if span.error:
+        entry['error'] = span.error
+    return entry
+
+
+_state = {'service': None, 'processor': None}
+_lock = threading.Lock()
+
+
+def configure(service, exporter=None):
+    """
+    Name the spans of this process and set up the exporter (`exporter`, or
+    TRACE_EXPORTER). Idempotent; queued spans are exported at shutdown.
+    """
+    with _lock:
+        if _state['service'] is not None:
+            return
+        _state['service'] = service
+        exporter = exporter if exporter is not None else exporter_from_env()
+        if exporter is not None:
+            processor = BatchProcessor(exporter)
+            _state['processor'] = processor
+            lifecycle.on_shutdown(processor.shutdown)
+
+
+def stats():
+    processor = _state['processor']
+    return processor.stats() if processor is not None else {}
+
+
+# ─── READING TRACES ──────────────────────────────────────────────────────────
+def load(paths):
+    traces = defaultdict(list)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    s = json.loads(line)
+                    traces[s['trace_id']].append(s)
+    return traces
+
+
+def render(spans):
+    """Waterfall of one trace: offset and duration in ms, indented by depth."""
+    ids = {s['span_id'] for s in spans}
+    children = defaultdict(list)
+    for s in spans:
+        children[s['parent_id'] if s['parent_id'] in ids else None].append(s)
+    origin = min(s['start'] for s in spans)
+    lines = []
+
+    def walk(s, depth):
+        offset = (s['start'] - origin) * 1000
+        error = f"  !! {s['error']}" if s.get('error') else ''
+        lines.append(f"{offset:9.1f} {s['duration_ms']:9.1f}  {s['service'] or '-':<18} {'  ' * depth}{s['name']}{error}")
+        for child in sorted(children[s['span_id']], key=lambda c: c['start']):
+            walk(child, depth + 1)
+
+    for root in sorted(children[None], key=lambda c: c['start']):
+        walk(root, 0)
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show traces written by JsonFileExporter')
+    parser.add_argument('files', nargs='+', help='span files, e.g. one per service')
+    parser.add_argument('--trace', help='show this trace id')
+    parser.add_argument('--root', help='only traces whose first span name contains this')
+    parser.add_argument('--slowest', type=int, default=1, help='show the N slowest traces')
+    args = parser.parse_args(argv)
+
+    traces = load(args.files)
+    if args.trace:
+        selected = [traces.get(args.trace, [])]
+    else:
+        def root_of(spans):
+            return min(spans, key=lambda s: (s['parent_id'] is not None, s['start']))
+        candidates = [spans for spans in traces.values()
+                      if not args.root or args.root in root_of(spans)['name']]
+        selected = sorted(candidates, key=lambda spans: root_of(spans)['duration_ms'], reverse=True)[:args.slowest]
+
+    for spans in selected:
+        if not spans:
+            print(f'trace {args.trace} not found', file=sys.stderr)
+            continue
+        print(f"trace {spans[0]['trace_id']} ({len(spans)} spans)")
+        print(f"{'start ms':>9} {'took ms':>9}  {'service':<18} span")
+        print('\n'.join(render(spans)))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 // At the top of the file, add:
 let weeklyActivityChart = null;
 let balanceHistoryChart = null;
+// Usernames of the user's cards, and the pending /reports/full request for them
+let cardUsernames = [];
+let reportsRequest = null;
 
 // Constants
 const API_URL = (typeof window !== 'undefined' && window.USER_API);
@@ -17,6 +20,51 @@ console.log('Final TRANSACTION_API_URL value:', TRANSACTION_API_URL);
 console.log('Final REPORT_API_URL value:', REPORT_API_URL);
 
 // Utility Functions
+function getReportBaseUrl() {
+    return window.REPORT_API.endsWith('/') ? window.REPORT_API.slice(0, -1) : window.REPORT_API;
+}
+
+// Summary and usage of every card in one request, shared by all dashboard widgets.
+// Resolves to {username: {summary, usage_analysis}}, or null after a 401.
+function fetchReports(usernames) {
+    const names = [...new Set(usernames)].sort();
+    const key = names.join(',');
+    if (reportsRequest && reportsRequest.key === key) {
+        return reportsRequest.promise;
+    }
+    const promise = (async () => {
+        const auth = getAuthData();
+        if (!auth) return null;
+        const query = names.map(u => `username=${encodeURIComponent(u)}`).join('&');
+        const response = await fetch(`${getReportBaseUrl()}/reports/full?${query}`, {
+            headers: {
+                'Authorization': `Bearer ${auth.token}`
+            }
+        });
+        const handledResponse = await handleApiResponse(response);
+        if (!handledResponse) return null;
+        if (!handledResponse.ok) {
+            throw new Error(`Failed to fetch reports: ${handledResponse.status}`);
+        }
+        return (await handledResponse.json()).reports;
+    })();
+    // Let the next caller retry instead of sharing a failure
+    promise.catch(() => {
+        if (reportsRequest && reportsRequest.promise === promise) reportsRequest = null;
+    });
+    reportsRequest = { key, promise };
+    return promise;
+}
+
+// The selected card's report, fetched together with the other cards
+async function fetchReport(username) {
+    const usernames = cardUsernames.includes(username) ? cardUsernames : [...cardUsernames, username];
+    const reports = await fetchReports(usernames);
+    if (!reports) return null;
+    if (!reports[username]) throw new Error('No report for this card');
+    return reports[username];
+}
+
 function getAuthData() {
     const token = localStorage.getItem('token');
     const userId = localStorage.getItem('user_id');
@@ -245,6 +293,7 @@ async function loadCards() {
         }
         const data = await handledResponse.json();
         let cards = data.cards;
+        cardUsernames = cards.map(card => card.username);
         if (cards.length === 0) {
             renderCardsRow([]);
         } else {
@@ -303,18 +352,13 @@ async function initializeCharts() {
         const weekStart = new Date(today);
         weekStart.setDate(today.getDate() - today.getDay()); // Start of week (Sunday)
 
-        // Fetch transactions for each card
-        for (const card of cards) {
-            const baseUrl = window.REPORT_API.endsWith('/') ? window.REPORT_API.slice(0, -1) : window.REPORT_API;
-            const response = await fetch(`${baseUrl}/report/${card.username}`, {
-                headers: {
-                    'Authorization': `Bearer ${auth.token}`
-                }
-            });
+        // One request for the reports of every card
+        const reports = cards.length > 0 ? (await fetchReports(cards.map(card => card.username))) || {} : {};
 
-            if (response.ok) {
-                const data = await response.json();
-                const transactions = data.summary.recent_activity || [];
+        for (const card of cards) {
+            const report = reports[card.username];
+            if (report) {
+                const transactions = report.summary.recent_activity || [];
 
                 // Filter and process transactions for this week
                 transactions.forEach(transaction => {
@@ -392,17 +436,11 @@ async function initializeCharts() {
         // We'll sum all deposits and subtract all withdrawals up to the end of each month
         let allCardTransactions = [];
         for (const card of cards) {
-            const baseUrl = window.REPORT_API.endsWith('/') ? window.REPORT_API.slice(0, -1) : window.REPORT_API;
-            const response = await fetch(`${baseUrl}/report/${card.username}`, {
-                headers: {
-                    'Authorization': `Bearer ${auth.token}`
-                }
-            });
-            if (response.ok) {
-                const data = await response.json();
-                // Assume the reporting service returns all transactions in data.summary.all_activity or similar
+            const report = reports[card.username];
+            if (report) {
+                // Assume the reporting service returns all transactions in summary.all_activity or similar
                 // If not, fallback to recent_activity (less accurate)
-                let transactions = data.summary.all_activity || data.summary.recent_activity || [];
+                let transactions = report.summary.all_activity || report.summary.recent_activity || [];
                 // Add card info to each transaction
                 transactions = transactions.map(tx => ({ ...tx, card }));
                 allCardTransactions = allCardTransactions.concat(transactions);
@@ -576,18 +614,8 @@ async function fetchRecentTransactions(username) {
             return;
         }
 
-        const baseUrl = window.REPORT_API.endsWith('/') ? window.REPORT_API.slice(0, -1) : window.REPORT_API;
-        const response = await fetch(`${baseUrl}/report/${username}`, {
-            headers: {
-                'Authorization': `Bearer ${auth.token}`
-            }
-        });
-
-        if (!response.ok) {
-            throw new Error(`Failed to fetch: ${response.status}`);
-        }
-
-        const data = await response.json();
+        const data = await fetchReport(username);
+        if (!data) return;
         const transactionsList = document.getElementById('recent-transactions-list');
         transactionsList.innerHTML = ''; // Clear existing transactions
 
@@ -630,14 +658,8 @@ async function fetchAndDisplayTotals(username) {
     try {
         const auth = getAuthData();
         if (!auth) return;
-        const baseUrl = window.REPORT_API.endsWith('/') ? window.REPORT_API.slice(0, -1) : window.REPORT_API;
-        const response = await fetch(`${baseUrl}/report/${username}`, {
-            headers: {
-                'Authorization': `Bearer ${auth.token}`
-            }
-        });
-        if (!response.ok) throw new Error('Failed to fetch totals');
-        const data = await response.json();
+        const data = await fetchReport(username);
+        if (!data) return;
         const summary = data.summary || {};
         document.getElementById('total-sent').textContent = formatAmount(summary.total_sent || 0);
         document.getElementById('total-received').textContent = formatAmount(summary.total_received || 0);
@@ -680,20 +702,8 @@ async function fetchAndDisplayTransactionStats(username) {
     if (!auth) return;
 
     try {
-        const response = await fetch(`${REPORT_API_URL}/report/${username}`, {
-            headers: {
-                'Authorization': `Bearer ${auth.token}`
-            }
-        });
-
-        const handledResponse = await handleApiResponse(response);
-        if (!handledResponse) return;
-
-        if (!handledResponse.ok) {
-            throw new Error('Failed to fetch transaction statistics');
-        }
-
-        const data = await handledResponse.json();
+        const data = await fetchReport(username);
+        if (!data) return;
         const summary = data.summary;
 
         // Update the statistics in the UI
@@ -712,17 +722,8 @@ async function fetchAndDisplayUsage(username) {
     const auth = getAuthData();
     if (!auth) return;
     try {
-        const response = await fetch(`${REPORT_API_URL}/report/${username}/usage`, {
-            headers: {
-                'Authorization': `Bearer ${auth.token}`
-            }
-        });
-        const handledResponse = await handleApiResponse(response);
-        if (!handledResponse) return;
-        if (!handledResponse.ok) {
-            throw new Error('Failed to fetch usage data');
-        }
-        const data = await handledResponse.json();
+        const data = await fetchReport(username);
+        if (!data) return;
         const usage = data.usage_analysis;
         let html = `
             <div><b>Transaction Frequency:</b> Daily: ${usage.transaction_frequency.daily.toFixed(2)}, Weekly: ${usage.transaction_frequency.weekly.toFixed(2)}, Monthly: ${usage.transaction_frequency.monthly.toFixed(2)}</div>
@@ -742,6 +743,8 @@ async function loadDashboard() {
     const username = localStorage.getItem('username');
     if (!username) return;
 
+    // Fresh reports for this refresh; every widget below shares one request
+    reportsRequest = null;
     await Promise.all([
         loadCards(),
         fetchRecentTransactions(username),
@@ -1,3 +1,6 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import os
 import smtplib
 import logging
@@ -6,15 +9,18 @@ from email.mime.multipart import MIMEMultipart
 from flask import Flask, request, jsonify
 from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity
 from elasticsearch import Elasticsearch, NotFoundError
+from common import log, metrics, tracing
+from common.es_client import ProcessLocalClient
+from common.bootstrap import Bootstrap, register_health_routes
 
 app = Flask(__name__)
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(levelname)s - %(message)s'
-)
+log.configure('notification')
 logger = logging.getLogger(__name__)
+log.init_app(app)
+metrics.init_app(app)
+tracing.init_app(app, 'notification')
 
 # ─── JWT CONFIG ───────────────────────────────────────────────────────────────
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
@@ -30,15 +36,18 @@ ES_USERNAME = os.getenv('ELASTIC_USERNAME')
 ES_PASSWORD = os.getenv('ELASTIC_PASSWORD')
 ES_URL = os.getenv('ES_URL')
 
-logger.info(f"Attempting to connect to Elasticsearch at {ES_URL}")
-es = Elasticsearch(
+# One client per process, created on first use (safe to fork)
+es = ProcessLocalClient(lambda: Elasticsearch(
         [ES_URL],
         basic_auth=(ES_USERNAME, ES_PASSWORD)
-)
+))
 # Index names
 CARD_INDEX = 'cards'
 USER_INDEX = 'users'
 
+# Nothing to create here; readiness still tracks ES availability
+bootstrap = Bootstrap(es, 'notification', started_at=STARTED_AT)
+
 # Email configuration
 SMTP_SERVER = os.getenv('SMTP_SERVER')
 SMTP_PORT = int(os.getenv('SMTP_PORT'))
@@ -60,7 +69,7 @@ def send_email(to_address, subject, body):
     """
     try:
         if not all([SMTP_USERNAME, SMTP_PASSWORD]):
-            logger.info(f"[EMAIL] (SMTP not configured) To: {to_address}\nSubject: {subject}\n{body}\n")
+            logger.info("[EMAIL] (SMTP not configured) To: %s\nSubject: %s\n%s\n", to_address, subject, body)
             return True
 
         # Create message(ss)
@@ -71,15 +80,16 @@ def send_email(to_address, subject, body):
         msg.attach(MIMEText(body, 'plain'))
 
         # Connect to SMTP server and send
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
+        with tracing.span('smtp send', 'client'), metrics.smtp_send(), \
+                smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
             server.starttls()
             server.login(SMTP_USERNAME, SMTP_PASSWORD)
             server.send_message(msg)
         
-        logger.info(f"[EMAIL] Sent to {to_address}")
+        logger.info("[EMAIL] Sent to %s", to_address)
         return True
     except Exception as e:
-        logger.error(f"[EMAIL] Error sending to {to_address}: {str(e)}")
+        logger.error("[EMAIL] Error sending to %s: %s", to_address, e)
         return False
 
 # --- Helpers ---
@@ -95,20 +105,23 @@ def fetch_user_email(card_doc):
     except NotFoundError:
         return None
     except Exception as e:
-        logger.error(f"Error fetching user data: {e}")
+        logger.error("Error fetching user data: %s", e)
         return None
 
 # --- Routes ---
-@app.route('/transaction-notify', methods=['POST'])
-def notify_transaction():
-    # Verify service authentication
+def is_service_request():
     service_token = request.headers.get('X-Service-Token')
-    if not service_token or service_token != SERVICE_SECRET:
-        logger.warning("Unauthorized service access attempt")
-        return jsonify({'message': 'Unauthorized service access'}), 403
+    return bool(service_token) and service_token == SERVICE_SECRET
 
-    data = request.get_json() or {}
+def process_notification(data):
+    """
+    Validate a single transaction event and send the sender/receiver emails.
+    Returns a (body, status_code) tuple.
+    """
     status = data.get('status')
+    if status == 'batch':
+        return process_batch_notification(data)
+
     trans_id = data.get('trans_id')
     sender_doc = data.get('sender_doc')
     receiver_doc = data.get('receiver_doc')
@@ -118,34 +131,35 @@ def notify_transaction():
     
     # Validate status
     if not status:
-        logger.error(f"Missing status: {data}")
-        return jsonify({'message': 'Missing status'}), 400
+        logger.error("Missing status: %s", data)
+        return {'message': 'Missing status'}, 400
 
     # Validate required fields
     if status == 'failed':
         if not all([trans_id, sender_doc, amount, reason]):
-            logger.error(f"Missing transaction fields: {data}")
-            return jsonify({'message': 'Missing transaction fields'}), 400
+            logger.error("Missing transaction fields: %s", data)
+            return {'message': 'Missing transaction fields'}, 400
     else:
         if not all([trans_id, sender_doc, receiver_doc, amount]):
-            logger.error(f"Missing transaction fields: {data}")
-            return jsonify({'message': 'Missing transaction fields'}), 400
+            logger.error("Missing transaction fields: %s", data)
+            return {'message': 'Missing transaction fields'}, 400
 
     # Get contact info
     s_email = fetch_user_email(sender_doc)
     if not s_email:
-        logger.error(f"Sender email not found for user: {sender_doc.get('username')}")
-        return jsonify({'message': 'Sender not found'}), 404
+        logger.error("Sender email not found for user: %s", sender_doc.get('username'))
+        return {'message': 'Sender not found'}, 404
 
     if status != 'failed':
         r_email = fetch_user_email(receiver_doc)
         if not r_email:
-            logger.error(f"Receiver email not found for user: {receiver_doc.get('username')}")
-            return jsonify({'message': 'Receiver not found'}), 404
+            logger.error("Receiver email not found for user: %s", receiver_doc.get('username'))
+            return {'message': 'Receiver not found'}, 404
         
         # Construct messages
         sender_msg = f"Dear {sender_doc.get('username')},\n\nYour transaction {trans_id} of ${amount:.2f} has been successfully sent to {receiver_doc.get('username')}."
-        logger.info(f"Transaction successful - ID: {trans_id}, Amount: ${amount:.2f}, From: {sender_doc.get('username')}, To: {receiver_doc.get('username')}")
+        logger.info("Transaction successful - ID: %s, Amount: $%.2f, From: %s, To: %s",
+                    trans_id, amount, sender_doc.get('username'), receiver_doc.get('username'))
         email_sent = send_email(s_email, 'Transaction sent', sender_msg)
 
         receiver_msg = f"Dear {receiver_doc.get('username')},\n\nYou received ${amount:.2f} from {sender_doc.get('username')}. Transaction ID: {trans_id}."
@@ -153,16 +167,105 @@ def notify_transaction():
 
     else:
         sender_msg = f"Dear {sender_doc.get('username')},\n\nYour transaction {trans_id} of ${amount:.2f} has failed\nReason: {reason}."
-        logger.error(f"Transaction failed - ID: {trans_id}, Amount: ${amount:.2f}, Reason: {reason}")
+        logger.error("Transaction failed - ID: %s, Amount: $%.2f, Reason: %s", trans_id, amount, reason)
         email_sent = send_email(s_email, 'Transaction failed', sender_msg)
 
     if not email_sent:
-        logger.error(f"Failed to send notifications for transaction: {trans_id}")
-        return jsonify({'message': 'Transaction notifications partially sent'}), 207
+        logger.error("Failed to send notifications for transaction: %s", trans_id)
+        return {'message': 'Transaction notifications partially sent'}, 207
+
+    logger.info("Successfully sent all notifications for transaction: %s", trans_id)
+    return {'message': 'Transaction notifications sent'}, 200
+
+def process_batch_notification(data):
+    """
+    Notify about a payout batch: one summary email to the sender and one
+    email to each receiver that was paid. Returns a (body, status_code) tuple.
+    """
+    batch_id = data.get('trans_id')
+    sender_doc = data.get('sender_doc')
+    items = data.get('items')
+
+    if not all([batch_id, sender_doc, items]):
+        logger.error("Missing batch fields: %s", data)
+        return {'message': 'Missing batch fields'}, 400
+
+    s_email = fetch_user_email(sender_doc)
+    if not s_email:
+        logger.error("Sender email not found for user: %s", sender_doc.get('username'))
+        return {'message': 'Sender not found'}, 404
+
+    lines = []
+    email_sent = True
+    for item in items:
+        receiver_doc = item.get('receiver_doc') or {}
+        amount = item.get('amount') or 0
+        if item.get('status') != 'completed':
+            lines.append(f"- ${amount:.2f} to {receiver_doc.get('username')} failed: {item.get('reason')}")
+            continue
+        lines.append(f"- ${amount:.2f} to {receiver_doc.get('username')} (transaction {item.get('trans_id')})")
+
+        r_email = fetch_user_email(receiver_doc)
+        if not r_email:
+            logger.error("Receiver email not found for user: %s", receiver_doc.get('username'))
+            email_sent = False
+            continue
+        receiver_msg = f"Dear {receiver_doc.get('username')},\n\nYou received ${amount:.2f} from {sender_doc.get('username')}. Transaction ID: {item.get('trans_id')}."
+        email_sent = send_email(r_email, 'Transaction Received', receiver_msg) and email_sent
+
+    sender_msg = f"Dear {sender_doc.get('username')},\n\nYour payout batch {batch_id} has been processed:\n" + "\n".join(lines)
+    email_sent = send_email(s_email, 'Payout processed', sender_msg) and email_sent
+    logger.info("Batch notification - ID: %s, Transfers: %d", batch_id, len(items))
+
+    if not email_sent:
+        logger.error("Failed to send notifications for batch: %s", batch_id)
+        return {'message': 'Batch notifications partially sent'}, 207
+    return {'message': 'Batch notifications sent'}, 200
+
+@app.route('/transaction-notify', methods=['POST'])
+def notify_transaction():
+    # Verify service authentication
+    if not is_service_request():
+        logger.warning("Unauthorized service access attempt")
+        return jsonify({'message': 'Unauthorized service access'}), 403
+
+    body, code = process_notification(request.get_json() or {})
+    return jsonify(body), code
+
+@app.route('/transaction-notify/batch', methods=['POST'])
+def notify_transaction_batch():
+    """
+    Deliver a batch of transaction events queued by the transaction service's
+    outbox. Each event is processed independently and gets its own result.
+    """
+    if not is_service_request():
+        logger.warning("Unauthorized service access attempt")
+        return jsonify({'message': 'Unauthorized service access'}), 403
+
+    events = (request.get_json() or {}).get('events')
+    if not isinstance(events, list):
+        return jsonify({'message': 'Missing events'}), 400
+
+    results = []
+    batch_span = tracing.current_span.get()
+    for event in events:
+        try:
+            # Continue the trace of the transfer that queued the event
+            with tracing.span(f"notify {(event or {}).get('status')}",
+                              parent=tracing.parse_traceparent((event or {}).get('traceparent')),
+                              links=[batch_span] if batch_span else ()) as span:
+                body, code = process_notification(event or {})
+                span.set_attribute('notify.status_code', code)
+        except Exception as e:
+            logger.error("Error processing notification for %s: %s", (event or {}).get('trans_id'), e)
+            body, code = {'message': 'Notification failed'}, 500
+        results.append({'trans_id': (event or {}).get('trans_id'), 'status': code, 'message': body['message']})
+
+    logger.info("Processed notification batch of %d events", len(events))
+    return jsonify({'results': results}), 200
 
-    logger.info(f"Successfully sent all notifications for transaction: {trans_id}")
-    return jsonify({'message': 'Transaction notifications sent'}), 200
+register_health_routes(app, bootstrap)
 
 if __name__ == '__main__':
     PORT = int(os.getenv('NOTIFY_PORT'))
-    app.run(host='0.0.0.0', port=PORT, debug=True)
+    app.run(host='0.0.0.0', port=PORT)
@@ -0,0 +1,114 @@
+"""
+Built reports, reused while the user's user_stats document is unchanged.
+
+Every transfer that touches a user ends with an update of their user_stats
+document, so its (_primary_term, _seq_no) is a version of all the data a
+report is built from. A lookup costs one mget without _source; a hit skips
+reading the document and building the report, and when the client already
+holds that version (If-None-Match) the response has no body at all.
+
+The day is part of the version too: transaction_frequency counts the days
+up to today, so a report built yesterday is stale even with no new
+transfers. A ranged report is cached under its span as well; the same
+user_stats version covers it, since user_rollups is updated in the same
+bulk requests.
+
+Memory is bounded by the JSON size of the cached values
+(REPORT_CACHE_MAX_BYTES), least recently used first out.
+"""
+import os
+import json
+import hashlib
+import threading
+from datetime import date
+from collections import OrderedDict, namedtuple
+from common import metrics
+
+CachedReport = namedtuple('CachedReport', 'version value size cost')
+
+
+class ReportCache:
+    """Thread-safe LRU of (report, username, span) -> CachedReport, bounded in bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes     = 0
+        self._data     = OrderedDict()
+        self._lock     = threading.Lock()
+        self.hits          = 0
+        self.misses        = 0
+        self.evictions     = 0
+        self.saved_seconds = 0.0
+
+    @classmethod
+    def from_env(cls):
+        return cls(int(os.getenv('REPORT_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+
+    def get(self, report, username, version, span=None):
+        """The cached value if it was built from `version`, else None."""
+        key = (report, username, span)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry.version != version:
+                self.misses += 1
+                metrics.REPORT_CACHE_LOOKUPS.labels(report, 'miss').inc()
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry.cost
+        metrics.REPORT_CACHE_LOOKUPS.labels(report, 'hit').inc()
+        metrics.REPORT_CACHE_SAVED.labels(report).inc(entry.cost)
+        return entry.value
+
+    def set(self, report, username, version, value, cost, span=None):
+        """Store `value` as built from `version`; `cost` is the seconds it took."""
+        size = len(json.dumps(value, separators=(',', ':')))
+        if size > self.max_bytes:
+            return
+        key = (report, username, span)
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self._data[key] = CachedReport(version, value, size, cost)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def count(self, report, result, n=1):
+        """Lookups answered without an entry: `not_modified` (304) or `bypass` (user_stats not rebuilt)."""
+        metrics.REPORT_CACHE_LOOKUPS.labels(report, result).inc(n)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size':          len(self._data),
+                'bytes':         self.bytes,
+                'max_bytes':     self.max_bytes,
+                'hits':          self.hits,
+                'misses':        self.misses,
+                'hit_ratio':     round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions':     self.evictions,
+                'saved_seconds': round(self.saved_seconds, 6),
+            }
+
+
+def versions_of(stats_versions):
+    """Cache versions from fetch_stats_versions: the document version and today."""
+    today = date.today().isoformat()
+    return {username: (version, today) for username, version in stats_versions.items()}
+
+
+def etag(report, versions, span=None):
+    """Strong ETag of a response built from `versions` ({username: version}), over `span` if ranged."""
+    digest = hashlib.sha1(repr((report, span, sorted(versions.items()))).encode()).hexdigest()
+    return digest[:32]
+
@@ -0,0 +1,271 @@
+"""
+/report/<username> and /report/<username>/usage over a time range:
+
+    ?from=2024-05-01&to=2024-06-01&interval=week
+
+`from` and `to` are ISO-8601 dates or timestamps (UTC unless they carry
+an offset), `to` exclusive, and both optional; `interval` is hour, day
+(the default), week (starting on Monday) or month. The transaction service keeps one user_rollups document
+per user and active hour (see transaction/user_rollups.py), and a range is
+one search over them: a date_histogram on the interval with sums of the
+numbers, plus the active days, time-of-day periods and top counterparties.
+Nothing is paged back; the cost follows the number of active hours in
+the range, not the number of transfers. The hour is also the resolution,
+so the bounds are widened to whole hours.
+
+Until rebuild_rollups.py has run, the same hourly rollups are built from
+the user's history over the range and totalled here instead
+(totals_from_rollups, the Python twin of totals_from_aggs).
+"""
+from datetime import datetime, date, timedelta
+from common.timestamps import parse_utc
+from report_summary import ROLLUP_INDEX
+from usage_engine import PERIODS, PERIOD_OF_HOUR, transaction_frequency
+
+INTERVALS = ('hour', 'day', 'week', 'month')
+RANGE_ARGS = ('from', 'to', 'interval')
+
+
+def is_ranged(args):
+    return any(args.get(name) for name in RANGE_ARGS)
+
+
+def parse_span(args):
+    """
+    (since, until, interval) from the query arguments, the bounds naive UTC
+    datetimes on whole hours or None. Raises ValueError if they are malformed.
+    """
+    try:
+        since, until = parse_utc(args.get('from')), parse_utc(args.get('to'))
+    except ValueError:
+        raise ValueError('Invalid date range')
+    interval = args.get('interval') or 'day'
+    if interval not in INTERVALS:
+        raise ValueError(f"interval must be one of {', '.join(INTERVALS)}")
+
+    if since:
+        since = since.replace(minute=0, second=0, microsecond=0)
+    if until and until != until.replace(minute=0, second=0, microsecond=0):
+        until = until.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    if since and until and since >= until:
+        raise ValueError('Invalid date range')
+    return since, until, interval
+
+
+def span_params(since, until):
+    """The range as query arguments for GET /transactions/<username>."""
+    return {name: bound.isoformat() for name, bound in (('from', since), ('to', until)) if bound}
+
+
+def describe_span(since, until, interval):
+    return {
+        'from': since.isoformat() + 'Z' if since else None,
+        'to': until.isoformat() + 'Z' if until else None,
+        'interval': interval
+    }
+
+
+# ─── TOTALS ──────────────────────────────────────────────────────────────────
+# Sums per bucket: agg name -> rollup field
+BUCKET_SUMS = {
+    'sent_count':     'sent.count',
+    'received_count': 'received.count',
+    'failed':         'failed',
+    'total_sent':     'sent.total',
+    'total_received': 'received.total'
+}
+# An hour left empty by rolled-back transfers is no activity
+_NOT_EMPTY = {'bool': {'should': [{'range': {'sent.count': {'gt': 0}}}, {'range': {'received.count': {'gt': 0}}},
+                                  {'range': {'failed': {'gt': 0}}}], 'minimum_should_match': 1}}
+_COMPLETED = {'bool': {'should': [{'range': {'sent.count': {'gt': 0}}}, {'range': {'received.count': {'gt': 0}}}],
+                       'minimum_should_match': 1}}
+
+
+def _sums(*names):
+    return {name: {'sum': {'field': BUCKET_SUMS[name]}} for name in names}
+
+
+def range_aggs(interval, top=5):
+    """Everything the ranged reports need from the user's hourly rollups."""
+    return {
+        'buckets': {'date_histogram': {'field': 'hour', 'calendar_interval': interval, 'min_doc_count': 1},
+                    'aggs': _sums(*BUCKET_SUMS)},
+        'largest': {'max': {'field': 'max_amount'}},
+        'completed': {
+            'filter': _COMPLETED,
+            'aggs': {
+                'days': {'date_histogram': {'field': 'hour', 'calendar_interval': 'day', 'min_doc_count': 1}},
+                'periods': {'terms': {'field': 'period', 'size': len(PERIODS)},
+                            'aggs': _sums('sent_count', 'received_count')}
+            }
+        },
+        'peers': {
+            'nested': {'path': 'peers'},
+            'aggs': {role: {'filter': {'term': {'peers.role': role}},
+                            'aggs': {'names': {'terms': {'field': 'peers.name', 'size': top,
+                                                         'order': {'count': 'desc'}},
+                                               'aggs': {'count': {'sum': {'field': 'peers.count'}}}}}}
+                     for role in ('sent', 'received')}
+        }
+    }
+
+
+def fetch_totals(es, username, since=None, until=None, interval='day', top=5):
+    """totals_from_aggs of the user's hourly rollups from `since` up to `until`."""
+    filters = [{'term': {'username': username}}, _NOT_EMPTY]
+    bounds = {}
+    if since:
+        bounds['gte'] = since.isoformat()
+    if until:
+        bounds['lt'] = until.isoformat()
+    if bounds:
+        filters.append({'range': {'hour': bounds}})
+    res = es.search(index=ROLLUP_INDEX, routing=username, query={'bool': {'filter': filters}},
+                    size=0, aggs=range_aggs(interval, top))
+    return totals_from_aggs(res['aggregations'], interval)
+
+
+def totals_from_aggs(aggs, interval):
+    """
+    {'buckets', 'largest', 'days', 'periods', 'recipients', 'senders'} from
+    the range_aggs response: buckets oldest first, each with the
+    BUCKET_SUMS; recipients and senders the top counterparties, most
+    transfers first.
+    """
+    def peers(role):
+        return {b['key']: int(b['count']['value']) for b in aggs['peers'][role]['names']['buckets']}
+    periods = {b['key']: int(b['sent_count']['value'] + b['received_count']['value'])
+               for b in aggs['completed']['periods']['buckets']}
+    return {
+        'buckets': {bucket(b['key_as_string'], interval): {
+            name: b[name]['value'] if name.startswith('total_') else int(b[name]['value']) for name in BUCKET_SUMS
+        } for b in aggs['buckets']['buckets']},
+        'largest': aggs['largest']['value'] or 0.0,
+        'days': [b['key_as_string'][:10] for b in aggs['completed']['days']['buckets']],
+        'periods': {name: periods.get(name, 0) for name in PERIODS},
+        'recipients': peers('sent'),
+        'senders': peers('received')
+    }
+
+
+def totals_from_rollups(rollups, interval, top=5):
+    """What fetch_totals returns for a list of hourly rollups, oldest first."""
+    buckets, days = {}, {}
+    largest = 0.0
+    periods = dict.fromkeys(PERIODS, 0)
+    peers = {'sent': {}, 'received': {}}
+    for rollup in rollups:
+        sent, received = rollup['sent'], rollup['received']
+        for peer in rollup['peers']:
+            peers[peer['role']][peer['name']] = peers[peer['role']].get(peer['name'], 0) + peer['count']
+        if not (sent['count'] or received['count'] or rollup['failed']):
+            continue
+        totals = buckets.setdefault(bucket(rollup['hour'], interval), dict.fromkeys(BUCKET_SUMS, 0))
+        totals['sent_count'] += sent['count']
+        totals['received_count'] += received['count']
+        totals['failed'] += rollup['failed']
+        totals['total_sent'] += sent['total']
+        totals['total_received'] += received['total']
+        largest = max(largest, rollup['max_amount'])
+        if sent['count'] or received['count']:
+            days[rollup['hour'][:10]] = True
+            periods[rollup['period']] += sent['count'] + received['count']
+
+    def top_peers(counts):
+        # Ties go to the smaller name, as in the terms aggregation
+        return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:top])
+    return {
+        'buckets': buckets,
+        'largest': largest,
+        'days': list(days),
+        'periods': periods,
+        'recipients': top_peers(peers['sent']),
+        'senders': top_peers(peers['received'])
+    }
+
+
+def rollups_from_history(transactions, username):
+    """
+    The user_rollups documents, oldest first, for the transactions of the
+    user's history (already limited to what they can see and to the range).
+    """
+    rollups = {}
+    # The history is newest first; tally in the order the transfers happened
+    for tx in reversed(transactions):
+        hour = (tx.get('timestamp') or '')[:13]
+        if len(hour) != 13 or hour[10] != 'T':
+            continue
+        rollup = rollups.setdefault(hour, {
+            'hour': f'{hour}:00:00Z', 'period': PERIODS[PERIOD_OF_HOUR[int(hour[11:13])]],
+            'sent': {'count': 0, 'total': 0.0}, 'received': {'count': 0, 'total': 0.0},
+            'failed': 0, 'max_amount': 0.0, 'peers': []
+        })
+        if tx.get('status') != 'completed':
+            rollup['failed'] += 1
+            continue
+        sent = tx.get('sender_username') == username
+        role = 'sent' if sent else 'received'
+        amount = float(tx.get('amount') or 0)
+        side = rollup[role]
+        side['count'] += 1
+        side['total'] += amount
+        rollup['max_amount'] = max(rollup['max_amount'], amount)
+        counterparty = tx.get('receiver_username') if sent else tx.get('sender_username')
+        peer = next((p for p in rollup['peers'] if p['name'] == counterparty and p['role'] == role), None)
+        if peer is None:
+            peer = {'name': counterparty, 'role': role, 'count': 0}
+            rollup['peers'].append(peer)
+        peer['count'] += 1
+    return [rollups[hour] for hour in sorted(rollups)]
+
+
+def bucket(hour, interval):
+    """The interval bucket of an hour ('2024-05-01T13:00:00Z' or '2024-05-01T13:00:00.000Z')."""
+    if interval == 'hour':
+        return hour[:16]
+    if interval == 'day':
+        return hour[:10]
+    if interval == 'month':
+        return hour[:7]
+    day = date.fromisoformat(hour[:10])
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+
+# ─── REPORTS ─────────────────────────────────────────────────────────────────
+def range_summary(totals, recent):
+    """The /report summary over the range, with the totals of each bucket in `activity`."""
+    buckets = totals['buckets'].values()
+    completed = sum(b['sent_count'] + b['received_count'] for b in buckets)
+    failed = sum(b['failed'] for b in buckets)
+    total_sent = sum(b['total_sent'] for b in buckets)
+    total_received = sum(b['total_received'] for b in buckets)
+    return {
+        'total_sent': total_sent,
+        'total_received': total_received,
+        'transaction_count': completed + failed,
+        'successful_transactions': completed,
+        'failed_transactions': failed,
+        'average_transaction_amount': (total_sent + total_received) / completed if completed else 0,
+        'largest_transaction': totals['largest'],
+        'recent_activity': recent,
+        # Newest first, like the history
+        'activity': {label: {'count': b['sent_count'] + b['received_count'], 'failed': b['failed'],
+                             'total_sent': b['total_sent'], 'total_received': b['total_received']}
+                     for label, b in reversed(totals['buckets'].items())}
+    }
+
+
+def range_usage(totals, until=None):
+    """The /report/<username>/usage analysis over the range, `daily_activity` per interval bucket."""
+    # Active days up to the end of the range, or today if that is sooner
+    now = datetime.utcnow() if until is None else min(until - timedelta(seconds=1), datetime.utcnow())
+    return {
+        'daily_activity': {label: {'count': b['sent_count'] + b['received_count'],
+                                   'total_amount': b['total_sent'] + b['total_received']}
+                           for label, b in reversed(totals['buckets'].items())
+                           if b['sent_count'] + b['received_count']},
+        'transaction_patterns': totals['periods'],
+        'common_recipients': totals['recipients'],
+        'common_senders': totals['senders'],
+        'transaction_frequency': transaction_frequency(totals['days'], now)
+    }
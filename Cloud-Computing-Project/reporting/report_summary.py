@@ -0,0 +1,222 @@
+import os
+import time
+import logging
+from usage_engine import transaction_frequency
+
+logger = logging.getLogger(__name__)
+
+# Owned by the transaction service (transaction_index.py, user_stats.py, user_rollups.py); only read here
+TRANSACTION_ALIAS = 'transactions'
+HISTORY_INDEX     = 'transaction-history'
+USER_STATS_INDEX  = 'user_stats'
+ROLLUP_INDEX      = 'user_rollups'
+KEYWORD_FIELDS    = ('sender_username', 'receiver_username', 'status')
+
+LAYOUT_CHECK_INTERVAL = float(os.getenv('TRANSACTION_LAYOUT_CHECK_INTERVAL', 30))
+RECENT_ACTIVITY_SIZE  = 5
+
+
+class TransactionLayout:
+    """
+    The part of the transaction service's IndexCatalog a read-only consumer
+    needs: whether the user_stats, user_rollups and routed history
+    projections are complete, and whether identifier fields need `.keyword` on a legacy
+    dynamic index. Refreshed every LAYOUT_CHECK_INTERVAL from one
+    get_mapping call.
+    """
+
+    def __init__(self, interval=LAYOUT_CHECK_INTERVAL):
+        self.interval = interval
+        self.legacy   = False
+        self.history  = False
+        self.stats    = False
+        self.rollups  = False
+        self._checked = 0.0
+
+    def load(self, es):
+        if time.monotonic() - self._checked >= self.interval:
+            try:
+                res = es.indices.get_mapping(index=[TRANSACTION_ALIAS, HISTORY_INDEX, USER_STATS_INDEX,
+                                                    ROLLUP_INDEX], ignore_unavailable=True)
+                stats   = res.pop(USER_STATS_INDEX, None)
+                rollups = res.pop(ROLLUP_INDEX, None)
+                history = res.pop(HISTORY_INDEX, None)
+                self.stats   = bool(stats and stats['mappings'].get('_meta', {}).get('rebuilt_at'))
+                self.rollups = bool(rollups and rollups['mappings'].get('_meta', {}).get('rebuilt_at'))
+                self.history = bool(history and history['mappings'].get('_meta', {}).get('backfilled_at'))
+                self.legacy  = any(str(m['mappings'].get('dynamic', 'true')).lower() != 'false'
+                                   for m in res.values())
+            except Exception as e:
+                logger.warning("Could not read transaction mapping: %s", e)
+            self._checked = time.monotonic()
+        return self
+
+    def fields(self):
+        suffix = '.keyword' if self.legacy else ''
+        return {name: name + suffix for name in KEYWORD_FIELDS}
+
+
+layout = TransactionLayout()
+
+
+def visible_target(es, username):
+    """
+    (fields, search target) of the transactions the user can see. Visibility
+    matches the transaction service's history: everything the user sent,
+    plus what they received unless it failed.
+    """
+    layout.load(es)
+    if layout.history:
+        # Visibility was applied when the owner's copy was written
+        fields = {name: name for name in KEYWORD_FIELDS}
+        target = {'index': HISTORY_INDEX, 'routing': username,
+                  'query': {'bool': {'filter': [{'term': {'owner': username}}]}}}
+    else:
+        fields = layout.fields()
+        target = {'index': TRANSACTION_ALIAS, 'query': {'bool': {
+            'should': [
+                {'term': {fields['sender_username']: username}},
+                {'bool': {
+                    'filter':   [{'term': {fields['receiver_username']: username}}],
+                    'must_not': [{'term': {fields['status']: 'failed'}}]
+                }}
+            ],
+            'minimum_should_match': 1
+        }}}
+    return fields, target
+
+
+def summary_search(es, username):
+    """
+    Arguments for the single search behind /report/<username>: the totals
+    come back as aggregations and the newest RECENT_ACTIVITY_SIZE
+    transactions as hits, so the cost does not grow with the history.
+    """
+    fields, target = visible_target(es, username)
+    return dict(
+        target,
+        size=RECENT_ACTIVITY_SIZE,
+        sort=[{'timestamp': {'order': 'desc'}}],
+        source=['trans_id', 'amount', 'sender_username', 'status', 'timestamp'],
+        track_total_hits=True,
+        aggs={
+            'completed': {
+                'filter': {'term': {fields['status']: 'completed'}},
+                'aggs': {
+                    'amount':   {'stats': {'field': 'amount'}},
+                    'sent':     {'filter': {'term': {fields['sender_username']: username}},
+                                 'aggs': {'amount': {'sum': {'field': 'amount'}}}},
+                    'received': {'filter': {'term': {fields['receiver_username']: username}},
+                                 'aggs': {'amount': {'sum': {'field': 'amount'}}}}
+                }
+            }
+        }
+    )
+
+
+def build_summary(res, username):
+    """Shape a summary_search response into the /report summary."""
+    total     = res['hits']['total']['value']
+    completed = res['aggregations']['completed']
+    amount    = completed['amount']
+    recent    = recent_activity(_hit_transactions(res), username)
+    return {
+        'total_sent': completed['sent']['amount']['value'],
+        'total_received': completed['received']['amount']['value'],
+        'transaction_count': total,
+        'successful_transactions': completed['doc_count'],
+        'failed_transactions': total - completed['doc_count'],
+        'average_transaction_amount': amount['avg'] or 0,
+        'largest_transaction': amount['max'] or 0,
+        'recent_activity': recent
+    }
+
+
+def fetch_summary(es, username):
+    return build_summary(es.search(**summary_search(es, username)), username)
+
+
+def fetch_recent(es, username, since=None, until=None):
+    """The summary's recent_activity, limited to transactions from `since` up to `until`."""
+    _, target = visible_target(es, username)
+    bounds = {}
+    if since:
+        bounds['gte'] = since.isoformat()
+    if until:
+        bounds['lt'] = until.isoformat()
+    filters = [target.pop('query')] + ([{'range': {'timestamp': bounds}}] if bounds else [])
+    res = es.search(**target, query={'bool': {'filter': filters}}, size=RECENT_ACTIVITY_SIZE, sort=[{'timestamp': {'order': 'desc'}}],
+                    source=['trans_id', 'amount', 'sender_username', 'status', 'timestamp'])
+    return recent_activity(_hit_transactions(res), username)
+
+
+def _hit_transactions(res):
+    # Projection copies carry the id; on the alias it is the _id
+    return [dict(hit['_source'], trans_id=hit['_source'].get('trans_id', hit['_id']))
+            for hit in res['hits']['hits']]
+
+
+def recent_activity(transactions, username):
+    """recent_activity entries for history records, in the order given."""
+    return [{
+        'transaction_id': tx.get('trans_id'),
+        'amount': float(tx.get('amount', 0)),
+        'type': 'sent' if tx.get('sender_username') == username else 'received',
+        'status': tx.get('status'),
+        'timestamp': tx.get('timestamp')
+    } for tx in transactions]
+
+
+# ─── USER STATS ──────────────────────────────────────────────────────────────
+def fetch_stats_versions(es, usernames):
+    """
+    {username: version} of the users' user_stats documents, or None while
+    the projection is being rebuilt. The version changes with every
+    transfer that touches the user; None for a user with no transactions
+    yet, who has no document.
+    """
+    if not layout.load(es).stats:
+        return None
+    return {username: version for username, (_, version) in mget_stats(es, usernames, source=False).items()}
+
+
+def mget_stats(es, usernames, source=True):
+    """{username: (document, version)} from one realtime mget; ({}, None) without a document."""
+    docs = es.mget(index=USER_STATS_INDEX, ids=list(usernames), source=source)['docs']
+    return {doc['_id']: (doc.get('_source', {}) if doc.get('found') else {},
+                         (doc['_primary_term'], doc['_seq_no']) if doc.get('found') else None)
+            for doc in docs}
+
+
+def summary_from_stats(stats):
+    sent      = stats.get('sent', {})
+    received  = stats.get('received', {})
+    completed = stats.get('completed', 0)
+    failed    = stats.get('failed', 0)
+    total     = sent.get('total', 0) + received.get('total', 0)
+    return {
+        'total_sent': sent.get('total', 0),
+        'total_received': received.get('total', 0),
+        'transaction_count': completed + failed,
+        'successful_transactions': completed,
+        'failed_transactions': failed,
+        'average_transaction_amount': total / completed if completed else 0,
+        'largest_transaction': stats.get('max_amount', 0),
+        'recent_activity': stats.get('recent', [])
+    }
+
+
+def usage_from_stats(stats, top=5):
+    daily = stats.get('daily', {})
+    return {
+        'daily_activity': daily,
+        'transaction_patterns': stats.get('time_of_day',
+                                          {'morning': 0, 'afternoon': 0, 'evening': 0, 'night': 0}),
+        'common_recipients': top_counts(stats.get('recipients', {}), top),
+        'common_senders': top_counts(stats.get('senders', {}), top),
+        'transaction_frequency': transaction_frequency(daily)
+    }
+
+
+def top_counts(counts, n):
+    return dict(sorted(counts.items(), key=lambda x: x[1], reverse=True)[:n])
@@ -1,12 +1,30 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import os
 from flask import Flask, request, jsonify
 import requests
-from datetime import datetime, timedelta
 from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity
 from elasticsearch import Elasticsearch, NotFoundError
 from flask_cors import CORS
+from common import log, metrics, tracing, compression
+from common.card_cache import CardCache
+from common.service_client import ServiceClient, CircuitOpenError
+from common.es_client import ProcessLocalClient
+from common.bootstrap import Bootstrap, register_health_routes
+from report_summary import (layout, fetch_summary, fetch_recent, recent_activity, fetch_stats_versions, mget_stats,
+                            summary_from_stats, usage_from_stats, RECENT_ACTIVITY_SIZE)
+from report_cache import ReportCache, versions_of, etag
+from report_range import (is_ranged, parse_span, span_params, describe_span, fetch_totals, rollups_from_history,
+                          totals_from_rollups, range_summary, range_usage)
+from usage_engine import usage_analysis, report_analysis
 
 app = Flask(__name__)
+log.configure('reporting')
+log.init_app(app)
+metrics.init_app(app)
+tracing.init_app(app, 'reporting')
+compression.init_app(app)
 # ─── CORS CONFIG ─────────────────────────────────────────────────────────────
 CORS(app, resources={
     r"/*": {
@@ -14,7 +32,7 @@ CORS(app, resources={
         "methods": ["GET", "POST", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization"],
         "supports_credentials": True,
-        "expose_headers": ["Content-Type", "Authorization"],
+        "expose_headers": ["Content-Type", "Authorization", "ETag"],
         "max_age": 3600
     }
 }, supports_credentials=True)
@@ -24,20 +42,43 @@ app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
 jwt = JWTManager(app)
 
 TRANSACTION_SERVICE_URL = os.getenv('TRANSACTION_SERVICE_URL')
+# Keep-alive pool, deadline and circuit breaker for the history fetches;
+# TRANSACTION_CLIENT_HEDGE_AFTER turns on hedging
+transaction_client = ServiceClient.from_env('transaction', TRANSACTION_SERVICE_URL, 'TRANSACTION_CLIENT')
 
 # Elasticsearch connection
 ES_HOST = os.getenv('ES_HOST')
 ES_PORT = os.getenv('ES_PORT')
 ES_USERNAME = os.getenv('ELASTIC_USERNAME')
 ES_PASSWORD = os.getenv('ELASTIC_PASSWORD')
-es = Elasticsearch(
+# One client per process, created on first use (safe to fork)
+es = ProcessLocalClient(lambda: Elasticsearch(
     [f'http://{ES_HOST}:{ES_PORT}'],
     basic_auth=(ES_USERNAME, ES_PASSWORD)
-)
+))
 
 # Index names
 CARD_INDEX = 'cards'
 
+# Usernames accepted by one GET /reports/full
+REPORT_MAX_USERNAMES = int(os.getenv('REPORT_MAX_USERNAMES', 20))
+
+# Nothing to create here; readiness still tracks ES availability
+bootstrap = Bootstrap(es, 'reporting', started_at=STARTED_AT)
+
+def fetch_card(username):
+    try:
+        return es.get(index=CARD_INDEX, id=username)['_source']
+    except NotFoundError:
+        return None
+
+def fetch_cards(usernames):
+    docs = es.mget(index=CARD_INDEX, ids=usernames)['docs']
+    return {doc['_id']: doc['_source'] if doc.get('found') else None for doc in docs}
+
+card_cache = CardCache.from_env(fetch_card, fetch_cards)
+report_cache = ReportCache.from_env()
+
 def get_auth_headers():
     """Helper function to get authorization headers"""
     token = request.headers.get('Authorization', '')
@@ -48,12 +89,136 @@ def verify_username_access(username):
     Verify that the username belongs to the authenticated user.
     Returns True if authorized, False otherwise.
     """
-    current_phone = get_jwt_identity()
+    return card_cache.is_owner(username, get_jwt_identity())
+
+def fetch_transactions(username, params=None):
+    """The user's history from the transaction service: (transactions, None) or (None, status)."""
     try:
-        res = es.get(index=CARD_INDEX, id=username)
-        return res['_source'].get('phone') == current_phone
-    except NotFoundError:
-        return False
+        with tracing.span('GET transaction /transactions/<username>', 'client'):
+            transactions_response = transaction_client.get(
+                f'/transactions/{username}',
+                headers=get_auth_headers(),
+                params=params
+            )
+    except CircuitOpenError:
+        return None, 503
+    except requests.Timeout:
+        return None, 504
+    except requests.RequestException:
+        return None, 502
+
+    if transactions_response.status_code != 200:
+        return None, transactions_response.status_code
+    return transactions_response.json().get('transactions', []), None
+
+def cached_reports(report, usernames, build, span=None, read=None):
+    """
+    ({username: build(stats)}, etag), reusing report_cache entries while the
+    user's user_stats document is unchanged. The values are None when the
+    request's If-None-Match already names this etag; both are None while
+    user_stats is being rebuilt.
+
+    A ranged report passes its `span`, part of the cache key and etag, and
+    `read(usernames)` returning {username: (build argument, version)} in
+    place of the user_stats documents.
+    """
+    read = read or (lambda names: mget_stats(es, names))
+    stats_versions = fetch_stats_versions(es, usernames)
+    if stats_versions is None:
+        report_cache.count(report, 'bypass', len(usernames))
+        return None, None
+    versions = versions_of(stats_versions)
+    tag = etag(report, versions, span)
+    if request.if_none_match.contains_weak(tag):
+        report_cache.count(report, 'not_modified', len(usernames))
+        return None, tag
+
+    values = {}
+    for username in usernames:
+        value = report_cache.get(report, username, versions[username], span)
+        if value is not None:
+            values[username] = value
+    missing = [username for username in usernames if username not in values]
+    if missing:
+        started = time.perf_counter()
+        docs = read(missing)
+        built = {username: build(stats) for username, (stats, _) in docs.items()}
+        cost = (time.perf_counter() - started) / len(missing)
+        for username, (_, version) in docs.items():
+            # A transfer may have landed since the versions were read
+            versions[username] = (version, versions[username][1])
+            report_cache.set(report, username, versions[username], built[username], cost, span)
+        values.update(built)
+        tag = etag(report, versions, span)
+    return values, tag
+
+def report_response(body, tag):
+    """The JSON response, or 304 when body is None; `tag` may be None (not cacheable)."""
+    response = jsonify(body) if body is not None else app.response_class(status=304)
+    if tag is not None:
+        response.set_etag(tag)
+        # The browser keeps the body and revalidates it on every request
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def full_from_stats(stats):
+    return {'summary': summary_from_stats(stats), 'usage_analysis': usage_from_stats(stats)}
+
+def reports_from_history(usernames):
+    """
+    Until user_stats is rebuilt: one history fetch per user, with summary
+    and usage computed from the same columns. (None, status) if a fetch fails.
+    """
+    reports = {}
+    for username in usernames:
+        transactions, status = fetch_transactions(username)
+        if transactions is None:
+            return None, status
+        summary, usage = report_analysis(transactions, username)
+        reports[username] = {'summary': summary, 'usage_analysis': usage}
+    return reports, None
+
+def ranged_report(username, report):
+    """
+    The summary or usage analysis over ?from=&to=&interval= (see
+    report_range.py): aggregated from the user's hourly rollups and cached
+    per user_stats version and span, or until rebuild_rollups.py has run,
+    totalled from their history over the range.
+    """
+    try:
+        since, until, interval = parse_span(request.args)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    def build(totals, recent):
+        if report == 'summary':
+            return range_summary(totals, recent)
+        return range_usage(totals, until)
+
+    def build_from_rollups(name):
+        totals = fetch_totals(es, name, since, until, interval)
+        return build(totals, fetch_recent(es, name, since, until) if report == 'summary' else [])
+
+    tag = None
+    if layout.load(es).rollups:
+        values, tag = cached_reports(f'range_{report}', [username], build_from_rollups,
+                                     span=(since, until, interval),
+                                     read=lambda names: {name: (name, version) for name, (_, version)
+                                                         in mget_stats(es, names, source=False).items()})
+        if tag is None:
+            values = {username: build_from_rollups(username)}
+    else:
+        transactions, status = fetch_transactions(username, span_params(since, until))
+        if transactions is None:
+            return jsonify({'message': 'Unable to fetch transactions'}), status
+        totals = totals_from_rollups(rollups_from_history(transactions, username), interval)
+        values = {username: build(totals, recent_activity(transactions[:RECENT_ACTIVITY_SIZE], username))}
+
+    return report_response(values and {
+        'username': username,
+        'range': describe_span(since, until, interval),
+        'summary' if report == 'summary' else 'usage_analysis': values[username]
+    }, tag)
 
 @app.route('/report/<string:username>', methods=['GET'])
 @jwt_required()
@@ -61,63 +226,18 @@ def get_report(username):
     """Get a comprehensive report for a user including balance and transaction summary"""
     if not verify_username_access(username):
         return jsonify({'message': 'Unauthorized access'}), 403
-        
-    headers = get_auth_headers()
-    
-    # Get user's transactions
-    transactions_response = requests.get(
-        f'{TRANSACTION_SERVICE_URL}/transactions/{username}',
-        headers=headers
-    )
-    
-    if transactions_response.status_code != 200:
-        return jsonify({'message': 'Unable to fetch transactions'}), transactions_response.status_code
-    
-    transactions = transactions_response.json().get('transactions', [])
-    
-    # Calculate transaction summary
-    summary = {
-        'total_sent': 0,
-        'total_received': 0,
-        'transaction_count': len(transactions),
-        'successful_transactions': 0,
-        'failed_transactions': 0,
-        'average_transaction_amount': 0,
-        'largest_transaction': 0,
-        'recent_activity': []
-    }
-    
-    total_amount = 0
-    for tx in transactions:
-        amount = float(tx.get('amount', 0))
-        if tx.get('status') == 'completed':
-            summary['successful_transactions'] += 1
-            if tx['sender_username'] == username:
-                summary['total_sent'] += amount
-            else:
-                summary['total_received'] += amount
-            total_amount += amount
-            summary['largest_transaction'] = max(summary['largest_transaction'], amount)
-        else:
-            summary['failed_transactions'] += 1
-            
-        # Add to recent activity (last 5 transactions)
-        if len(summary['recent_activity']) < 5:
-            summary['recent_activity'].append({
-                'transaction_id': tx.get('trans_id'),
-                'amount': amount,
-                'type': 'sent' if tx['sender_username'] == username else 'received',
-                'status': tx.get('status'),
-                'timestamp': tx.get('timestamp')
-            })
-    
-    if summary['successful_transactions'] > 0:
-        summary['average_transaction_amount'] = total_amount / summary['successful_transactions']
-    
-    return jsonify({
+    if is_ranged(request.args):
+        return ranged_report(username, 'summary')
+
+    # Built from the user_stats projection and cached per version of it;
+    # until it has been rebuilt, aggregated in Elasticsearch
+    summaries, tag = cached_reports('summary', [username], summary_from_stats)
+    if tag is None:
+        summaries = {username: fetch_summary(es, username)}
+    return report_response(summaries and {
         'username': username,
-        'summary': summary
-    }), 200
+        'summary': summaries[username]
+    }, tag)
 
 @app.route('/report/<string:username>/usage', methods=['GET'])
 @jwt_required()
@@ -125,93 +245,56 @@ def get_usage_analysis(username):
     """Get detailed account usage analysis"""
     if not verify_username_access(username):
         return jsonify({'message': 'Unauthorized access'}), 403
-        
-    headers = get_auth_headers()
-    
-    # Get user's transactions
-    transactions_response = requests.get(
-        f'{TRANSACTION_SERVICE_URL}/transactions/{username}',
-        headers=headers
-    )
-    
-    if transactions_response.status_code != 200:
-        return jsonify({'message': 'Unable to fetch transactions'}), transactions_response.status_code
-    
-    transactions = transactions_response.json().get('transactions', [])
-    
-    # Initialize usage analysis
-    usage = {
-        'daily_activity': {},
-        'transaction_patterns': {
-            'morning': 0,  # 6-12
-            'afternoon': 0,  # 12-18
-            'evening': 0,  # 18-24
-            'night': 0  # 0-6
-        },
-        'common_recipients': {},
-        'common_senders': {},
-        'transaction_frequency': {
-            'daily': 0,
-            'weekly': 0,
-            'monthly': 0
-        }
-    }
-    
-    # Analyze transactions
-    for tx in transactions:
-        if tx.get('status') != 'completed':
-            continue
-            
-        timestamp = datetime.fromisoformat(tx.get('timestamp').replace('Z', '+00:00'))
-        date_str = timestamp.strftime('%Y-%m-%d')
-        hour = timestamp.hour
-        
-        # Daily activity
-        if date_str not in usage['daily_activity']:
-            usage['daily_activity'][date_str] = {
-                'count': 0,
-                'total_amount': 0
-            }
-        usage['daily_activity'][date_str]['count'] += 1
-        usage['daily_activity'][date_str]['total_amount'] += float(tx.get('amount', 0))
-        
-        # Time of day analysis
-        if 6 <= hour < 12:
-            usage['transaction_patterns']['morning'] += 1
-        elif 12 <= hour < 18:
-            usage['transaction_patterns']['afternoon'] += 1
-        elif 18 <= hour < 24:
-            usage['transaction_patterns']['evening'] += 1
-        else:
-            usage['transaction_patterns']['night'] += 1
-            
-        # Common recipients/senders
-        if tx['sender_username'] == username:
-            recipient = tx['receiver_username']
-            usage['common_recipients'][recipient] = usage['common_recipients'].get(recipient, 0) + 1
-        else:
-            sender = tx['sender_username']
-            usage['common_senders'][sender] = usage['common_senders'].get(sender, 0) + 1
-    
-    # Calculate transaction frequency
-    if usage['daily_activity']:
-        days_with_transactions = len(usage['daily_activity'])
-        total_days = (datetime.now() - min(datetime.fromisoformat(d) for d in usage['daily_activity'].keys())).days + 1
-        
-        if total_days > 0:
-            usage['transaction_frequency']['daily'] = days_with_transactions / total_days
-            usage['transaction_frequency']['weekly'] = days_with_transactions / (total_days / 7)
-            usage['transaction_frequency']['monthly'] = days_with_transactions / (total_days / 30)
-    
-    # Sort and limit common recipients/senders to top 5
-    usage['common_recipients'] = dict(sorted(usage['common_recipients'].items(), key=lambda x: x[1], reverse=True)[:5])
-    usage['common_senders'] = dict(sorted(usage['common_senders'].items(), key=lambda x: x[1], reverse=True)[:5])
-    
-    return jsonify({
+    if is_ranged(request.args):
+        return ranged_report(username, 'usage')
+
+    usages, tag = cached_reports('usage', [username], usage_from_stats)
+    if tag is None:
+        # Until user_stats is rebuilt, go through the user's whole history
+        transactions, status = fetch_transactions(username)
+        if transactions is None:
+            return jsonify({'message': 'Unable to fetch transactions'}), status
+        usages = {username: usage_analysis(transactions, username)}
+    return report_response(usages and {
         'username': username,
-        'usage_analysis': usage
-    }), 200
+        'usage_analysis': usages[username]
+    }, tag)
+
+@app.route('/report/<string:username>/full', methods=['GET'])
+@jwt_required()
+def get_full_report(username):
+    """Summary and usage analysis together, from one read of the user's data"""
+    if not verify_username_access(username):
+        return jsonify({'message': 'Unauthorized access'}), 403
+
+    reports, tag = cached_reports('full', [username], full_from_stats)
+    if tag is None:
+        reports, status = reports_from_history([username])
+        if reports is None:
+            return jsonify({'message': 'Unable to fetch transactions'}), status
+    return report_response(reports and dict(reports[username], username=username), tag)
+
+@app.route('/reports/full', methods=['GET'])
+@jwt_required()
+def get_full_reports():
+    """/report/<username>/full for several cards: ?username=a&username=b"""
+    usernames = list(dict.fromkeys(request.args.getlist('username')))
+    if not usernames:
+        return jsonify({'message': 'At least one username is required'}), 400
+    if len(usernames) > REPORT_MAX_USERNAMES:
+        return jsonify({'message': f'At most {REPORT_MAX_USERNAMES} usernames per request'}), 400
+    if not card_cache.owns_all(usernames, get_jwt_identity()):
+        return jsonify({'message': 'Unauthorized access'}), 403
+
+    reports, tag = cached_reports('full', usernames, full_from_stats)
+    if tag is None:
+        reports, status = reports_from_history(usernames)
+        if reports is None:
+            return jsonify({'message': 'Unable to fetch transactions'}), status
+    return report_response(reports and {'reports': reports}, tag)
+
+register_health_routes(app, bootstrap)
 
 if __name__ == '__main__':
     PORT = int(os.getenv('REPORT_PORT'))
-    app.run(host='0.0.0.0', port=PORT, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=PORT)
\ No newline at end of file
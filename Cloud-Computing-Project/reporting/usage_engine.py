@@ -0,0 +1,141 @@
+"""
+/report/<username>/usage (and the summary of /report/<username>/full)
+computed over columns instead of per transaction.
+
+The completed transactions are loaded once into parallel NumPy arrays
+(UTC epoch seconds, amounts, direction, interned counterparty ids) and
+every part of the analysis is a vectorized pass over them:
+
+- daily activity: bincount over the day number, with the amounts as weights;
+- time of day: a 24-entry hour -> period table, then bincount;
+- counterparties: bincount over the interned ids of each direction, and
+  a stable argsort for the top five.
+
+The result is the same as the former Python loop, down to float rounding:
+bincount adds weights in input order, which is the order the loop summed
+them in. Counterparties are interned per direction in first-seen order,
+so equal counts keep the loop's order too.
+"""
+from datetime import datetime
+import numpy as np
+
+PERIODS = ('morning', 'afternoon', 'evening', 'night')
+# 0-6 night, 6-12 morning, 12-18 afternoon, 18-24 evening
+PERIOD_OF_HOUR = np.array([3] * 6 + [0] * 6 + [1] * 6 + [2] * 6)
+SECONDS_PER_DAY = 86400
+
+
+class TransactionColumns:
+    """A user's completed transactions as parallel arrays, in history order."""
+
+    __slots__ = ('seconds', 'amount', 'sent', 'counterparty', 'recipients', 'senders')
+
+    def __init__(self, seconds, amount, sent, counterparty, recipients, senders):
+        self.seconds      = seconds
+        self.amount       = amount
+        self.sent         = sent
+        self.counterparty = counterparty
+        self.recipients   = recipients
+        self.senders      = senders
+
+    @classmethod
+    def from_transactions(cls, transactions, username):
+        completed = [tx for tx in transactions if tx.get('status') == 'completed']
+        # Wall-clock time as written: the date and hour the loop read from
+        # fromisoformat, without building a datetime per transaction
+        seconds = np.array([tx['timestamp'][:19] for tx in completed], dtype='datetime64[s]').astype(np.int64)
+        amount = np.array([tx.get('amount', 0) for tx in completed], dtype=np.float64)
+        sent = [tx['sender_username'] == username for tx in completed]
+        # Ids count up from 0 per direction in first-seen order, so they double as tie-breakers
+        recipients, senders = {}, {}
+        counterparty = np.array([
+            recipients.setdefault(tx['receiver_username'], len(recipients)) if is_sent
+            else senders.setdefault(tx['sender_username'], len(senders))
+            for tx, is_sent in zip(completed, sent)
+        ], dtype=np.int64)
+        return cls(seconds, amount, np.array(sent, dtype=bool), counterparty, list(recipients), list(senders))
+
+    def __len__(self):
+        return len(self.amount)
+
+    def daily_activity(self):
+        """Per day, newest first like the history."""
+        if not len(self):
+            return {}
+        days = self.seconds // SECONDS_PER_DAY
+        first = days.min()
+        days -= first
+        counts = np.bincount(days)
+        totals = np.bincount(days, weights=self.amount)
+        active = np.flatnonzero(counts)[::-1]
+        labels = np.datetime_as_string((active + first).astype('datetime64[D]'))
+        return {
+            label: {'count': count, 'total_amount': total}
+            for label, count, total in zip(labels.tolist(), counts[active].tolist(), totals[active].tolist())
+        }
+
+    def transaction_patterns(self):
+        hours = (self.seconds % SECONDS_PER_DAY) // 3600
+        counts = np.bincount(PERIOD_OF_HOUR[hours], minlength=len(PERIODS))
+        return {name: int(count) for name, count in zip(PERIODS, counts)}
+
+    def top_counterparties(self, sent, k=5):
+        names = self.recipients if sent else self.senders
+        counts = np.bincount(self.counterparty[self.sent if sent else ~self.sent], minlength=len(names))
+        # Most frequent first; equal counts keep first-seen order
+        order = np.argsort(-counts, kind='stable')[:k]
+        return {names[i]: int(counts[i]) for i in order}
+
+    def usage(self):
+        daily = self.daily_activity()
+        return {
+            'daily_activity': daily,
+            'transaction_patterns': self.transaction_patterns(),
+            'common_recipients': self.top_counterparties(sent=True),
+            'common_senders': self.top_counterparties(sent=False),
+            'transaction_frequency': transaction_frequency(daily)
+        }
+
+    def summary(self, transactions, username, recent=5):
+        """The /report summary; `transactions` is the full list the columns were built from."""
+        completed = len(self)
+        total_sent = float(self.amount[self.sent].sum())
+        total_received = float(self.amount[~self.sent].sum())
+        return {
+            'total_sent': total_sent,
+            'total_received': total_received,
+            'transaction_count': len(transactions),
+            'successful_transactions': completed,
+            'failed_transactions': len(transactions) - completed,
+            'average_transaction_amount': (total_sent + total_received) / completed if completed else 0,
+            'largest_transaction': float(self.amount.max()) if completed else 0,
+            'recent_activity': [{
+                'transaction_id': tx.get('trans_id'),
+                'amount': float(tx.get('amount', 0)),
+                'type': 'sent' if tx['sender_username'] == username else 'received',
+                'status': tx.get('status'),
+                'timestamp': tx.get('timestamp')
+            } for tx in transactions[:recent]]
+        }
+
+
+def transaction_frequency(days, now=None):
+    frequency = {'daily': 0, 'weekly': 0, 'monthly': 0}
+    if days:
+        total_days = ((now or datetime.now()) - min(datetime.fromisoformat(d) for d in days)).days + 1
+        if total_days > 0:
+            frequency['daily']   = len(days) / total_days
+            frequency['weekly']  = len(days) / (total_days / 7)
+            frequency['monthly'] = len(days) / (total_days / 30)
+    return frequency
+
+
+def usage_analysis(transactions, username):
+    """The usage_analysis of /report/<username>/usage for a list of transactions."""
+    return TransactionColumns.from_transactions(transactions, username).usage()
+
+
+def report_analysis(transactions, username):
+    """(summary, usage_analysis) of the same transactions, from one set of columns."""
+    columns = TransactionColumns.from_transactions(transactions, username)
+    return columns.summary(transactions, username), columns.usage()
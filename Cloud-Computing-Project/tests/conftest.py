@@ -0,0 +1,78 @@
+"""
+Shared fixtures: the transaction and reporting modules on sys.path, and
+the benchmarks' in-memory Elasticsearch with the Python equivalents of the
+Painless scripts registered (see benchmarks/fake_es.py).
+
+    python -m pytest -q
+"""
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'transaction'))
+sys.path.append(os.path.join(ROOT, 'reporting'))
+
+from benchmarks.fake_es import FakeElasticsearch
+from benchmarks.microbench import register_scripts
+
+register_scripts()
+
+CARD_INDEX = 'cards'
+TIMESTAMP  = '2024-05-01T13:30:00Z'
+
+
+@pytest.fixture
+def es():
+    from transaction_index import catalog, ensure_transaction_index, ensure_history_index
+    from user_stats import ensure_user_stats_index
+    from user_rollups import ensure_rollup_index
+    es = FakeElasticsearch()
+    for ensure in (ensure_transaction_index, ensure_history_index, ensure_user_stats_index, ensure_rollup_index):
+        ensure(es)
+    # The catalog is per process; it must not answer from another test's cluster
+    catalog.invalidate()
+    return es
+
+
+@pytest.fixture
+def cards(es):
+    """alice with 100.0 and bob with 0.0; returns a function reading a card."""
+    for username, phone, balance in (('alice', '111', 100.0), ('bob', '222', 0.0)):
+        es.index(index=CARD_INDEX, id=username, document={'username': username, 'phone': phone,
+                                                           'pin': '1234', 'balance': balance})
+    return lambda username: es.get(index=CARD_INDEX, id=username)
+
+
+@pytest.fixture
+def tx_index():
+    from transaction_index import partition_name
+    return partition_name(TIMESTAMP)
+
+
+@pytest.fixture
+def audit():
+    """audit(sender, receiver, amount): an audit record as the transaction service writes it."""
+    def audit(sender, receiver, amount, status='completed', timestamp=TIMESTAMP):
+        return {
+            'sender_username':   sender,
+            'receiver_username': receiver,
+            'timestamp':         timestamp,
+            'status':            status,
+            'amount':            amount
+        }
+    return audit
+
+
+@pytest.fixture
+def transfer(es, cards, tx_index, audit):
+    """transfer(tx_id, receiver, amount): execute_transfer from alice, at her current card version."""
+    from transfer_engine import execute_transfer
+
+    def transfer(tx_id, receiver, amount, version=None):
+        card = cards('alice')
+        seq_no, primary_term = version or (card['_seq_no'], card['_primary_term'])
+        execute_transfer(es, CARD_INDEX, tx_index, tx_id, 'alice', receiver, amount,
+                         audit('alice', receiver, amount), seq_no, primary_term)
+    return transfer
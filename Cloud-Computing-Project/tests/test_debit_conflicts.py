@@ -0,0 +1,68 @@
+"""
+The sender debit under concurrent updates to the same card: a version
+conflict re-reads the card and retries with backoff (see
+transfer_engine.debit).
+"""
+import pytest
+import transfer_engine
+from transfer_engine import InsufficientBalance, TransferConflict
+from reconcile_transfers import CARD_INDEX
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(transfer_engine, '_backoff_delay', lambda attempt: 0)
+
+
+def spend(es, username, amount, update=None):
+    """Another worker's update to the card, bumping its version."""
+    (update or es.update)(index=CARD_INDEX, id=username, script={
+        'source': transfer_engine.DEBIT_SCRIPT, 'lang': 'painless', 'params': {'amt': amount}})
+
+
+def test_conflict_is_retried_at_the_new_version(es, cards, tx_index, transfer):
+    stale = cards('alice')
+    spend(es, 'alice', 50.0)
+    before = transfer_engine.stats.snapshot()
+
+    transfer('tx1', 'bob', 30.0, version=(stale['_seq_no'], stale['_primary_term']))
+
+    after = transfer_engine.stats.snapshot()
+    assert (after['conflicts'] - before['conflicts'], after['retries'] - before['retries']) == (1, 1)
+    assert cards('alice')['_source']['balance'] == 20.0
+    assert cards('bob')['_source']['balance'] == 30.0
+    assert es.get(index=tx_index, id='tx1')['_source']['status'] == 'completed'
+
+
+def test_balance_is_checked_again_after_a_conflict(es, cards, tx_index, transfer):
+    stale = cards('alice')
+    spend(es, 'alice', 80.0)
+
+    with pytest.raises(InsufficientBalance):
+        transfer('tx1', 'bob', 30.0, version=(stale['_seq_no'], stale['_primary_term']))
+
+    assert cards('alice')['_source']['balance'] == 20.0
+    assert cards('bob')['_source']['balance'] == 0.0
+    assert not es.exists(index=tx_index, id='tx1')
+
+
+def test_gives_up_when_the_card_keeps_changing(es, cards, tx_index, transfer, monkeypatch):
+    update = es.update
+
+    def contended(**kwargs):
+        spend(es, 'alice', 1.0, update)
+        return update(**kwargs)
+    monkeypatch.setattr(es, 'update', contended)
+    before = transfer_engine.stats.snapshot()
+
+    with pytest.raises(TransferConflict):
+        transfer('tx1', 'bob', 30.0)
+    monkeypatch.undo()
+
+    after = transfer_engine.stats.snapshot()
+    assert after['conflicts'] - before['conflicts'] == transfer_engine.MAX_RETRIES + 1
+    assert after['exhausted'] - before['exhausted'] == 1
+    # Only the other worker's updates landed
+    assert cards('alice')['_source']['balance'] == 100.0 - (transfer_engine.MAX_RETRIES + 1)
+    assert cards('bob')['_source']['balance'] == 0.0
+    assert not es.exists(index=tx_index, id='tx1')
@@ -0,0 +1,73 @@
+"""
+History cursors: the opaque token GET /transactions/<username> hands back
+for the next page (see history.encode_cursor).
+"""
+import base64
+import json
+from datetime import datetime
+import pytest
+from history import encode_cursor, decode_cursor, fetch_page, parse_range, InvalidCursor
+
+
+def _token(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor('pit-1', [1714570200000, 'tx9'])
+
+    assert decode_cursor(cursor) == ('pit-1', [1714570200000, 'tx9'], None, None, False)
+
+
+def test_cursor_keeps_the_range_and_routing():
+    since, until = datetime(2024, 5, 1), datetime(2024, 6, 1, 12, 30)
+    cursor = encode_cursor('pit-1', [1714570200000, 'tx9'], since, until, routed=True)
+
+    assert decode_cursor(cursor) == ('pit-1', [1714570200000, 'tx9'], since, until, True)
+
+
+@pytest.mark.parametrize('cursor', [
+    'not a cursor!',
+    base64.urlsafe_b64encode(b'{not json').decode(),
+    _token({'after': [1, 'tx1']}),
+    _token({'pit': 'pit-1', 'after': [1, 'tx1'], 'since': 'yesterday'}),
+])
+def test_invalid_cursor(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+
+def test_pages_follow_the_cursor(es, transfer):
+    for n in range(5):
+        transfer(f'tx{n}', 'bob', 1.0)
+    es.indices.refresh(index='_all')
+
+    seen, cursor = [], None
+    while True:
+        txs, cursor = fetch_page(es, 'alice', 2, cursor)
+        seen += [tx['trans_id'] for tx in txs]
+        if cursor is None:
+            break
+        assert len(txs) == 2
+
+    assert sorted(seen) == [f'tx{n}' for n in range(5)]
+
+
+def test_range_offsets_are_converted_to_utc():
+    since, until = parse_range('2024-05-01T00:00:00+02:00', '2024-05-01T12:00:00Z')
+
+    assert (since, until) == (datetime(2024, 4, 30, 22), datetime(2024, 5, 1, 12))
+    assert decode_cursor(encode_cursor('pit-1', [1, 'tx1'], since, until))[2:4] == (since, until)
+
+
+@pytest.mark.parametrize('since, found', [
+    ('2024-05-01T15:00:00+02:00', True),     # 13:00 UTC, before the 13:30 UTC transfer
+    ('2024-05-01T14:00:00-01:00', False),    # 15:00 UTC
+])
+def test_range_with_an_offset_selects_by_utc(es, transfer, since, found):
+    transfer('tx1', 'bob', 1.0)
+    es.indices.refresh(index='_all')
+
+    txs, _ = fetch_page(es, 'alice', 10, since=parse_range(since, None)[0])
+
+    assert [tx['trans_id'] for tx in txs] == (['tx1'] if found else [])
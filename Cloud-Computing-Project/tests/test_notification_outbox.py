@@ -0,0 +1,154 @@
+"""
+Notification events are stored in the notification_outbox index with the
+transfers they announce, deleted once delivered, swept back into the queue
+when the process that queued them lost them, and dropped by the reconciler
+when their transfer is refunded (see transaction/notification_outbox.py).
+"""
+import time
+import pytest
+import transfer_engine
+import reconcile_transfers
+from reconcile_transfers import CARD_INDEX
+from transfer_engine import execute_transfer, TransferPending
+from notification_outbox import (
+    NotificationOutbox, OUTBOX_INDEX, ensure_outbox_index, outbox_actions, outbox_document
+)
+
+
+class Response:
+    status_code = 200
+
+    @staticmethod
+    def json():
+        return {}
+
+
+def notification_service(outbox, monkeypatch):
+    """Answer every batch the outbox posts with a 200; returns the events it was sent."""
+    events = []
+
+    def post(path, json=None, headers=None):
+        events.extend(json['events'])
+        return Response()
+    monkeypatch.setattr(outbox.client, 'post', post)
+    return events
+
+
+# Long enough ago for any sweep
+STORED_AT = '2024-05-01T13:30:00Z'
+
+
+def event(tx_id, status='completed'):
+    return {'trans_id': tx_id, 'sender_doc': {'username': 'alice'}, 'receiver_doc': {'username': 'bob'},
+            'amount': 30.0, 'status': status, 'reason': None}
+
+
+def stored(es, tx_id):
+    return es.exists(index=OUTBOX_INDEX, id=tx_id)
+
+
+@pytest.fixture
+def outbox_es(es, cards):
+    ensure_outbox_index(es)
+    return es
+
+
+@pytest.fixture
+def pay(outbox_es, cards, tx_index, audit):
+    """pay(tx_id): 30.0 from alice to bob, with its event in the transfer's bulk request."""
+    def pay(tx_id):
+        card = cards('alice')
+        execute_transfer(outbox_es, CARD_INDEX, tx_index, tx_id, 'alice', 'bob', 30.0,
+                         audit('alice', 'bob', 30.0), card['_seq_no'], card['_primary_term'],
+                         extra_actions=outbox_actions(event(tx_id)))
+    return pay
+
+
+def test_event_is_stored_by_the_transfer_bulk(outbox_es, pay):
+    pay('tx1')
+
+    doc = outbox_es.get(index=OUTBOX_INDEX, id='tx1')['_source']
+    assert (doc['sender'], doc['transfers'], doc['event']['status']) == ('alice', ['tx1'], 'completed')
+
+
+def test_delivered_event_is_deleted(outbox_es, pay, monkeypatch):
+    pay('tx1')
+    outbox = NotificationOutbox('http://notification.invalid', {}, es=outbox_es, workers=1)
+    delivered = notification_service(outbox, monkeypatch)
+
+    outbox.enqueue(event('tx1'))
+    outbox.close(timeout=5)
+
+    assert [e['trans_id'] for e in delivered] == ['tx1']
+    assert not stored(outbox_es, 'tx1')
+
+
+def test_sweep_queues_old_events_once_their_transfers_are_settled(outbox_es):
+    for tx_id in ('tx1', 'tx2', 'tx3'):
+        outbox_es.index(index=OUTBOX_INDEX, id=tx_id, document=dict(outbox_document(event(tx_id)),
+                                                                   created_at=STORED_AT))
+    # Just queued by a request: not the sweeper's to take yet
+    outbox_es.index(index=OUTBOX_INDEX, id='tx4', document=outbox_document(event('tx4')))
+    # Left for reconcile_transfers.py to settle first
+    outbox_es.update(index=CARD_INDEX, id='alice', doc={'pending': [{'tx': 'tx2', 'receiver': 'bob',
+                                                                     'amount': 30.0, 'at': STORED_AT}]})
+    outbox, other = (NotificationOutbox('http://notification.invalid', {}, es=outbox_es, workers=0, sweep_age=60)
+                     for _ in range(2))
+
+    assert outbox.sweep() == 2
+    assert sorted(outbox._queue.get_nowait()['event']['trans_id'] for _ in range(2)) == ['tx1', 'tx3']
+    # Claimed: no sweeper queues them again until sweep_age has passed
+    assert outbox.sweep() == 0
+    assert other.sweep() == 0
+
+
+def test_sweep_tolerates_a_missing_index(es):
+    assert NotificationOutbox('http://notification.invalid', {}, es=es, workers=0).sweep() == 0
+
+
+def test_rolled_back_transfer_replaces_its_event(outbox_es, pay):
+    pay('tx1')
+    outbox = NotificationOutbox('http://notification.invalid', {}, es=outbox_es, workers=0)
+
+    outbox.record(event('tx1', 'failed'))
+
+    assert outbox_es.get(index=OUTBOX_INDEX, id='tx1')['_source']['event']['status'] == 'failed'
+    assert outbox._queue.get_nowait()['event']['status'] == 'failed'
+
+
+def test_reconciler_deletes_the_event_of_a_refunded_transfer(outbox_es, cards, pay, monkeypatch):
+    # The transfer is dated 2024; keep its credit trace decidable
+    monkeypatch.setattr(transfer_engine, 'CREDIT_TRACE_TTL', 20 * 365 * 86400)
+    bulk = outbox_es.bulk
+
+    def only_the_event(operations, **kwargs):
+        # The bulk request stores the event, applies nothing else, and raises
+        bulk(operations=outbox_actions(event('tx1')), **kwargs)
+        monkeypatch.setattr(outbox_es, 'bulk', bulk)
+        raise ConnectionError('connection reset by peer')
+    monkeypatch.setattr(outbox_es, 'bulk', only_the_event)
+
+    with pytest.raises(TransferPending):
+        pay('tx1')
+    assert stored(outbox_es, 'tx1')
+
+    assert reconcile_transfers.reconcile(outbox_es, grace=0) == 1
+    assert cards('alice')['_source']['balance'] == 100.0
+    assert not stored(outbox_es, 'tx1')
+
+
+def test_events_of_failed_deliveries_stay_stored(outbox_es, pay, monkeypatch):
+    pay('tx1')
+    outbox = NotificationOutbox('http://notification.invalid', {}, es=outbox_es, workers=1, max_retries=0)
+
+    def post(*args, **kwargs):
+        raise ConnectionError('connection refused')
+    monkeypatch.setattr(outbox.client, 'post', post)
+
+    outbox.enqueue(event('tx1'))
+    deadline = time.time() + 5
+    while outbox.stats()['dead_lettered'] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    outbox.close(timeout=0)
+
+    assert stored(outbox_es, 'tx1')
@@ -0,0 +1,107 @@
+"""
+The Painless scripts that maintain user_stats and user_rollups against
+their Python twins (user_stats.record, user_rollups.record), which the
+rebuild scripts and the fake ES rely on. The same bulk actions are sent
+to a real cluster and to the fake, and every document must match to the
+cent.
+
+Painless only runs in Elasticsearch, so this needs a disposable cluster:
+
+    TEST_ES_URL=http://localhost:9200 [TEST_ES_USERNAME=... TEST_ES_PASSWORD=...] python -m pytest -q
+
+It writes to fresh test-* indices and deletes them afterwards.
+"""
+import os
+import uuid
+import pytest
+from benchmarks.fake_es import FakeElasticsearch
+from user_stats import USER_STATS_INDEX, USER_STATS_MAPPINGS, stats_entries, stats_actions
+from user_rollups import ROLLUP_INDEX, ROLLUP_MAPPINGS, rollup_actions
+from rebuild_user_stats import differences
+
+TEST_ES_URL = os.getenv('TEST_ES_URL')
+
+pytestmark = pytest.mark.skipif(not TEST_ES_URL, reason='TEST_ES_URL is not set; Painless needs a real cluster')
+
+# (tx_id, sender, receiver, amount, status, timestamp)
+TRANSFERS = [
+    ('tx1', 'alice', 'bob',   12.5,  'completed', '2024-05-01T08:15:00Z'),
+    ('tx2', 'alice', 'carol', 40.0,  'completed', '2024-05-01T08:45:00Z'),
+    ('tx3', 'bob',   'alice', 7.25,  'completed', '2024-05-01T19:05:00Z'),
+    ('tx4', 'alice', 'bob',   99.99, 'failed',    '2024-05-02T02:30:00Z'),
+    ('tx5', 'carol', 'alice', 0.01,  'completed', '2024-05-06T13:00:00Z'),
+    ('tx6', 'alice', 'bob',   3.0,   'completed', '2024-05-06T13:59:59Z'),
+]
+
+
+@pytest.fixture
+def clusters():
+    from elasticsearch import Elasticsearch
+    auth = (os.getenv('TEST_ES_USERNAME'), os.getenv('TEST_ES_PASSWORD')) if os.getenv('TEST_ES_USERNAME') else None
+    real = Elasticsearch([TEST_ES_URL], basic_auth=auth)
+    suffix = uuid.uuid4().hex[:8]
+    names = {USER_STATS_INDEX: f'test-user-stats-{suffix}', ROLLUP_INDEX: f'test-user-rollups-{suffix}'}
+    real.indices.create(index=names[USER_STATS_INDEX], mappings=USER_STATS_MAPPINGS)
+    real.indices.create(index=names[ROLLUP_INDEX], mappings=ROLLUP_MAPPINGS)
+    try:
+        yield real, FakeElasticsearch(), names
+    finally:
+        real.indices.delete(index=list(names.values()), ignore_unavailable=True)
+
+
+def audit(sender, receiver, amount, status, timestamp):
+    return {'sender_username': sender, 'receiver_username': receiver,
+            'amount': amount, 'status': status, 'timestamp': timestamp}
+
+
+def retarget(actions, names):
+    """The bulk actions with the projection indices renamed."""
+    renamed = []
+    for action in actions:
+        (op, meta), = action.items() if len(action) == 1 else [(None, None)]
+        if isinstance(meta, dict) and '_index' in meta:
+            action = {op: dict(meta, _index=names.get(meta['_index'], meta['_index']))}
+        renamed.append(action)
+    return renamed
+
+
+def apply(clusters, add, remove=()):
+    real, fake, names = clusters
+    actions = retarget(rollup_actions(add, remove) + stats_actions(add, remove), names)
+    for es in (real, fake):
+        res = es.bulk(operations=actions, refresh=True)
+        assert not res['errors'], res['items']
+
+
+def documents(es, index):
+    hits = es.search(index=index, query={'match_all': {}}, size=1000)['hits']['hits']
+    return {hit['_id']: hit['_source'] for hit in hits}
+
+
+def assert_same_documents(clusters):
+    real, fake, names = clusters
+    for index in names.values():
+        painless, python = documents(real, index), documents(fake, index)
+        assert sorted(painless) == sorted(python), index
+        for doc_id in python:
+            assert differences(painless[doc_id], python[doc_id]) == [], (index, doc_id)
+            assert differences(python[doc_id], painless[doc_id]) == [], (index, doc_id)
+
+
+def test_transfers_and_rollbacks_match(clusters):
+    entries = {tx_id: stats_entries(tx_id, audit(*rest)) for tx_id, *rest in TRANSFERS}
+    # One bulk per transfer, as the transaction service sends them
+    for tx_id, *_ in TRANSFERS:
+        apply(clusters, entries[tx_id])
+    assert_same_documents(clusters)
+
+    # A transfer rolled back after its bulk: moved from completed to failed
+    tx_id, sender, receiver, amount, _, timestamp = TRANSFERS[1]
+    apply(clusters, stats_entries(tx_id, audit(sender, receiver, amount, 'failed', timestamp)), entries[tx_id])
+    assert_same_documents(clusters)
+
+    # Several transfers in one bulk, as a batch payout sends them
+    batch = [entry for tx_id in ('tx7', 'tx8') for entry in
+             stats_entries(tx_id, audit('alice', 'carol', 5.0, 'completed', '2024-05-06T13:30:00Z'))]
+    apply(clusters, batch)
+    assert_same_documents(clusters)
@@ -0,0 +1,31 @@
+"""
+Ranged report arguments (see reporting/report_range.py): bounds are UTC
+and widened to whole hours, so the cache key and ETag of a range do not
+depend on the offset it was written in.
+"""
+from datetime import datetime
+import pytest
+from report_range import parse_span
+
+
+def test_span_is_widened_to_whole_utc_hours():
+    since, until, interval = parse_span({'from': '2024-05-01T00:30:00+02:00', 'to': '2024-05-01T10:15:00-05:00'})
+
+    assert (since, until, interval) == (datetime(2024, 4, 30, 22), datetime(2024, 5, 1, 16), 'day')
+
+
+def test_same_range_in_any_offset():
+    utc = parse_span({'from': '2024-05-01T22:00:00Z', 'to': '2024-05-02', 'interval': 'hour'})
+
+    assert parse_span({'from': '2024-05-02T00:00:00+02:00', 'to': '2024-05-01T20:00:00-04:00',
+                       'interval': 'hour'}) == utc
+
+
+@pytest.mark.parametrize('args', [
+    {'from': 'yesterday'},
+    {'from': '2024-05-02', 'to': '2024-05-02T01:30:00+02:00'},
+    {'interval': 'fortnight'},
+])
+def test_invalid_span(args):
+    with pytest.raises(ValueError):
+        parse_span(args)
@@ -0,0 +1,44 @@
+"""
+W3C trace context: parsing and forwarding `traceparent` (see
+common/tracing.py).
+"""
+import pytest
+from common import tracing
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+SPAN_ID  = '00f067aa0ba902b7'
+
+
+def test_traceparent_round_trip():
+    value = f'00-{TRACE_ID}-{SPAN_ID}-01'
+    context = tracing.parse_traceparent(value)
+
+    assert (context.trace_id, context.span_id, context.sampled) == (TRACE_ID, SPAN_ID, True)
+    assert tracing.format_traceparent(context) == value
+
+
+@pytest.mark.parametrize('value', [
+    None,
+    '',
+    'garbage',
+    f'ff-{TRACE_ID}-{SPAN_ID}-01',
+    f'00-{"0" * 32}-{SPAN_ID}-01',
+    f'00-{TRACE_ID}-{"0" * 16}-01',
+    f'00-{TRACE_ID}-{SPAN_ID}-01-extra',
+    f'00-{TRACE_ID.upper()}-{SPAN_ID}-01',
+])
+def test_invalid_traceparent(value):
+    assert tracing.parse_traceparent(value) is None
+
+
+def test_child_span_continues_the_trace():
+    parent = tracing.parse_traceparent(f'00-{TRACE_ID}-{SPAN_ID}-00')
+
+    with tracing.span('outer', parent=parent) as outer:
+        with tracing.span('inner') as inner:
+            headers = tracing.inject({'Accept': 'application/json'})
+
+    assert (outer.trace_id, outer.parent_id, outer.sampled) == (TRACE_ID, SPAN_ID, False)
+    assert (inner.trace_id, inner.parent_id) == (TRACE_ID, outer.span_id)
+    assert headers == {'Accept': 'application/json', 'traceparent': f'00-{TRACE_ID}-{inner.span_id}-00'}
+    assert tracing.inject() == {}
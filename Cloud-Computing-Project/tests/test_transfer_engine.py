@@ -0,0 +1,151 @@
+"""
+execute_transfer and execute_batch when the bulk request after the debit
+succeeds, fails on some of its items, or raises after applying some or
+all of them (see transfer_engine.py).
+"""
+import pytest
+import transfer_engine
+import reconcile_transfers
+from reconcile_transfers import CARD_INDEX
+from transfer_engine import execute_batch, TransferError, TransferPending
+
+
+@pytest.fixture(autouse=True)
+def traces_cover_the_fixtures(monkeypatch):
+    # The fixtures' transfers are dated 2024; keep their credit traces decidable
+    monkeypatch.setattr(transfer_engine, 'CREDIT_TRACE_TTL', 20 * 365 * 86400)
+
+
+def applies_only(es, monkeypatch, keep):
+    """Make the next bulk apply only the actions `keep(meta)` selects, then raise."""
+    bulk = es.bulk
+
+    def partial(operations, **kwargs):
+        kept, ops = [], iter(operations)
+        for meta in ops:
+            pair = [meta] if 'delete' in meta else [meta, next(ops)]
+            if keep(meta):
+                kept += pair
+        bulk(operations=kept, **kwargs)
+        monkeypatch.setattr(es, 'bulk', bulk)
+        raise ConnectionError('connection reset by peer')
+    monkeypatch.setattr(es, 'bulk', partial)
+
+
+def credit_to(*receivers):
+    return lambda meta: 'update' in meta and meta['update']['_id'] in receivers
+
+
+def balance(cards, username):
+    return cards(username)['_source']['balance']
+
+
+def pending(cards, username):
+    return [p['tx'] for p in cards(username)['_source'].get('pending') or []]
+
+
+def test_transfer_moves_the_money_and_settles(es, cards, tx_index, transfer):
+    transfer('tx1', 'bob', 30.0)
+
+    assert balance(cards, 'alice') == 70.0
+    assert balance(cards, 'bob') == 30.0
+    assert pending(cards, 'alice') == []
+    assert es.get(index=tx_index, id='tx1')['_source']['status'] == 'completed'
+    assert es.get(index='user_stats', id='alice')['_source']['completed'] == 1
+
+
+def test_failed_credit_after_the_debit_is_rolled_back(es, cards, tx_index, transfer):
+    # carol has no card: the debit applies, then the credit item of the bulk fails
+    with pytest.raises(TransferError) as raised:
+        transfer('tx1', 'carol', 30.0)
+
+    assert raised.value.failed == ['tx1']
+    assert balance(cards, 'alice') == 100.0
+    assert pending(cards, 'alice') == []
+    assert es.get(index=tx_index, id='tx1')['_source']['status'] == 'failed'
+    stats = es.get(index='user_stats', id='alice')['_source']
+    assert (stats['completed'], stats['failed'], stats['sent']['total']) == (0, 1, 0.0)
+
+
+def test_batch_rolls_back_only_the_failed_items(es, cards, tx_index, audit):
+    card = cards('alice')
+    items = [{'tx_id': tx_id, 'receiver': receiver, 'amount': amount, 'audit': audit('alice', receiver, amount)}
+             for tx_id, receiver, amount in (('tx1', 'bob', 10.0), ('tx2', 'carol', 20.0))]
+
+    failed = execute_batch(es, CARD_INDEX, tx_index, 'alice', items, card['_seq_no'], card['_primary_term'])
+
+    assert failed == ['tx2']
+    assert balance(cards, 'alice') == 90.0
+    assert balance(cards, 'bob') == 10.0
+    assert pending(cards, 'alice') == []
+    assert [es.get(index=tx_index, id=tx_id)['_source']['status'] for tx_id in ('tx1', 'tx2')] \
+        == ['completed', 'failed']
+
+
+def test_bulk_that_raises_leaves_the_transfer_pending(es, cards, tx_index, transfer, monkeypatch):
+    applies_only(es, monkeypatch, lambda meta: False)
+
+    with pytest.raises(TransferPending) as raised:
+        transfer('tx1', 'bob', 30.0)
+
+    assert raised.value.pending == ['tx1']
+    assert balance(cards, 'alice') == 70.0
+    assert pending(cards, 'alice') == ['tx1']
+    assert not es.exists(index=tx_index, id='tx1')
+
+    # It never landed: the reconciler refunds the sender and records the failure
+    assert reconcile_transfers.reconcile(es, grace=0) == 1
+    assert balance(cards, 'alice') == 100.0
+    assert balance(cards, 'bob') == 0.0
+    assert pending(cards, 'alice') == []
+    assert es.get(index=tx_index, id='tx1')['_source']['status'] == 'failed'
+    assert reconcile_transfers.reconcile(es, grace=0) == 0
+
+
+def test_bulk_that_raises_after_landing_is_not_refunded(es, cards, tx_index, transfer, monkeypatch):
+    applies_only(es, monkeypatch, lambda meta: True)
+
+    with pytest.raises(TransferPending):
+        transfer('tx1', 'bob', 30.0)
+
+    # The settle action rode in the bulk that landed
+    assert pending(cards, 'alice') == []
+    assert reconcile_transfers.reconcile(es, grace=0) == 0
+    assert balance(cards, 'alice') == 70.0
+    assert balance(cards, 'bob') == 30.0
+    assert es.get(index=tx_index, id='tx1')['_source']['status'] == 'completed'
+
+
+def test_bulk_that_raises_after_some_credits_landed(es, cards, tx_index, audit, monkeypatch):
+    es.index(index=CARD_INDEX, id='carol', document={'username': 'carol', 'phone': '333', 'balance': 0.0})
+    card = cards('alice')
+    items = [{'tx_id': tx_id, 'receiver': receiver, 'amount': amount, 'audit': audit('alice', receiver, amount)}
+             for tx_id, receiver, amount in (('tx1', 'bob', 10.0), ('tx2', 'carol', 20.0))]
+    # Only bob's credit landed: no audit records, and alice's entries stay pending
+    applies_only(es, monkeypatch, credit_to('bob'))
+
+    with pytest.raises(TransferPending):
+        execute_batch(es, CARD_INDEX, tx_index, 'alice', items, card['_seq_no'], card['_primary_term'])
+    assert pending(cards, 'alice') == ['tx1', 'tx2']
+
+    # bob was paid, so only carol's transfer is refunded
+    assert reconcile_transfers.reconcile(es, grace=0) == 1
+    assert balance(cards, 'alice') == 90.0
+    assert (balance(cards, 'bob'), balance(cards, 'carol')) == (10.0, 0.0)
+    assert pending(cards, 'alice') == []
+    assert [es.get(index=tx_index, id=tx_id)['_source']['status'] for tx_id in ('tx1', 'tx2')] \
+        == ['completed', 'failed']
+    assert reconcile_transfers.reconcile(es, grace=0) == 0
+
+
+def test_pending_transfer_past_its_credit_trace_is_left_alone(es, cards, tx_index, transfer, monkeypatch):
+    applies_only(es, monkeypatch, lambda meta: False)
+    with pytest.raises(TransferPending):
+        transfer('tx1', 'bob', 30.0)
+    monkeypatch.setattr(transfer_engine, 'CREDIT_TRACE_TTL', 60)
+
+    # No trace on bob's card, but it may have been dropped since: no refund
+    assert reconcile_transfers.reconcile(es, grace=0) == 0
+    assert (balance(cards, 'alice'), balance(cards, 'bob')) == (70.0, 0.0)
+    assert pending(cards, 'alice') == ['tx1']
+    assert not es.exists(index=tx_index, id='tx1')
@@ -0,0 +1,49 @@
+"""
+Transfers posted while the transaction service is still bootstrapping
+are turned away before they reach Elasticsearch (see
+common/bootstrap.bootstrap_required).
+"""
+import os
+import pytest
+
+os.environ.setdefault('JWT_SECRET_KEY', 'test-secret-of-at-least-thirty-two-bytes')
+
+import transaction_service  # noqa: E402
+from common import bootstrap as bootstrap_module  # noqa: E402
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+
+class NoElasticsearch:
+    """Any call means a request reached ES before the bootstrap finished."""
+
+    def __getattr__(self, name):
+        raise AssertionError(f'Elasticsearch called: {name}')
+
+
+@pytest.fixture
+def unbootstrapped(monkeypatch):
+    monkeypatch.setattr(bootstrap_module, 'BOOTSTRAP_WAIT', 0.01)
+    monkeypatch.setattr(transaction_service, 'es', NoElasticsearch())
+    monkeypatch.setattr(transaction_service.idempotency, 'es', NoElasticsearch())
+    assert not transaction_service.bootstrap.wait(0)
+    return transaction_service.app.test_client()
+
+
+def auth():
+    with transaction_service.app.app_context():
+        return {'Authorization': f"Bearer {create_access_token(identity='111')}"}
+
+
+@pytest.mark.parametrize('path, body', [
+    ('/transactions', {'sender_username': 'alice', 'receiver_username': 'bob', 'amount': 10}),
+    ('/transactions/batch', {'sender_username': 'alice', 'transfers': [{'receiver_username': 'bob', 'amount': 10}]}),
+])
+def test_transfer_before_bootstrap_is_retried_later(unbootstrapped, path, body):
+    res = unbootstrapped.post(path, json=body, headers=dict(auth(), **{'Idempotency-Key': 'k1'}))
+
+    assert res.status_code == 503
+    assert res.headers['Retry-After'] == str(bootstrap_module.BOOTSTRAP_RETRY_AFTER)
+
+
+def test_liveness_does_not_wait(unbootstrapped):
+    assert unbootstrapped.get('/healthz').status_code == 200
@@ -0,0 +1,130 @@
+"""
+Backfill the per-user history projection for transactions written
+before it existed (see transaction_index.py).
+
+    python backfill_history.py [--batch-size 1000] [--dry-run]
+
+1. Make sure the partitions and `transaction-history` exist with their
+   current mappings.
+2. Copy every audit record into the projection, once per user who can see
+   it. Copies use `create`, so a copy written by a live transfer in the
+   meantime is never overwritten with an older version.
+3. Record `backfilled_at` in the projection mapping. Running pods pick it
+   up within TRANSACTION_LAYOUT_CHECK_INTERVAL seconds and start serving
+   history from the single routed shard.
+
+Safe to re-run; services keep writing both copies the whole time.
+"""
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime
+from elasticsearch import Elasticsearch
+from transaction_index import (
+    TRANSACTION_ALIAS, HISTORY_INDEX,
+    ensure_transaction_index, ensure_history_index, projection_actions
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+def scan(es, index, batch_size, query=None):
+    """Yield every hit of `index` (matching `query`), in index order, through a point-in-time."""
+    pit_id = es.open_point_in_time(index=index, keep_alive='5m')['id']
+    after = None
+    try:
+        while True:
+            params = {'pit': {'id': pit_id, 'keep_alive': '5m'}, 'size': batch_size,
+                      'sort': ['_shard_doc'], 'track_total_hits': False}
+            if query:
+                params['query'] = query
+            if after:
+                params['search_after'] = after
+            res = es.search(**params)
+            hits = res['hits']['hits']
+            pit_id = res.get('pit_id', pit_id)
+            yield from hits
+            if len(hits) < batch_size:
+                return
+            after = hits[-1]['sort']
+    finally:
+        es.close_point_in_time(id=pit_id)
+
+
+def copy_actions(hit):
+    """Projection copies of one audit record, as create-only actions."""
+    actions = projection_actions(hit['_id'], hit['_source'])
+    for i in range(0, len(actions), 2):
+        actions[i] = {'create': actions[i]['index']}
+    return actions
+
+
+def backfill_projection(es, batch_size=1000):
+    copied = skipped = 0
+    batch = []
+
+    def flush():
+        nonlocal copied, skipped
+        res = es.bulk(operations=batch)
+        for item in res['items']:
+            status = item['create'].get('status', 500)
+            if status < 300:
+                copied += 1
+            elif status == 409:
+                skipped += 1
+            else:
+                raise RuntimeError(f"History copy failed: {item['create']}")
+        batch.clear()
+        logger.info("History copies: %s written, %s already present", copied, skipped)
+
+    for hit in scan(es, TRANSACTION_ALIAS, batch_size):
+        if not hit['_source'].get('sender_username') or not hit['_source'].get('receiver_username'):
+            continue
+        batch.extend(copy_actions(hit))
+        if len(batch) >= 2 * batch_size:
+            flush()
+    if batch:
+        flush()
+    return copied, skipped
+
+
+def backfill(es, batch_size=1000, dry_run=False):
+    if not dry_run:
+        ensure_transaction_index(es)
+        ensure_history_index(es)
+    if not es.indices.exists(index=TRANSACTION_ALIAS):
+        logger.info("No transactions yet; nothing to backfill")
+        return
+    total = es.count(index=TRANSACTION_ALIAS)['count']
+    logger.info("Copying %s transactions into %s", total, HISTORY_INDEX)
+    if dry_run:
+        return
+    backfill_projection(es, batch_size)
+    es.indices.refresh(index=HISTORY_INDEX)
+    es.indices.put_mapping(index=HISTORY_INDEX, meta={'backfilled_at': datetime.utcnow().isoformat() + 'Z'})
+    logger.info("%s is complete; history reads switch to it", HISTORY_INDEX)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args(argv)
+
+    es = Elasticsearch(
+        [f"http://{os.getenv('ES_HOST')}:{os.getenv('ES_PORT')}"],
+        basic_auth=(os.getenv('ELASTIC_USERNAME'), os.getenv('ELASTIC_PASSWORD'))
+    )
+    try:
+        backfill(es, batch_size=args.batch_size, dry_run=args.dry_run)
+    except Exception as e:
+        logger.error("Backfill failed: %s", e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Delete Idempotency-Key records past their `expires_at` (see idempotency.py).
+
+    python expire_idempotency_keys.py
+
+Records are kept for IDEMPOTENCY_CACHE_TTL seconds after they were
+claimed or completed, long enough for any client retry. The k8s CronJob
+runs this nightly.
+"""
+import os
+import sys
+import logging
+from elasticsearch import Elasticsearch
+from idempotency import purge_expired
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_INDEX = 'idempotency_keys'
+
+
+def main():
+    es = Elasticsearch(
+        [f"http://{os.getenv('ES_HOST')}:{os.getenv('ES_PORT')}"],
+        basic_auth=(os.getenv('ELASTIC_USERNAME'), os.getenv('ELASTIC_PASSWORD'))
+    )
+    try:
+        if es.indices.exists(index=IDEMPOTENCY_INDEX):
+            logger.info("Deleted %s expired idempotency records", purge_expired(es, IDEMPOTENCY_INDEX))
+    except Exception as e:
+        logger.error("Expiry failed: %s", e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import os
+import json
+import base64
+import logging
+from datetime import datetime
+from common.timestamps import parse_utc
+from transaction_index import HISTORY_INDEX, catalog
+
+logger = logging.getLogger(__name__)
+
+# Point-in-time keep-alive between two pages of the same cursor
+PIT_KEEP_ALIVE    = os.getenv('HISTORY_PIT_KEEP_ALIVE', '2m')
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 500))
+HISTORY_MAX_LIMIT = int(os.getenv('HISTORY_MAX_LIMIT', 1000))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def history_query(username, fields=None, since=None, until=None):
+    """
+    Transactions visible to `username`: everything they sent, plus what they
+    received unless it failed (receivers never see failed transfers),
+    optionally limited to timestamps in [since, until).
+    """
+    fields = fields or {name: name for name in ('sender_username', 'receiver_username', 'status')}
+    query = {
+        'bool': {
+            'should': [
+                {'term': {fields['sender_username']: username}},
+                {'bool': {
+                    'filter':   [{'term': {fields['receiver_username']: username}}],
+                    'must_not': [{'term': {fields['status']: 'failed'}}]
+                }}
+            ],
+            'minimum_should_match': 1
+        }
+    }
+    if since or until:
+        query['bool']['filter'] = [_range_filter(since, until)]
+    return query
+
+
+def projection_query(username, since=None, until=None):
+    """
+    The same history as history_query, read from the routed projection:
+    visibility was applied when the copies were written, so it is one term.
+    """
+    query = {'bool': {'filter': [{'term': {'owner': username}}]}}
+    if since or until:
+        query['bool']['filter'].append(_range_filter(since, until))
+    return query
+
+
+def _range_filter(since, until):
+    bounds = {}
+    if since:
+        bounds['gte'] = since.isoformat()
+    if until:
+        bounds['lt'] = until.isoformat()
+    return {'range': {'timestamp': bounds}}
+
+
+def parse_range(since, until):
+    """
+    Parse optional ISO-8601 `from`/`to` query values ('2024-05-01' or a full
+    timestamp, UTC unless it has an offset) into naive UTC datetimes. Raises
+    ValueError if they are malformed.
+    """
+    since, until = parse_utc(since), parse_utc(until)
+    if since and until and since >= until:
+        raise ValueError('from must be before to')
+    return since, until
+
+
+def encode_cursor(pit_id, search_after, since=None, until=None, routed=False):
+    data = {'pit': pit_id, 'after': search_after}
+    if routed:
+        data['routed'] = True
+    if since:
+        data['since'] = since.isoformat()
+    if until:
+        data['until'] = until.isoformat()
+    raw = json.dumps(data, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return (pit_id, search_after, since, until, routed) from a cursor."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        since, until = data.get('since'), data.get('until')
+        return (data['pit'], data['after'],
+                datetime.fromisoformat(since) if since else None,
+                datetime.fromisoformat(until) if until else None,
+                bool(data.get('routed')))
+    except Exception:
+        raise InvalidCursor('Invalid cursor')
+
+
+def _hit_to_tx(hit, routed=False):
+    tx = hit['_source']
+    if routed:
+        tx.pop('owner', None)
+    else:
+        tx['trans_id'] = hit['_id']
+    return tx
+
+
+def close_pit(es, pit_id):
+    try:
+        es.close_point_in_time(id=pit_id)
+    except Exception as e:
+        logger.warning("Failed to close point in time: %s", e)
+
+
+async def close_pit_async(es, pit_id):
+    try:
+        await es.close_point_in_time(id=pit_id)
+    except Exception as e:
+        logger.warning("Failed to close point in time: %s", e)
+
+
+def fetch_page(es, username, limit, cursor=None, since=None, until=None):
+    """
+    Return one page of a user's history (newest first) and the cursor for the
+    next page, or None when the history is exhausted. The cursor pins a
+    point-in-time so pages stay consistent while new transfers arrive.
+
+    Once the history projection is backfilled, the point-in-time is opened
+    with the user's routing and only touches the shard holding their copies.
+    Before that, a [since, until) range only opens the partitions that overlap it.
+    """
+    catalog.load(es)
+    if cursor:
+        pit_id, after, since, until, routed = decode_cursor(cursor)
+    else:
+        routed, after = catalog.history_ready, None
+        if routed:
+            pit_id = es.open_point_in_time(index=HISTORY_INDEX, keep_alive=PIT_KEEP_ALIVE, routing=username)['id']
+        else:
+            indices = catalog.read_indices(since, until)
+            if not indices:
+                return [], None
+            pit_id = es.open_point_in_time(index=indices, keep_alive=PIT_KEEP_ALIVE, ignore_unavailable=True)['id']
+
+    res = es.search(**_page_params(pit_id, after, username, limit, since, until, routed))
+    txs, pit_id, next_cursor = _page_result(res, pit_id, limit, since, until, routed)
+    if next_cursor is None:
+        close_pit(es, pit_id)
+    return txs, next_cursor
+
+
+async def fetch_page_async(es, username, limit, cursor=None, since=None, until=None):
+    """fetch_page for an AsyncElasticsearch client."""
+    await catalog.load_async(es)
+    if cursor:
+        pit_id, after, since, until, routed = decode_cursor(cursor)
+    else:
+        routed, after = catalog.history_ready, None
+        if routed:
+            pit_id = (await es.open_point_in_time(index=HISTORY_INDEX, keep_alive=PIT_KEEP_ALIVE,
+                                                  routing=username))['id']
+        else:
+            indices = catalog.read_indices(since, until)
+            if not indices:
+                return [], None
+            pit_id = (await es.open_point_in_time(index=indices, keep_alive=PIT_KEEP_ALIVE,
+                                                  ignore_unavailable=True))['id']
+
+    res = await es.search(**_page_params(pit_id, after, username, limit, since, until, routed))
+    txs, pit_id, next_cursor = _page_result(res, pit_id, limit, since, until, routed)
+    if next_cursor is None:
+        await close_pit_async(es, pit_id)
+    return txs, next_cursor
+
+
+def _page_params(pit_id, after, username, limit, since, until, routed):
+    if routed:
+        query = projection_query(username, since, until)
+    else:
+        query = history_query(username, catalog.fields(), since, until)
+    params = {
+        'pit':   {'id': pit_id, 'keep_alive': PIT_KEEP_ALIVE},
+        'query': query,
+        'sort':  [{'timestamp': {'order': 'desc'}}],
+        'size':  limit,
+        'track_total_hits': False
+    }
+    if after:
+        params['search_after'] = after
+    return params
+
+
+def _page_result(res, pit_id, limit, since, until, routed):
+    hits = res['hits']['hits']
+    pit_id = res.get('pit_id', pit_id)
+    txs = [_hit_to_tx(hit, routed) for hit in hits]
+    if len(hits) < limit:
+        return txs, pit_id, None
+    return txs, pit_id, encode_cursor(pit_id, hits[-1]['sort'], since, until, routed)
+
+
+def iter_history(es, username, page_size=HISTORY_PAGE_SIZE, since=None, until=None):
+    """Yield every visible transaction, newest first, one page in memory at a time."""
+    cursor = None
+    try:
+        while True:
+            txs, cursor = fetch_page(es, username, page_size, cursor, since, until)
+            for tx in txs:
+                yield tx
+            if not cursor:
+                return
+    finally:
+        # Release the point-in-time if the consumer stopped early
+        if cursor:
+            close_pit(es, decode_cursor(cursor)[0])
+
+
+async def iter_history_async(es, username, page_size=HISTORY_PAGE_SIZE, since=None, until=None):
+    """iter_history for an AsyncElasticsearch client."""
+    cursor = None
+    try:
+        while True:
+            txs, cursor = await fetch_page_async(es, username, page_size, cursor, since, until)
+            for tx in txs:
+                yield tx
+            if not cursor:
+                return
+    finally:
+        if cursor:
+            await close_pit_async(es, decode_cursor(cursor)[0])
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import g, request, jsonify, make_response
+from flask_jwt_extended import get_jwt_identity
+from elasticsearch import ConflictError, NotFoundError
+from common import metrics
+from common.card_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH     = 255
+
+# Only the lookup fields are indexed; stored responses are opaque JSON strings
+IDEMPOTENCY_MAPPINGS = {
+    'dynamic': False,
+    'properties': {
+        'state':      {'type': 'keyword'},
+        'created':    {'type': 'date'},
+        'claimed_at': {'type': 'date'},
+        'expires_at': {'type': 'date'}
+    }
+}
+
+
+class IdempotencyStore:
+    """
+    Records Idempotency-Key outcomes so a retried POST replays the original
+    response instead of running the transfer again.
+
+    A key is claimed atomically with an `op_type=create` document in ES, so
+    only one request across all workers and pods executes it. Completed
+    responses are also kept in a process-local LRU, which lets a retry that
+    lands on the same process be answered without any ES call. Concurrent
+    duplicates wait for the in-flight original to finish.
+
+    A claim is a lease: one whose `claimed_at` is older than `lease`
+    seconds (its owner died mid-request) is taken over by the next request,
+    conditionally on the claim's seq_no so only one taker wins. The lease
+    must outlast the slowest request. Records carry `expires_at`, `ttl`
+    seconds on, and expire_idempotency_keys.py deletes them after that.
+    """
+
+    def __init__(self, es, index, maxsize=10000, ttl=86400.0, wait_timeout=10.0, lease=60.0):
+        self.es           = es
+        self.index        = index
+        self.ttl          = ttl
+        self.wait_timeout = wait_timeout
+        self.lease        = lease
+        self._responses   = TTLCache(maxsize, ttl, name='idempotency')
+        self._in_flight   = {}
+        self._lock        = threading.Lock()
+        self.replays      = 0
+        self.executions   = 0
+
+    @classmethod
+    def from_env(cls, es, index):
+        return cls(
+            es,
+            index,
+            maxsize=int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000)),
+            ttl=float(os.getenv('IDEMPOTENCY_CACHE_TTL', 86400)),
+            wait_timeout=float(os.getenv('IDEMPOTENCY_WAIT_TIMEOUT', 10)),
+            lease=float(os.getenv('IDEMPOTENCY_LEASE', 60)),
+        )
+
+    @staticmethod
+    def doc_id(scope, key):
+        return hashlib.sha256(f'{scope}:{key}'.encode()).hexdigest()
+
+    def begin(self, doc_id, fingerprint):
+        """
+        Claim `doc_id`. Returns ('execute', None) when the caller owns the key,
+        ('replay', (body, code)) for a finished key, or ('mismatch'|'busy', None).
+        """
+        deadline = time.time() + self.wait_timeout
+        while True:
+            stored = self._responses.get(doc_id)
+            if stored is not None:
+                return self._replay(stored, fingerprint)
+
+            with self._lock:
+                waiter = self._in_flight.get(doc_id)
+                if waiter is None:
+                    self._in_flight[doc_id] = threading.Event()
+            if waiter is not None:
+                # Same process: wait on the original request
+                if not waiter.wait(max(0.0, deadline - time.time())):
+                    return 'busy', None
+                continue
+
+            try:
+                claimed = self._claim(doc_id, fingerprint)
+            except Exception:
+                self._release(doc_id)
+                raise
+            if claimed:
+                with self._lock:
+                    self.executions += 1
+                metrics.IDEMPOTENT_REQUESTS.labels('executed').inc()
+                return 'execute', None
+            self._release(doc_id)
+
+            # Another process owns the key: poll its record until it completes
+            delay = 0.05
+            while time.time() < deadline:
+                try:
+                    doc = self.es.get(index=self.index, id=doc_id)['_source']
+                except NotFoundError:
+                    break  # the owner aborted, try to claim it again
+                if doc.get('state') == 'completed':
+                    stored = (doc['fingerprint'], json.loads(doc['response']), doc['status_code'])
+                    self._responses.set(doc_id, stored)
+                    return self._replay(stored, fingerprint)
+                if self._stale(doc):
+                    break  # the owner's lease ran out, try to take the key over
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+            else:
+                return 'busy', None
+
+    def _claim(self, doc_id, fingerprint):
+        """Create the in-flight record, or take over one whose lease ran out. False if owned."""
+        now = datetime.utcnow()
+        doc = {
+            'state':       'in_flight',
+            'fingerprint': fingerprint,
+            'created':     now.isoformat(),
+            'claimed_at':  now.isoformat(),
+            'expires_at':  (now + timedelta(seconds=self.ttl)).isoformat()
+        }
+        try:
+            self.es.index(index=self.index, id=doc_id, op_type='create', document=doc)
+            return True
+        except ConflictError:
+            pass
+        try:
+            current = self.es.get(index=self.index, id=doc_id)
+        except NotFoundError:
+            return False
+        if current['_source'].get('state') != 'in_flight' or not self._stale(current['_source']):
+            return False
+        try:
+            self.es.index(index=self.index, id=doc_id, document=dict(doc, created=current['_source'].get('created')),
+                          if_seq_no=current['_seq_no'], if_primary_term=current['_primary_term'])
+        except ConflictError:
+            return False
+        logger.warning("Took over idempotency key %s after its lease ran out", doc_id)
+        return True
+
+    def _stale(self, doc):
+        claimed = doc.get('claimed_at') or doc.get('created')
+        return (doc.get('state') == 'in_flight' and claimed is not None
+                and datetime.fromisoformat(claimed) < datetime.utcnow() - timedelta(seconds=self.lease))
+
+    def complete(self, doc_id, fingerprint, body, code):
+        stored = (fingerprint, body, code)
+        try:
+            self.es.index(index=self.index, id=doc_id, document={
+                'state':       'completed',
+                'fingerprint': fingerprint,
+                'response':    json.dumps(body),
+                'status_code': code,
+                'completed':   datetime.utcnow().isoformat(),
+                'expires_at':  (datetime.utcnow() + timedelta(seconds=self.ttl)).isoformat()
+            })
+        except Exception as e:
+            logger.error("Failed to persist idempotency record: %s", e)
+        self._responses.set(doc_id, stored)
+        self._release(doc_id)
+
+    def abort(self, doc_id):
+        """Forget a claimed key so that a retry can execute it again."""
+        try:
+            self.es.delete(index=self.index, id=doc_id)
+        except NotFoundError:
+            pass
+        except Exception as e:
+            logger.error("Failed to release idempotency record: %s", e)
+        self._release(doc_id)
+
+    def _release(self, doc_id):
+        with self._lock:
+            waiter = self._in_flight.pop(doc_id, None)
+        if waiter is not None:
+            waiter.set()
+
+    def _replay(self, stored, fingerprint):
+        if stored[0] != fingerprint:
+            return 'mismatch', None
+        with self._lock:
+            self.replays += 1
+        metrics.IDEMPOTENT_REQUESTS.labels('replayed').inc()
+        return 'replay', (stored[1], stored[2])
+
+    def stats(self):
+        with self._lock:
+            stats = {'replays': self.replays, 'executions': self.executions, 'in_flight': len(self._in_flight)}
+        stats['cache'] = self._responses.stats()
+        return stats
+
+
+def purge_expired(es, index):
+    """Delete the records whose `expires_at` has passed; returns how many."""
+    res = es.delete_by_query(index=index, query={'range': {'expires_at': {'lt': 'now'}}},
+                             conflicts='proceed', refresh=True)
+    return res.get('deleted', 0)
+
+
+def money_may_move():
+    """
+    Tell `idempotent` that the view is about to debit. From then on its
+    outcome is recorded even when it fails, so that a retry replays it
+    rather than charging again.
+    """
+    g.idempotency_committed = True
+
+
+def request_fingerprint():
+    payload = request.get_json(silent=True)
+    raw = json.dumps(payload, sort_keys=True) if payload is not None else request.get_data(as_text=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def idempotent(store):
+    """
+    Make a JWT-protected POST view honour the Idempotency-Key header. Keys
+    are scoped to the caller's identity. A 409, and a 5xx or an exception
+    before the view called money_may_move, are not recorded, so those
+    requests can be retried with the same key.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(IDEMPOTENCY_HEADER)
+            if key is None:
+                return view(*args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return jsonify({'message': f'Invalid {IDEMPOTENCY_HEADER}'}), 400
+
+            doc_id = store.doc_id(get_jwt_identity(), key)
+            fingerprint = request_fingerprint()
+            outcome, stored = store.begin(doc_id, fingerprint)
+            if outcome == 'replay':
+                resp = make_response(jsonify(stored[0]), stored[1])
+                resp.headers['Idempotent-Replayed'] = 'true'
+                return resp
+            if outcome == 'mismatch':
+                return jsonify({'message': f'{IDEMPOTENCY_HEADER} was already used for a different request'}), 422
+            if outcome == 'busy':
+                return jsonify({'message': 'A request with this idempotency key is still in progress'}), 409
+
+            try:
+                resp = make_response(view(*args, **kwargs))
+            except Exception:
+                if g.get('idempotency_committed'):
+                    store.complete(doc_id, fingerprint, {'message': 'Internal server error'}, 500)
+                else:
+                    store.abort(doc_id)
+                raise
+            if resp.status_code == 409 or (resp.status_code >= 500 and not g.get('idempotency_committed')):
+                store.abort(doc_id)
+            else:
+                store.complete(doc_id, fingerprint, resp.get_json(), resp.status_code)
+            return resp
+        return wrapper
+    return decorator
@@ -0,0 +1,157 @@
+"""
+Move a legacy, dynamically mapped `transactions` index behind the
+`transactions` alias (see transaction_index.py) without taking the
+service down.
+
+    python migrate_index.py [--dry-run]
+
+1. Create the archive index `transactions-vN` with the declared mapping.
+   Refresh and replicas are off while it loads.
+2. Reindex everything from the legacy index. Transfers keep writing to
+   the legacy index meanwhile.
+3. Catch up on documents written since the copy started.
+4. Block writes on the legacy index for the final catch-up. Then, in one
+   atomic step, drop it and point the alias at the archive. Writes fail
+   only for that short window; a transfer whose audit write fails is
+   compensated as usual.
+
+Running pods notice the new layout within TRANSACTION_LAYOUT_CHECK_INTERVAL
+seconds and start writing to the monthly partitions. The archive keeps
+everything from before; reads always include it, and partitions.py seals
+it like any old partition.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+from elasticsearch import Elasticsearch
+from transaction_index import (
+    TRANSACTION_ALIAS, TRANSACTION_VERSION, TRANSACTION_MAPPINGS,
+    versioned_name, transaction_settings, ensure_transaction_index
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Overlap between passes, covering clock skew between pods and ES
+CATCHUP_MARGIN = timedelta(minutes=5)
+
+
+def resolve_source(es, alias):
+    """Return (source indices, legacy) for what `alias` currently resolves to."""
+    if es.indices.exists_alias(name=alias):
+        return sorted(es.indices.get_alias(name=alias)), False
+    if es.indices.exists(index=alias):
+        return [alias], True
+    return [], False
+
+
+def wait_for_task(es, task_id, poll=2.0):
+    while True:
+        task = es.tasks.get(task_id=task_id)
+        status = task['task']['status']
+        logger.info("Reindex progress: %s/%s",
+                    status.get('created', 0) + status.get('updated', 0), status.get('total', 0))
+        if task.get('completed'):
+            failures = task.get('response', {}).get('failures') or []
+            if failures:
+                raise RuntimeError(f"Reindex finished with {len(failures)} failures: {failures[:3]}")
+            return task.get('response', {})
+        time.sleep(poll)
+
+
+def reindex(es, sources, dest, since=None, batch_size=1000, background=False):
+    source = {'index': sources, 'size': batch_size}
+    if since is not None:
+        source['query'] = {'range': {'timestamp': {'gte': (since - CATCHUP_MARGIN).isoformat() + 'Z'}}}
+    res = es.options(request_timeout=3600).reindex(
+        source=source,
+        dest={'index': dest},
+        conflicts='proceed',
+        slices='auto',
+        wait_for_completion=not background
+    )
+    return wait_for_task(es, res['task']) if background else res
+
+
+def migrate(es, alias=TRANSACTION_ALIAS, version=TRANSACTION_VERSION, batch_size=1000, dry_run=False):
+    dest = versioned_name(version)
+    sources, legacy = resolve_source(es, alias)
+    if not legacy:
+        logger.info("'%s' is already an alias over %s; nothing to migrate", alias, sources or 'nothing yet')
+        if not sources and not dry_run:
+            ensure_transaction_index(es)
+        return
+
+    total = es.count(index=sources)['count']
+    logger.info("Migrating %s transactions from legacy index %s to %s", total, alias, dest)
+    if dry_run:
+        return
+
+    final_settings = transaction_settings()
+    replicas = es.indices.get_settings(index=sources[0])[sources[0]]['settings']['index'].get('number_of_replicas', '1')
+    load_settings = {'index': dict(final_settings['index'], refresh_interval='-1', number_of_replicas=0)}
+    if not es.indices.exists(index=dest):
+        es.indices.create(index=dest, mappings=TRANSACTION_MAPPINGS, settings=load_settings)
+
+    # Bulk copy while the service keeps writing to the source
+    started = datetime.utcnow()
+    reindex(es, sources, dest, batch_size=batch_size, background=True)
+    caught_up = datetime.utcnow()
+    res = reindex(es, sources, dest, since=started, batch_size=batch_size)
+    logger.info("First catch-up copied %s documents", res.get('created', 0) + res.get('updated', 0))
+
+    # Short write freeze for the last few documents, then the atomic swap
+    es.indices.put_settings(index=sources, settings={'index.blocks.write': True})
+    try:
+        res = reindex(es, sources, dest, since=caught_up, batch_size=batch_size)
+        logger.info("Final catch-up copied %s documents", res.get('created', 0) + res.get('updated', 0))
+        es.indices.refresh(index=dest)
+        copied = es.count(index=dest)['count']
+        source_count = es.count(index=sources)['count']
+        if copied < source_count:
+            raise RuntimeError(f"{dest} has {copied} documents but the source has {source_count}")
+
+        # An alias cannot share a name with an index, so the legacy index
+        # is dropped in the same atomic step that creates the alias
+        es.indices.update_aliases(actions=[
+            {'remove_index': {'index': alias}},
+            {'add': {'index': dest, 'alias': alias}}
+        ])
+    except Exception:
+        es.indices.put_settings(index=sources, settings={'index.blocks.write': False})
+        raise
+
+    es.indices.put_settings(index=dest, settings={
+        'index': {'refresh_interval': final_settings['index']['refresh_interval'], 'number_of_replicas': replicas}
+    })
+    logger.info("'%s' now points at %s (%s documents)", alias, dest, copied)
+    # Partitions for new writes hang off the same alias
+    ensure_transaction_index(es)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--version', type=int, default=TRANSACTION_VERSION, help='target index version')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args(argv)
+
+    es = Elasticsearch(
+        [f"http://{os.getenv('ES_HOST')}:{os.getenv('ES_PORT')}"],
+        basic_auth=(os.getenv('ELASTIC_USERNAME'), os.getenv('ELASTIC_PASSWORD'))
+    )
+    try:
+        migrate(es, version=args.version, batch_size=args.batch_size, dry_run=args.dry_run)
+    except Exception as e:
+        logger.error("Migration failed: %s", e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,780 @@
+import os
+import time
+import heapq
+import asyncio
+import queue
+import random
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from elasticsearch import BadRequestError, NotFoundError
+from common import metrics, tracing
+from common.service_client import ServiceClient, CircuitBreaker, CircuitOpenError
+from common.timestamps import parse_utc
+
+logger = logging.getLogger(__name__)
+
+# Events not yet delivered, one document per event (see outbox_actions)
+OUTBOX_INDEX = 'notification_outbox'
+OUTBOX_MAPPINGS = {
+    'dynamic': False,
+    'properties': {
+        'sender':     {'type': 'keyword'},
+        'transfers':  {'type': 'keyword'},
+        'created_at': {'type': 'date'},
+        'swept_at':   {'type': 'date'},
+        # Stored for delivery only
+        'event':      {'type': 'object', 'enabled': False},
+    }
+}
+
+# Stored events read per sweep request
+SWEEP_PAGE_SIZE = 500
+
+
+def env_options():
+    """Outbox tuning knobs from the NOTIFY_* environment variables."""
+    return {
+        'workers':      int(os.getenv('NOTIFY_WORKERS', 4)),
+        'batch_size':   int(os.getenv('NOTIFY_BATCH_SIZE', 20)),
+        'max_queue':    int(os.getenv('NOTIFY_QUEUE_SIZE', 10000)),
+        'max_retries':  int(os.getenv('NOTIFY_MAX_RETRIES', 5)),
+        'backoff_base': float(os.getenv('NOTIFY_BACKOFF_BASE', 0.5)),
+        'backoff_max':  float(os.getenv('NOTIFY_BACKOFF_MAX', 30)),
+        'timeout':      float(os.getenv('NOTIFY_TIMEOUT', 5)),
+        'failure_threshold': int(os.getenv('NOTIFY_FAILURE_THRESHOLD', 5)),
+        'reset_timeout':     float(os.getenv('NOTIFY_RESET_TIMEOUT', 10)),
+        'sweep_age':         float(os.getenv('NOTIFY_SWEEP_AGE', 300)),
+        'sweep_interval':    float(os.getenv('NOTIFY_SWEEP_INTERVAL', 300)),
+    }
+
+
+def ensure_outbox_index(es):
+    """Bootstrap step: create the index the outbox stores its events in."""
+    if es.indices.exists(index=OUTBOX_INDEX):
+        return
+    try:
+        es.indices.create(index=OUTBOX_INDEX, mappings=OUTBOX_MAPPINGS)
+        logger.info("Created notification outbox %s", OUTBOX_INDEX)
+    except BadRequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+
+async def ensure_outbox_index_async(es):
+    """ensure_outbox_index for an AsyncElasticsearch client."""
+    if await es.indices.exists(index=OUTBOX_INDEX):
+        return
+    try:
+        await es.indices.create(index=OUTBOX_INDEX, mappings=OUTBOX_MAPPINGS)
+        logger.info("Created notification outbox %s", OUTBOX_INDEX)
+    except BadRequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+
+def _attach_trace(event):
+    # Events are delivered in batches, long after the request returned;
+    # each one carries the trace of the transfer that queued it.
+    context = tracing.traceparent()
+    if context:
+        event['traceparent'] = context
+
+
+def transfer_ids(event):
+    """The transfers an event announces: one, or every item of a batch."""
+    if event.get('status') == 'batch':
+        return [item['trans_id'] for item in event['items']]
+    return [event['trans_id']]
+
+
+def outbox_document(event):
+    """The stored form of `event`; its id is the event's trans_id."""
+    _attach_trace(event)
+    return {
+        'event':      event,
+        'sender':     (event.get('sender_doc') or {}).get('username'),
+        'transfers':  transfer_ids(event),
+        'created_at': _stamp(),
+    }
+
+
+def outbox_actions(event):
+    """
+    Bulk actions storing `event` until it is delivered. They go in the bulk
+    request that writes the audit records the event announces, so the event
+    is stored exactly when the transfers are.
+    """
+    return [{'index': {'_index': OUTBOX_INDEX, '_id': event['trans_id']}}, outbox_document(event)]
+
+
+def _stamp(age=0.0):
+    return (datetime.utcnow() - timedelta(seconds=age)).isoformat() + 'Z'
+
+
+def _sweep_query(cutoff):
+    # Stored before the cutoff, and not claimed by a sweep since
+    return {'bool': {
+        'filter':   [{'range': {'created_at': {'lt': cutoff}}}],
+        'must_not': [{'range': {'swept_at': {'gte': cutoff}}}],
+    }}
+
+
+def _settled_hits(hits, cards):
+    """
+    The stored events none of whose transfers is still on its sender's
+    `pending` list. Those are settled by reconcile_transfers.py first, which
+    deletes the events of the transfers it refunds.
+    """
+    pending = {doc['_id']: {p['tx'] for p in doc['_source'].get('pending') or []}
+               for doc in cards['docs'] if doc.get('found')}
+    return [hit for hit in hits
+            if not pending.get(hit['_source'].get('sender'), set()) & set(hit['_source'].get('transfers') or [])]
+
+
+def _claim_actions(hits):
+    # Conditional on the version read, so concurrent sweepers never queue the same event
+    now = _stamp()
+    actions = []
+    for hit in hits:
+        actions += [{'update': {'_index': OUTBOX_INDEX, '_id': hit['_id'],
+                                'if_seq_no': hit['_seq_no'], 'if_primary_term': hit['_primary_term']}},
+                    {'doc': {'swept_at': now}}]
+    return actions
+
+
+def _claimed_items(hits, res):
+    items = []
+    for hit, result in zip(hits, res['items']):
+        if result['update'].get('status', 500) < 300:
+            created = parse_utc(hit['_source']['created_at']).replace(tzinfo=timezone.utc).timestamp()
+            items.append({'event': hit['_source']['event'], 'enqueued_at': created, 'attempts': 0})
+    return items
+
+
+def _forget_actions(items):
+    return [{'delete': {'_index': OUTBOX_INDEX, '_id': item['event']['trans_id']}} for item in items]
+
+
+def _check_forgotten(res, count):
+    # 404: the event was deleted already (delivered twice, or refunded)
+    failed = [r for item in res['items'] for r in item.values() if r.get('status', 500) not in (200, 404)]
+    if failed:
+        logger.warning("Could not delete %s of %s delivered notifications from %s; they will be sent again: %s",
+                       len(failed), count, OUTBOX_INDEX, failed[0])
+
+
+def event_statuses(status, body, count):
+    """
+    The status of each event of a delivered batch: the per-event `results`
+    the notification service answers with, or the HTTP status for all of
+    them when the answer has none (an error, or a malformed body).
+    """
+    results = body.get('results') if isinstance(body, dict) else None
+    if status < 300 and isinstance(results, list) and len(results) == count:
+        return [r.get('status', 500) if isinstance(r, dict) else 500 for r in results]
+    return [status] * count
+
+
+def _json(resp):
+    try:
+        return resp.json()
+    except ValueError:
+        return None
+
+
+def delivery_span(events):
+    """
+    Client span for one batch POST: a child of the first event's trace,
+    linked to the others. The notification service continues each event's
+    own trace from its `traceparent`.
+    """
+    contexts = [c for c in (tracing.parse_traceparent(e.get('traceparent')) for e in events) if c]
+    return tracing.span('POST notification /transaction-notify/batch', 'client',
+                        parent=contexts[0] if contexts else None, links=contexts[1:],
+                        attributes={'batch.size': len(events)})
+
+
+class NotificationOutbox:
+    """
+    Outbox for transaction notifications.
+
+    Every event is stored in the notification_outbox index by the bulk
+    request that writes the audit records it announces (see outbox_actions),
+    and queued here after that request returns. The queue is the fast path;
+    the index is what survives a crash. A small pool of
+    dispatcher threads drains the queue in batches, POSTs each batch to the
+    notification service and re-schedules failed deliveries with exponential
+    backoff. Threads are started lazily (and restarted after a fork) so the
+    module is safe to import in a pre-forking server. POSTs go through a
+    ServiceClient: kept-alive connections, one per dispatcher, and a circuit
+    breaker that sends batches straight to the retry schedule while the
+    notification service is down. Only the events the service reports as
+    failed with a 5xx in its per-event `results` are retried.
+
+    A stored event is deleted once the service has delivered or rejected it.
+    Events the queue lost (`dropped`, `dead_lettered` and `abandoned` in
+    notification_outbox_events_total, see common/metrics.py) stay stored: a
+    sweeper thread queues the ones older than sweep_age at startup and every
+    sweep_interval seconds after. Delivery is therefore at least once; an
+    event whose deletion failed, or that was claimed by a sweep while still
+    queued in another process, is sent again. Without an `es` client the
+    outbox keeps events in memory only.
+    """
+
+    def __init__(self, url, headers, es=None, card_index='cards', workers=4, batch_size=20,
+                 max_queue=10000, max_retries=5, backoff_base=0.5, backoff_max=30.0, timeout=5,
+                 failure_threshold=5, reset_timeout=10.0, sweep_age=300.0, sweep_interval=300.0):
+        self.es           = es
+        self.card_index   = card_index
+        self.url          = url
+        self.headers      = headers
+        self.workers      = workers
+        self.batch_size   = batch_size
+        self.max_retries  = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max  = backoff_max
+        self.timeout      = timeout
+        self.sweep_age    = sweep_age
+        self.sweep_interval = sweep_interval
+        self.client       = ServiceClient('notification', url, timeout=timeout, pool_size=workers,
+                                          failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+
+        self._queue   = queue.Queue(maxsize=max_queue)
+        self._retries = []          # heap of (due_at, seq, item)
+        self._seq     = 0
+        self._lock    = threading.Lock()
+        self._stop    = threading.Event()
+        self._threads = []
+        self._sweeper_thread = None
+        self._pid     = None
+
+        self._in_flight     = 0
+        self._delivered     = 0
+        self._rejected      = 0
+        self._retried       = 0
+        self._dropped       = 0
+        self._dead_lettered = 0
+        self._swept         = 0
+        self._last_lag      = 0.0
+        self._max_lag       = 0.0
+
+    @classmethod
+    def from_env(cls, url, headers, es=None, card_index='cards'):
+        """Build an outbox using the NOTIFY_* tuning knobs from the environment."""
+        return cls(url, headers, es=es, card_index=card_index, **env_options())
+
+    # ─── PRODUCER SIDE ───────────────────────────────────────────────────────
+    def enqueue(self, event):
+        """Record a notification event. Never blocks the request thread."""
+        self._ensure_started()
+        _attach_trace(event)
+        item = {'event': event, 'enqueued_at': time.time(), 'attempts': 0}
+        try:
+            self._queue.put_nowait(item)
+            metrics.OUTBOX_DEPTH.inc()
+            return True
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            metrics.OUTBOX_EVENTS.labels('dropped').inc()
+            logger.error("Notification outbox full, dropping event for transaction %s", event.get('trans_id'))
+            return False
+
+    def record(self, event):
+        """
+        Store `event` on its own, replacing the stored event with its id, and
+        queue it. For events whose audit records were written without them.
+        """
+        if self.es is not None:
+            try:
+                self.es.index(index=OUTBOX_INDEX, id=event['trans_id'], document=outbox_document(event))
+            except Exception as e:
+                logger.warning("Could not store notification for transaction %s, queueing it only: %s",
+                               event.get('trans_id'), e)
+        return self.enqueue(event)
+
+    def close(self, timeout=10.0):
+        """Wait up to `timeout` seconds for pending events, then stop the dispatchers."""
+        deadline = time.time() + timeout
+        while time.time() < deadline and self.depth() > 0:
+            time.sleep(0.05)
+        self._stop.set()
+        threads = self._threads + ([self._sweeper_thread] if self._sweeper_thread else [])
+        for t in threads:
+            t.join(max(0.0, deadline - time.time()))
+        _abandon(self.depth(), self.es is not None)
+
+    # ─── STATS ───────────────────────────────────────────────────────────────
+    def depth(self):
+        with self._lock:
+            return self._queue.qsize() + len(self._retries) + self._in_flight
+
+    def stats(self):
+        with self._queue.mutex:
+            head = self._queue.queue[0]['enqueued_at'] if self._queue.queue else None
+        with self._lock:
+            pending = [item['enqueued_at'] for _, _, item in self._retries]
+            if head is not None:
+                pending.append(head)
+            oldest = min(pending) if pending else None
+            return {
+                'queue_depth':       self._queue.qsize(),
+                'retry_pending':     len(self._retries),
+                'in_flight':         self._in_flight,
+                'delivered':         self._delivered,
+                'rejected':          self._rejected,
+                'retried':           self._retried,
+                'dropped':           self._dropped,
+                'dead_lettered':     self._dead_lettered,
+                'swept':             self._swept,
+                'last_lag_seconds':  round(self._last_lag, 3),
+                'max_lag_seconds':   round(self._max_lag, 3),
+                'oldest_pending_age_seconds': round(time.time() - oldest, 3) if oldest else 0.0,
+                'workers':           len([t for t in self._threads if t.is_alive()]),
+                'circuit':           self.client.breaker.stats(),
+            }
+
+    # ─── DISPATCHERS ─────────────────────────────────────────────────────────
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A forked child inherits the queue but not the threads.
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f'notify-outbox-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+            if self.es is not None and self.workers:
+                self._sweeper_thread = threading.Thread(target=self._sweeper, name='notify-outbox-sweeper',
+                                                        daemon=True)
+                self._sweeper_thread.start()
+
+    # ─── SWEEPER ─────────────────────────────────────────────────────────────
+    def sweep(self):
+        """Queue the stored events older than sweep_age that are not queued anywhere; returns how many."""
+        cutoff = _stamp(self.sweep_age)
+        swept, after = 0, None
+        while not self._stop.is_set():
+            try:
+                res = self.es.search(index=OUTBOX_INDEX, query=_sweep_query(cutoff), sort=[{'created_at': 'asc'}],
+                                     size=SWEEP_PAGE_SIZE, search_after=after, seq_no_primary_term=True)
+            except NotFoundError:
+                return swept
+            page = res['hits']['hits']
+            hits = page
+            if hits:
+                senders = sorted({hit['_source'].get('sender') for hit in hits if hit['_source'].get('sender')})
+                if senders:
+                    hits = _settled_hits(hits, self.es.mget(index=self.card_index, ids=senders))
+            if hits:
+                for item in _claimed_items(hits, self.es.bulk(operations=_claim_actions(hits))):
+                    self._put(item)
+                    swept += 1
+            if len(page) < SWEEP_PAGE_SIZE:
+                break
+            after = page[-1]['sort']
+        if swept:
+            with self._lock:
+                self._swept += swept
+            metrics.OUTBOX_EVENTS.labels('swept').inc(swept)
+            logger.info("Queued %s undelivered notifications from %s", swept, OUTBOX_INDEX)
+        return swept
+
+    def _put(self, item):
+        # Waits for room: these events are already stored, nothing is lost by waiting
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                metrics.OUTBOX_DEPTH.inc()
+                return
+            except queue.Full:
+                continue
+
+    def _sweeper(self):
+        delay = self.backoff_base
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+                delay, pause = self.backoff_base, self.sweep_interval
+            except Exception as e:
+                logger.warning("Notification outbox sweep failed: %s", e)
+                delay, pause = min(self.backoff_max, delay * 2), delay
+            self._stop.wait(pause)
+
+    def _next_batch(self):
+        batch = []
+        # Due retries go first so they are not starved by new traffic.
+        with self._lock:
+            now = time.time()
+            while self._retries and self._retries[0][0] <= now and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(self._retries)[2])
+            wait = min(self._retries[0][0] - now, 0.5) if self._retries else 0.5
+        if not batch:
+            try:
+                batch.append(self._queue.get(timeout=max(wait, 0.01)))
+            except queue.Empty:
+                return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            with self._lock:
+                self._in_flight += len(batch)
+            try:
+                self._deliver(batch)
+            finally:
+                with self._lock:
+                    self._in_flight -= len(batch)
+
+    def _deliver(self, batch):
+        events = [item['event'] for item in batch]
+        try:
+            with delivery_span(events):
+                resp = self.client.post('', json={'events': events}, headers=self.headers)
+            statuses = event_statuses(resp.status_code, _json(resp), len(batch))
+        except Exception as e:
+            logger.warning("Notification batch of %s failed: %s", len(batch), e)
+            statuses = [None] * len(batch)
+
+        retry, settled = _split(batch, statuses)
+        if retry:
+            self._schedule_retry(retry)
+        now = time.time()
+        with self._lock:
+            for item, status in settled:
+                if status >= 400:
+                    self._rejected += 1
+                else:
+                    self._delivered += 1
+                lag = now - item['enqueued_at']
+                self._last_lag = lag
+                self._max_lag = max(self._max_lag, lag)
+        _count_settled(settled, now)
+        if settled and self.es is not None:
+            self._forget([item for item, _ in settled])
+
+    def _forget(self, items):
+        try:
+            _check_forgotten(self.es.bulk(operations=_forget_actions(items)), len(items))
+        except Exception as e:
+            logger.warning("Could not delete %s delivered notifications from %s; they will be sent again: %s",
+                           len(items), OUTBOX_INDEX, e)
+
+    def _schedule_retry(self, batch):
+        with self._lock:
+            for item in batch:
+                item['attempts'] += 1
+                if item['attempts'] > self.max_retries:
+                    self._dead_lettered += 1
+                    metrics.OUTBOX_DEPTH.dec()
+                    metrics.OUTBOX_EVENTS.labels('dead_lettered').inc()
+                    logger.error("Giving up on notification for transaction %s after %s retries",
+                                 item['event'].get('trans_id'), self.max_retries)
+                    continue
+                delay = min(self.backoff_max, self.backoff_base * (2 ** (item['attempts'] - 1)))
+                delay *= random.uniform(0.5, 1.0)
+                self._seq += 1
+                self._retried += 1
+                metrics.OUTBOX_EVENTS.labels('retried').inc()
+                heapq.heappush(self._retries, (time.time() + delay, self._seq, item))
+
+
+def _split(batch, statuses):
+    """Events to retry (no answer, or a 5xx), and the settled ones with their status."""
+    retry, settled = [], []
+    for item, status in zip(batch, statuses):
+        if status is None or status >= 500:
+            retry.append(item)
+        else:
+            settled.append((item, status))
+    return retry, settled
+
+
+def _count_settled(settled, now):
+    metrics.OUTBOX_DEPTH.dec(len(settled))
+    for item, _ in settled:
+        metrics.OUTBOX_LAG.observe(now - item['enqueued_at'])
+    rejected = [item['event'].get('trans_id') for item, status in settled if status >= 400]
+    if rejected:
+        # Retrying these will not help
+        logger.error("Notification service rejected events for transactions %s", rejected)
+        metrics.OUTBOX_EVENTS.labels('rejected').inc(len(rejected))
+    if len(settled) > len(rejected):
+        metrics.OUTBOX_EVENTS.labels('delivered').inc(len(settled) - len(rejected))
+
+
+def _abandon(depth, stored):
+    if depth:
+        fate = f'they stay in {OUTBOX_INDEX} for the next sweep' if stored else 'they are lost'
+        logger.error("Notification outbox stopped with %s events undelivered; %s", depth, fate)
+        metrics.OUTBOX_EVENTS.labels('abandoned').inc(depth)
+
+
+class AsyncNotificationOutbox:
+    """
+    asyncio counterpart of NotificationOutbox for the ASGI service.
+
+    Dispatcher tasks share one aiohttp session and run on the server's event
+    loop, so delivering notifications costs no threads. start() and close()
+    are called from the application's serving hooks. The session pools its
+    connections itself; the circuit breaker is the one ServiceClient uses.
+    Storage, per-event retries and sweeps work as in NotificationOutbox,
+    with the AsyncElasticsearch client handed to start().
+    """
+
+    def __init__(self, url, headers, card_index='cards', workers=4, batch_size=20, max_queue=10000,
+                 max_retries=5, backoff_base=0.5, backoff_max=30.0, timeout=5,
+                 failure_threshold=5, reset_timeout=10.0, sweep_age=300.0, sweep_interval=300.0):
+        self.es           = None
+        self.card_index   = card_index
+        self.url          = url
+        self.headers      = headers
+        self.workers      = workers
+        self.batch_size   = batch_size
+        self.max_queue    = max_queue
+        self.max_retries  = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max  = backoff_max
+        self.timeout      = timeout
+        self.sweep_age    = sweep_age
+        self.sweep_interval = sweep_interval
+        self.breaker      = CircuitBreaker('notification', failure_threshold, reset_timeout)
+
+        self._queue   = None
+        self._session = None
+        self._tasks   = []
+        self._sweeper_task = None
+        self._timers  = set()
+
+        self._in_flight     = 0
+        self._delivered     = 0
+        self._rejected      = 0
+        self._retried       = 0
+        self._dropped       = 0
+        self._dead_lettered = 0
+        self._swept         = 0
+        self._last_lag      = 0.0
+        self._max_lag       = 0.0
+
+    @classmethod
+    def from_env(cls, url, headers, card_index='cards'):
+        return cls(url, headers, card_index=card_index, **env_options())
+
+    async def start(self, es=None):
+        import aiohttp
+        self.es       = es
+        self._queue   = asyncio.Queue(maxsize=self.max_queue)
+        self._session = aiohttp.ClientSession(
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+        if es is not None and self.workers:
+            self._sweeper_task = asyncio.create_task(self._sweeper())
+
+    def enqueue(self, event):
+        """Record a notification event. Never waits."""
+        _attach_trace(event)
+        item = {'event': event, 'enqueued_at': time.time(), 'attempts': 0}
+        try:
+            self._queue.put_nowait(item)
+            metrics.OUTBOX_DEPTH.inc()
+            return True
+        except (asyncio.QueueFull, AttributeError):
+            self._dropped += 1
+            metrics.OUTBOX_EVENTS.labels('dropped').inc()
+            logger.error("Notification outbox full, dropping event for transaction %s", event.get('trans_id'))
+            return False
+
+    async def record(self, event):
+        """NotificationOutbox.record for the AsyncElasticsearch client."""
+        if self.es is not None:
+            try:
+                await self.es.index(index=OUTBOX_INDEX, id=event['trans_id'], document=outbox_document(event))
+            except Exception as e:
+                logger.warning("Could not store notification for transaction %s, queueing it only: %s",
+                               event.get('trans_id'), e)
+        return self.enqueue(event)
+
+    async def close(self, timeout=10.0):
+        """Wait up to `timeout` seconds for pending events, then stop the dispatchers."""
+        deadline = time.time() + timeout
+        while time.time() < deadline and self.depth() > 0:
+            await asyncio.sleep(0.05)
+        _abandon(self.depth(), self.es is not None)
+        for handle in self._timers:
+            handle.cancel()
+        tasks = self._tasks + ([self._sweeper_task] if self._sweeper_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+    def depth(self):
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + len(self._timers) + self._in_flight
+
+    def stats(self):
+        return {
+            'queue_depth':      self._queue.qsize() if self._queue is not None else 0,
+            'retry_pending':    len(self._timers),
+            'in_flight':        self._in_flight,
+            'delivered':        self._delivered,
+            'rejected':         self._rejected,
+            'retried':          self._retried,
+            'dropped':          self._dropped,
+            'dead_lettered':    self._dead_lettered,
+            'swept':            self._swept,
+            'last_lag_seconds': round(self._last_lag, 3),
+            'max_lag_seconds':  round(self._max_lag, 3),
+            'workers':          len([t for t in self._tasks if not t.done()]),
+            'circuit':          self.breaker.stats(),
+        }
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._in_flight += len(batch)
+            try:
+                await self._deliver(batch)
+            finally:
+                self._in_flight -= len(batch)
+
+    async def _deliver(self, batch):
+        events = [item['event'] for item in batch]
+        try:
+            with metrics.outbound('notification') as call, delivery_span(events):
+                if not self.breaker.allow():
+                    call.status = 'circuit_open'
+                    raise CircuitOpenError("notification is failing; not calling it for now")
+                try:
+                    async with self._session.post(self.url, json={'events': events}, headers=tracing.inject()) as resp:
+                        call.status = status = resp.status
+                        try:
+                            body = await resp.json(content_type=None)
+                        except ValueError:
+                            body = None
+                except Exception:
+                    self.breaker.record(False)
+                    raise
+                self.breaker.record(status < 500)
+            statuses = event_statuses(status, body, len(batch))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Notification batch of %s failed: %s", len(batch), e)
+            statuses = [None] * len(batch)
+
+        retry, settled = _split(batch, statuses)
+        if retry:
+            self._schedule_retry(retry)
+        now = time.time()
+        for item, status in settled:
+            if status >= 400:
+                self._rejected += 1
+            else:
+                self._delivered += 1
+            self._last_lag = now - item['enqueued_at']
+            self._max_lag = max(self._max_lag, self._last_lag)
+        _count_settled(settled, now)
+        if settled and self.es is not None:
+            await self._forget([item for item, _ in settled])
+
+    async def _forget(self, items):
+        try:
+            _check_forgotten(await self.es.bulk(operations=_forget_actions(items)), len(items))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Could not delete %s delivered notifications from %s; they will be sent again: %s",
+                           len(items), OUTBOX_INDEX, e)
+
+    async def sweep(self):
+        """NotificationOutbox.sweep for the AsyncElasticsearch client."""
+        cutoff = _stamp(self.sweep_age)
+        swept, after = 0, None
+        while True:
+            try:
+                res = await self.es.search(index=OUTBOX_INDEX, query=_sweep_query(cutoff),
+                                           sort=[{'created_at': 'asc'}], size=SWEEP_PAGE_SIZE,
+                                           search_after=after, seq_no_primary_term=True)
+            except NotFoundError:
+                return swept
+            page = res['hits']['hits']
+            hits = page
+            if hits:
+                senders = sorted({hit['_source'].get('sender') for hit in hits if hit['_source'].get('sender')})
+                if senders:
+                    hits = _settled_hits(hits, await self.es.mget(index=self.card_index, ids=senders))
+            if hits:
+                for item in _claimed_items(hits, await self.es.bulk(operations=_claim_actions(hits))):
+                    # Waits for room: these events are already stored
+                    await self._queue.put(item)
+                    metrics.OUTBOX_DEPTH.inc()
+                    swept += 1
+            if len(page) < SWEEP_PAGE_SIZE:
+                break
+            after = page[-1]['sort']
+        if swept:
+            self._swept += swept
+            metrics.OUTBOX_EVENTS.labels('swept').inc(swept)
+            logger.info("Queued %s undelivered notifications from %s", swept, OUTBOX_INDEX)
+        return swept
+
+    async def _sweeper(self):
+        delay = self.backoff_base
+        while True:
+            try:
+                await self.sweep()
+                delay, pause = self.backoff_base, self.sweep_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Notification outbox sweep failed: %s", e)
+                delay, pause = min(self.backoff_max, delay * 2), delay
+            await asyncio.sleep(pause)
+
+    def _schedule_retry(self, batch):
+        loop = asyncio.get_running_loop()
+        for item in batch:
+            item['attempts'] += 1
+            if item['attempts'] > self.max_retries:
+                self._dead_lettered += 1
+                metrics.OUTBOX_DEPTH.dec()
+                metrics.OUTBOX_EVENTS.labels('dead_lettered').inc()
+                logger.error("Giving up on notification for transaction %s after %s retries",
+                             item['event'].get('trans_id'), self.max_retries)
+                continue
+            delay = min(self.backoff_max, self.backoff_base * (2 ** (item['attempts'] - 1)))
+            delay *= random.uniform(0.5, 1.0)
+            self._retried += 1
+            metrics.OUTBOX_EVENTS.labels('retried').inc()
+            handle = loop.call_later(delay, self._requeue, item)
+            self._timers.add(handle)
+            item['timer'] = handle
+
+    def _requeue(self, item):
+        self._timers.discard(item.pop('timer', None))
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self._dropped += 1
+            metrics.OUTBOX_DEPTH.dec()
+            metrics.OUTBOX_EVENTS.labels('dropped').inc()
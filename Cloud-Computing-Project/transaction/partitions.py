@@ -0,0 +1,107 @@
+"""
+Maintenance for the monthly transaction partitions (see transaction_index.py).
+
+    python partitions.py list
+    python partitions.py seal [--grace-days 1] [--dry-run]
+
+`seal` finds partitions whose month ended more than --grace-days ago and:
+- blocks writes to them;
+- force-merges them down to one segment;
+- records that in the mapping `_meta`, so later runs skip them.
+
+The pre-partitioning archive index gets the same treatment once no new
+transaction can land in it. Sealed partitions stay searchable. With one
+segment, each shard answers a sorted history query from a single segment.
+
+Safe to run repeatedly; the k8s CronJob runs it nightly.
+"""
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime, timedelta
+from elasticsearch import Elasticsearch
+from transaction_index import TRANSACTION_ALIAS, partition_bounds
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+FORCEMERGE_TIMEOUT = int(os.getenv('PARTITION_FORCEMERGE_TIMEOUT', 3600))
+
+
+def describe(es, alias=TRANSACTION_ALIAS):
+    """One row per index behind the alias, oldest first."""
+    mappings = es.indices.get_mapping(index=alias)
+    stats = es.indices.stats(index=alias, metric=['docs', 'store', 'segments'])['indices']
+    rows = []
+    for index in mappings:
+        bounds = partition_bounds(index)
+        total = stats.get(index, {}).get('primaries', {})
+        rows.append({
+            'index':    index,
+            'start':    bounds[0] if bounds else None,
+            'end':      bounds[1] if bounds else None,
+            'docs':     total.get('docs', {}).get('count', 0),
+            'bytes':    total.get('store', {}).get('size_in_bytes', 0),
+            'segments': total.get('segments', {}).get('count', 0),
+            'sealed':   bool(mappings[index]['mappings'].get('_meta', {}).get('sealed_at')),
+        })
+    return sorted(rows, key=lambda r: (r['start'] is not None, r['start'] or datetime.min))
+
+
+def to_seal(rows, now, grace):
+    """Partitions whose month is over (plus grace), and the archive once partitions took over."""
+    cutoff = now - grace
+    partitions = [r for r in rows if r['start'] is not None]
+    archive_closed = bool(partitions) and partitions[0]['start'] < cutoff
+    return [
+        r for r in rows
+        if not r['sealed'] and ((r['end'] is not None and r['end'] <= cutoff) or (r['start'] is None and archive_closed))
+    ]
+
+
+def seal(es, index):
+    logger.info("Sealing %s", index)
+    es.indices.put_settings(index=index, settings={'index.blocks.write': True})
+    es.options(request_timeout=FORCEMERGE_TIMEOUT).indices.forcemerge(index=index, max_num_segments=1)
+    es.indices.put_mapping(index=index, meta={'sealed_at': datetime.utcnow().isoformat() + 'Z'})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', choices=['list', 'seal'])
+    parser.add_argument('--grace-days', type=float, default=1.0,
+                        help='how long after a month ends before its partition is sealed')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args(argv)
+
+    es = Elasticsearch(
+        [f"http://{os.getenv('ES_HOST')}:{os.getenv('ES_PORT')}"],
+        basic_auth=(os.getenv('ELASTIC_USERNAME'), os.getenv('ELASTIC_PASSWORD'))
+    )
+    rows = describe(es)
+    if args.command == 'list':
+        print(f"{'index':<32} {'docs':>10} {'MB':>9} {'segments':>9}  sealed")
+        for r in rows:
+            print(f"{r['index']:<32} {r['docs']:>10} {r['bytes'] / 1e6:>9.1f} {r['segments']:>9}  {r['sealed']}")
+        return
+
+    pending = to_seal(rows, datetime.utcnow(), timedelta(days=args.grace_days))
+    if not pending:
+        logger.info("Nothing to seal")
+    for r in pending:
+        if args.dry_run:
+            logger.info("Would seal %s (%s docs, %s segments)", r['index'], r['docs'], r['segments'])
+            continue
+        try:
+            seal(es, r['index'])
+        except Exception as e:
+            logger.error("Failed to seal %s: %s", r['index'], e)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
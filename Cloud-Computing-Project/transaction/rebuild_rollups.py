@@ -0,0 +1,155 @@
+"""
+Recompute the user_rollups projection from the transactions (see
+user_rollups.py), or check that it still matches them.
+
+    python rebuild_rollups.py [--batch-size 100]
+    python rebuild_rollups.py --check
+
+Users are the ids of the cards index, taken one at a time within batches:
+
+1. Read the user's current hour documents with their seq_no (the
+   projection is refreshed first), then refresh the transaction indices
+   so every transfer counted in them is searchable.
+2. Recompute the user's hours from their history, the same records
+   GET /transactions/<username> returns.
+3. Rebuild: write each hour back only if the stored document is still the
+   one read in step 1 (if_seq_no, or create for a new hour), and delete
+   hours the history no longer has the same way. A transfer that changed
+   any of them in the meantime makes that user go round again.
+   Check: compare with the stored hours, amounts to the cent, and look at
+   a difference again before reporting it.
+4. Rebuild only: record `rebuilt_at` in the projection mapping; reporting
+   serves ranges from it within TRANSACTION_LAYOUT_CHECK_INTERVAL seconds.
+
+Safe to re-run while the services keep updating the projection. --check
+exits 1 when any user's hours do not match.
+"""
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime
+from elasticsearch import Elasticsearch
+from transaction_index import TRANSACTION_ALIAS, HISTORY_INDEX, ensure_transaction_index, ensure_history_index
+from history import iter_history
+from backfill_history import scan
+from user_stats import stats_entries
+from user_rollups import ROLLUP_INDEX, ensure_rollup_index, rollups_of
+from rebuild_user_stats import differences, CARD_INDEX, MAX_ATTEMPTS
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def compute(es, username):
+    """{_id: document} of the user's hours, folded from their history."""
+    return rollups_of([(owner, entry) for tx in iter_history(es, username, page_size=1000)
+                       for owner, entry in stats_entries(tx['trans_id'], tx) if owner == username])
+
+
+def stored(es, username):
+    """{_id: hit} of the user's hour documents, with seq_no and primary_term."""
+    hits, after = {}, None
+    while True:
+        res = es.search(index=ROLLUP_INDEX, routing=username, size=1000, sort=['_doc'],
+                        query={'bool': {'filter': [{'term': {'username': username}}]}},
+                        seq_no_primary_term=True, search_after=after)
+        page = res['hits']['hits']
+        hits.update((hit['_id'], hit) for hit in page)
+        if len(page) < 1000:
+            return hits
+        after = page[-1]['sort']
+
+
+def _pass(es, username, check):
+    """One read-refresh-recompute round for a user; returns (retry, mismatched hour ids)."""
+    es.indices.refresh(index=ROLLUP_INDEX)
+    current = stored(es, username)
+    es.indices.refresh(index=[TRANSACTION_ALIAS, HISTORY_INDEX], ignore_unavailable=True)
+    computed = compute(es, username)
+
+    if check:
+        mismatched = sorted(doc_id for doc_id in set(current) | set(computed)
+                            if doc_id not in current or doc_id not in computed
+                            or differences(current[doc_id]['_source'], computed[doc_id]))
+        return bool(mismatched), mismatched
+
+    actions = []
+    for doc_id, doc in computed.items():
+        hit = current.get(doc_id)
+        if hit is None:
+            actions += [{'create': {'_index': ROLLUP_INDEX, '_id': doc_id, 'routing': username}}, doc]
+        elif differences(hit['_source'], doc):
+            actions += [{'index': {'_index': ROLLUP_INDEX, '_id': doc_id, 'routing': username,
+                                   'if_seq_no': hit['_seq_no'], 'if_primary_term': hit['_primary_term']}}, doc]
+    for doc_id in set(current) - set(computed):
+        hit = current[doc_id]
+        actions.append({'delete': {'_index': ROLLUP_INDEX, '_id': doc_id, 'routing': username,
+                                   'if_seq_no': hit['_seq_no'], 'if_primary_term': hit['_primary_term']}})
+    retry = False
+    if actions:
+        for item in es.bulk(operations=actions)['items']:
+            result = list(item.values())[0]
+            if result.get('status') == 409:
+                retry = True
+            elif result.get('status', 500) >= 300:
+                raise RuntimeError(f"Rollup write failed: {result}")
+    return retry, []
+
+
+def rebuild(es, batch_size=100, check=False):
+    if not check:
+        ensure_transaction_index(es)
+        ensure_history_index(es)
+        ensure_rollup_index(es)
+    users = [hit['_id'] for hit in scan(es, CARD_INDEX, 1000)]
+    logger.info("%s %s for %s users", 'Checking' if check else 'Rebuilding', ROLLUP_INDEX, len(users))
+
+    mismatched = {}
+    for done, username in enumerate(users, 1):
+        for _ in range(MAX_ATTEMPTS):
+            retry, hours = _pass(es, username, check)
+            if not retry:
+                break
+        if retry and not check:
+            raise RuntimeError(f"Rollups of {username} kept changing; try again")
+        if hours:
+            mismatched[username] = hours
+        if done % batch_size == 0 or done == len(users):
+            logger.info("%s/%s users", done, len(users))
+
+    if check:
+        for username, hours in sorted(mismatched.items()):
+            logger.warning("%s: %s hours differ, first %s", username, len(hours), hours[0])
+        logger.info("%s of %s users do not match", len(mismatched), len(users))
+        return not mismatched
+
+    es.indices.put_mapping(index=ROLLUP_INDEX, meta={'rebuilt_at': datetime.utcnow().isoformat() + 'Z'})
+    logger.info("%s is complete; ranged reports switch to it", ROLLUP_INDEX)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--batch-size', type=int, default=100, help='users between progress lines')
+    parser.add_argument('--check', action='store_true', help='compare only; exit 1 on any mismatch')
+    args = parser.parse_args(argv)
+
+    es = Elasticsearch(
+        [f"http://{os.getenv('ES_HOST')}:{os.getenv('ES_PORT')}"],
+        basic_auth=(os.getenv('ELASTIC_USERNAME'), os.getenv('ELASTIC_PASSWORD'))
+    )
+    try:
+        matches = rebuild(es, batch_size=args.batch_size, check=args.check)
+    except Exception as e:
+        logger.error("Rebuild failed: %s", e)
+        sys.exit(1)
+    if not matches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Recompute the user_stats projection from the transactions (see
+user_stats.py), or check that it still matches them.
+
+    python rebuild_user_stats.py [--batch-size 100]
+    python rebuild_user_stats.py --check
+
+Users are the ids of the cards index, taken in batches:
+
+1. Read the batch's current stats documents (a realtime mget), then
+   refresh the transaction indices so every transfer counted in them is
+   searchable.
+2. Recompute each user's document from their history, the same records
+   GET /transactions/<username> returns.
+3. Rebuild: write it back only if the stored document is still the one
+   read in step 1 (if_seq_no, or create for a new one). A transfer that
+   changed it in the meantime makes that user go round again.
+   Check: compare it with the stored document, amounts to the cent. A
+   difference is looked at again before it is reported, since a live
+   transfer can land between the read and the refresh.
+4. Rebuild only: record `rebuilt_at` in the projection mapping. Running
+   reporting pods pick it up within TRANSACTION_LAYOUT_CHECK_INTERVAL
+   seconds and start serving reports from it.
+
+Safe to re-run while the services keep updating the projection. --check
+exits 1 when any user's document does not match.
+"""
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime
+from elasticsearch import Elasticsearch
+from transaction_index import TRANSACTION_ALIAS, HISTORY_INDEX, ensure_transaction_index, ensure_history_index
+from history import iter_history
+from backfill_history import scan
+from user_stats import USER_STATS_INDEX, ensure_user_stats_index, empty_stats, stats_entries, record
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+CARD_INDEX   = 'cards'
+MAX_ATTEMPTS = 5
+
+
+def compute(es, username):
+    """The user's stats document, folded from their history."""
+    entries = [entry for tx in iter_history(es, username, page_size=1000)
+               for owner, entry in stats_entries(tx['trans_id'], tx) if owner == username]
+    return record(empty_stats(username), entries)
+
+
+def _rounded(value):
+    if isinstance(value, float):
+        return round(value, 2)
+    if isinstance(value, dict):
+        return {k: _rounded(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_rounded(v) for v in value]
+    return value
+
+
+def differences(stored, computed):
+    """Top-level fields whose values differ, amounts compared to the cent."""
+    stored, computed = _rounded(stored or {}), _rounded(computed)
+    return sorted(name for name in computed if stored.get(name) != computed[name])
+
+
+def _pass(es, usernames, check):
+    """One read-refresh-recompute round; returns the users to look at again and the mismatches."""
+    docs = es.mget(index=USER_STATS_INDEX, ids=usernames)['docs']
+    es.indices.refresh(index=[TRANSACTION_ALIAS, HISTORY_INDEX], ignore_unavailable=True)
+    retry, mismatched, actions = [], {}, []
+    for doc in docs:
+        username = doc['_id']
+        computed = compute(es, username)
+        stored = doc['_source'] if doc.get('found') else None
+        if check:
+            diff = differences(stored, computed)
+            if diff:
+                retry.append(username)
+                mismatched[username] = diff
+        elif stored is None:
+            actions += [{'create': {'_index': USER_STATS_INDEX, '_id': username}}, computed]
+        else:
+            actions += [{'index': {'_index': USER_STATS_INDEX, '_id': username,
+                                   'if_seq_no': doc['_seq_no'], 'if_primary_term': doc['_primary_term']}},
+                        computed]
+    if actions:
+        for item in es.bulk(operations=actions)['items']:
+            result = list(item.values())[0]
+            if result.get('status') == 409:
+                retry.append(result['_id'])
+            elif result.get('status', 500) >= 300:
+                raise RuntimeError(f"Stats write failed: {result}")
+    return retry, mismatched
+
+
+def rebuild(es, batch_size=100, check=False):
+    if not check:
+        ensure_transaction_index(es)
+        ensure_history_index(es)
+        ensure_user_stats_index(es)
+    users = [hit['_id'] for hit in scan(es, CARD_INDEX, 1000)]
+    logger.info("%s %s for %s users", 'Checking' if check else 'Rebuilding', USER_STATS_INDEX, len(users))
+
+    done, mismatched = 0, {}
+    for start in range(0, len(users), batch_size):
+        pending = users[start:start + batch_size]
+        for _ in range(MAX_ATTEMPTS):
+            pending, mismatched_now = _pass(es, pending, check)
+            if not pending:
+                break
+        if pending and not check:
+            raise RuntimeError(f"Stats of {pending} kept changing; try again")
+        mismatched.update(mismatched_now)
+        done += len(users[start:start + batch_size])
+        logger.info("%s/%s users", done, len(users))
+
+    if check:
+        for username, fields in sorted(mismatched.items()):
+            logger.warning("%s: %s differ", username, ', '.join(fields))
+        logger.info("%s of %s users do not match", len(mismatched), len(users))
+        return not mismatched
+
+    es.indices.put_mapping(index=USER_STATS_INDEX, meta={'rebuilt_at': datetime.utcnow().isoformat() + 'Z'})
+    logger.info("%s is complete; reports switch to it", USER_STATS_INDEX)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--check', action='store_true', help='compare only; exit 1 on any mismatch')
+    args = parser.parse_args(argv)
+
+    es = Elasticsearch(
+        [f"http://{os.getenv('ES_HOST')}:{os.getenv('ES_PORT')}"],
+        basic_auth=(os.getenv('ELASTIC_USERNAME'), os.getenv('ELASTIC_PASSWORD'))
+    )
+    try:
+        matches = rebuild(es, batch_size=args.batch_size, check=args.check)
+    except Exception as e:
+        logger.error("Rebuild failed: %s", e)
+        sys.exit(1)
+    if not matches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
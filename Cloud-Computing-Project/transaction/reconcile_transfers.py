@@ -0,0 +1,192 @@
+"""
+Settle transfers left pending on the sender's card (see transfer_engine.py).
+
+    python reconcile_transfers.py [--grace 600] [--batch-size 500]
+
+A debit records each transfer in the sender card's `pending` list and the
+bulk request that credits the receiver and writes the audit record clears
+it. When that bulk request raises, the service cannot tell whether it
+landed, so the entry stays. For every entry older than --grace seconds:
+
+1. Refresh the transaction indices and look the audit records up.
+2. A transfer with no audit record may still have been credited: ES can
+   apply some items of a bulk request that raised. Each transfer credit
+   leaves its id in the receiver card's `credits` (see
+   transfer_engine.TRANSFER_CREDIT_SCRIPT), so the receivers are read too.
+3. A completed audit or a credit trace means the money reached the
+   receiver: the entry is dropped. Any other outcome means it did not: the
+   sender is refunded and the entry dropped, in one scripted update that
+   only refunds entries still on the card, so a re-run never refunds twice.
+4. Transfers with no audit record at all get one, completed if they were
+   credited and failed otherwise, with their history copies, rollups and
+   user_stats.
+5. Stored notification events announcing a refunded transfer as completed
+   are deleted (see notification_outbox.py); the outbox sweeper delivers
+   the others once their entries are gone.
+
+Traces are kept for TRANSFER_CREDIT_TRACE_TTL seconds. An entry older than
+that with no audit record cannot be decided and is left pending with an
+error. Safe to re-run. What it cannot repair, and logs from the services
+instead: a bulk request that lands more than --grace seconds after it was
+sent, and a rollback whose refund was lost while the audit record
+completed. Where a raised bulk applied some of its user_stats or rollup
+updates, rebuild_user_stats.py --check and rebuild_rollups.py --check
+report the difference.
+"""
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime, timedelta
+from elasticsearch import Elasticsearch, NotFoundError
+from transaction_index import TRANSACTION_ALIAS, catalog, projection_actions
+from backfill_history import scan
+from transfer_engine import RECONCILE_SCRIPT, CREDIT_RETRY_ON_CONFLICT, trace_cutoff
+from user_stats import stats_entries, stats_actions
+from user_rollups import rollup_actions
+from notification_outbox import OUTBOX_INDEX
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+CARD_INDEX = 'cards'
+
+
+def stale_entries(es, cutoff, batch_size=500):
+    """(username, entries) of every card holding pending entries recorded before `cutoff`."""
+    for hit in scan(es, CARD_INDEX, batch_size, query={'exists': {'field': 'pending.tx'}}):
+        entries = [p for p in hit['_source'].get('pending') or [] if p['at'] < cutoff]
+        if entries:
+            yield hit['_id'], entries
+
+
+def audits(es, tx_ids):
+    """{tx_id: audit record} of the transfers that have one."""
+    res = es.search(index=TRANSACTION_ALIAS, query={'ids': {'values': tx_ids}}, size=len(tx_ids))
+    return {hit['_id']: hit['_source'] for hit in res['hits']['hits']}
+
+
+def credited(es, entries):
+    """tx ids of `entries` whose credit left its trace on the receiver card."""
+    res = es.mget(index=CARD_INDEX, ids=sorted({p['receiver'] for p in entries}))
+    traced = {c['tx'] for doc in res['docs'] if doc.get('found') for c in doc['_source'].get('credits') or []}
+    return {p['tx'] for p in entries if p['tx'] in traced}
+
+
+def audit_actions(es, sender, entry, completed):
+    """The audit record a pending transfer never got, with everything derived from it."""
+    tx_id = entry['tx']
+    audit = {
+        'sender_username':   sender,
+        'receiver_username': entry['receiver'],
+        'timestamp':         entry['at'],
+        'status':            'completed' if completed else 'failed',
+        'amount':            entry['amount']
+    }
+    if not completed:
+        audit['error'] = 'Transaction failed'
+    return ([{'create': {'_index': catalog.load(es).write_index(entry['at']), '_id': tx_id}}, audit]
+            + projection_actions(tx_id, audit, correction=not completed)
+            + rollup_actions(stats_entries(tx_id, audit))
+            + stats_actions(stats_entries(tx_id, audit)))
+
+
+def forget_refunded(es, owed):
+    """Delete the stored notification events announcing one of the `owed` transfers as completed."""
+    try:
+        res = es.search(index=OUTBOX_INDEX, query={'terms': {'transfers': owed}}, size=len(owed))
+    except NotFoundError:
+        return
+    ids = []
+    for hit in res['hits']['hits']:
+        event = hit['_source']['event']
+        announced = event['items'] if event.get('status') == 'batch' else [event]
+        if any(e['trans_id'] in owed and e['status'] == 'completed' for e in announced):
+            ids.append(hit['_id'])
+    if ids:
+        res = es.bulk(operations=[{'delete': {'_index': OUTBOX_INDEX, '_id': doc_id}} for doc_id in ids])
+        if res.get('errors'):
+            logger.error("Failed to delete notifications %s of refunded transfers: %s", ids, res['items'])
+
+
+def settle(es, sender, entries, traced_since):
+    """Refund what `sender` is owed for `entries`; returns the number of transfers refunded."""
+    found = audits(es, [p['tx'] for p in entries])
+    missing = [p for p in entries if p['tx'] not in found]
+    landed = credited(es, missing) if missing else set()
+    undecided = [p['tx'] for p in missing if p['tx'] not in landed and p['at'] < traced_since]
+    if undecided:
+        logger.error("Cannot tell whether transfers %s of %s were credited; their traces have expired, "
+                     "left pending", undecided, sender)
+        entries = [p for p in entries if p['tx'] not in undecided]
+        missing = [p for p in missing if p['tx'] not in undecided]
+        if not entries:
+            return 0
+    ids = [p['tx'] for p in entries]
+    owed = [tx_id for tx_id in ids
+            if tx_id not in landed and found.get(tx_id, {}).get('status') != 'completed']
+    # Before the entries go: until then the outbox sweeper leaves these events alone
+    if owed:
+        forget_refunded(es, owed)
+    res = es.update(index=CARD_INDEX, id=sender, retry_on_conflict=CREDIT_RETRY_ON_CONFLICT,
+                    script={'source': RECONCILE_SCRIPT, 'lang': 'painless',
+                            'params': {'ids': ids, 'owed': owed}})
+    if res.get('result') != 'updated':
+        return 0
+
+    actions = [action for p in missing for action in audit_actions(es, sender, p, p['tx'] in landed)]
+    if actions:
+        res = es.bulk(operations=actions)
+        for item in res['items']:
+            (op, result), = item.items()
+            # 409: the audit record landed after all, and the refund above stands;
+            # 404: there was no receiver history copy to delete
+            if result.get('status', 500) >= 300 and result.get('status') != 409 \
+                    and not (op == 'delete' and result.get('status') == 404):
+                logger.error("Failed to record pending transfer for %s: %s", sender, result)
+    for tx_id in landed:
+        logger.info("Transfer %s of %s was credited; recorded it as completed", tx_id, sender)
+    for tx_id in owed:
+        logger.info("Refunded %s for pending transfer %s", sender, tx_id)
+    return len(owed)
+
+
+def reconcile(es, grace=600, batch_size=500):
+    if not es.indices.exists(index=CARD_INDEX):
+        logger.info("No cards yet; nothing to reconcile")
+        return 0
+    cutoff = (datetime.utcnow() - timedelta(seconds=grace)).isoformat() + 'Z'
+    stale = list(stale_entries(es, cutoff, batch_size))
+    logger.info("%s pending transfers older than %ss on %s cards",
+                sum(len(entries) for _, entries in stale), grace, len(stale))
+    if not stale:
+        return 0
+    es.indices.refresh(index=TRANSACTION_ALIAS, ignore_unavailable=True)
+    traced_since = trace_cutoff()
+    refunded = sum(settle(es, sender, entries, traced_since) for sender, entries in stale)
+    logger.info("Refunded %s transfers", refunded)
+    return refunded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--grace', type=int, default=600, help='seconds a transfer may stay pending')
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args(argv)
+
+    es = Elasticsearch(
+        [f"http://{os.getenv('ES_HOST')}:{os.getenv('ES_PORT')}"],
+        basic_auth=(os.getenv('ELASTIC_USERNAME'), os.getenv('ELASTIC_PASSWORD'))
+    )
+    try:
+        reconcile(es, grace=args.grace, batch_size=args.batch_size)
+    except Exception as e:
+        logger.error("Reconcile failed: %s", e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
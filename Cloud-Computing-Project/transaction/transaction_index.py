@@ -0,0 +1,370 @@
+import os
+import re
+import time
+import logging
+import threading
+from datetime import datetime
+from elasticsearch import BadRequestError
+
+logger = logging.getLogger(__name__)
+
+# Services read through this alias; every index behind it is versioned so
+# the mapping can change with a reindex (see migrate_index.py)
+TRANSACTION_ALIAS   = 'transactions'
+TRANSACTION_VERSION = 2
+
+# New transactions go to one partition per calendar month, named after
+# the audit timestamp and created on demand from the index template
+PARTITION_PREFIX  = f'{TRANSACTION_ALIAS}-v{TRANSACTION_VERSION}-'
+PARTITION_PATTERN = re.compile(r'^' + re.escape(TRANSACTION_ALIAS) + r'-v\d+-(\d{4})\.(\d{2})$')
+TEMPLATE_NAME     = f'{TRANSACTION_ALIAS}-partitions'
+
+# Per-user copy of every visible transaction, routed by its owner so one
+# user's history lives on a single shard
+HISTORY_INDEX = 'transaction-history'
+
+# Fields that used to be dynamic text with a `.keyword` sub-field
+KEYWORD_FIELDS = ('sender_username', 'receiver_username', 'status', 'batch_id')
+
+TRANSACTION_MAPPINGS = {
+    # Unknown fields stay in _source but are not indexed
+    'dynamic': False,
+    'properties': {
+        'sender_username':   {'type': 'keyword'},
+        'receiver_username': {'type': 'keyword'},
+        'status':            {'type': 'keyword'},
+        'batch_id':          {'type': 'keyword'},
+        'timestamp':         {'type': 'date'},
+        # Cents are exact; scaled_float packs far smaller than double
+        'amount':            {'type': 'scaled_float', 'scaling_factor': 100},
+        # Shown to users, never searched
+        'error':             {'type': 'text', 'index': False}
+    }
+}
+
+HISTORY_MAPPINGS = {
+    'dynamic': False,
+    '_routing': {'required': True},
+    'properties': dict(
+        TRANSACTION_MAPPINGS['properties'],
+        owner={'type': 'keyword'},
+        trans_id={'type': 'keyword'}
+    )
+}
+
+# How often a service re-reads which indices are behind the alias
+LAYOUT_CHECK_INTERVAL = float(os.getenv('TRANSACTION_LAYOUT_CHECK_INTERVAL', 30))
+
+
+def versioned_name(version=TRANSACTION_VERSION):
+    return f'{TRANSACTION_ALIAS}-v{version}'
+
+
+def transaction_settings():
+    return {
+        'index': {
+            # Audit records are read back by id (realtime) far more often than
+            # searched, so trade a little history freshness for fewer segments
+            'refresh_interval': os.getenv('TRANSACTION_REFRESH_INTERVAL', '5s'),
+            'number_of_shards': int(os.getenv('TRANSACTION_SHARDS', 1)),
+        }
+    }
+
+
+def history_settings():
+    return {
+        'index': {
+            'refresh_interval': os.getenv('TRANSACTION_REFRESH_INTERVAL', '5s'),
+            # Routing keeps each user on one shard, so shards only spread load
+            'number_of_shards': int(os.getenv('HISTORY_SHARDS', 3)),
+        }
+    }
+
+
+def partition_name(timestamp):
+    """Partition for an ISO timestamp ('2024-05-01T...') or a datetime."""
+    if isinstance(timestamp, datetime):
+        return f'{PARTITION_PREFIX}{timestamp:%Y.%m}'
+    return PARTITION_PREFIX + timestamp[:7].replace('-', '.')
+
+
+def partition_bounds(index):
+    """[start, end) of a monthly partition, or None for any other index."""
+    match = PARTITION_PATTERN.match(index)
+    if not match:
+        return None
+    year, month = int(match.group(1)), int(match.group(2))
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return datetime(year, month, 1), end
+
+
+def previous_month(moment):
+    return datetime(moment.year - 1, 12, 1) if moment.month == 1 else datetime(moment.year, moment.month - 1, 1)
+
+
+def index_template():
+    return {
+        'index_patterns': [PARTITION_PREFIX + '*'],
+        'priority': 100,
+        'template': {
+            'settings': transaction_settings(),
+            'mappings': TRANSACTION_MAPPINGS,
+            'aliases':  {TRANSACTION_ALIAS: {}}
+        }
+    }
+
+
+def ensure_transaction_index(es):
+    """
+    Bootstrap step: install the partition template and make sure the current
+    month exists, so the alias resolves before the first write. An existing
+    legacy `transactions` index is left alone until migrate_index.py moves it.
+    """
+    es.indices.put_index_template(name=TEMPLATE_NAME, **index_template())
+    if es.indices.exists(index=TRANSACTION_ALIAS) and not es.indices.exists_alias(name=TRANSACTION_ALIAS):
+        _warn_legacy()
+        return
+    current = partition_name(datetime.utcnow())
+    if not es.indices.exists(index=current):
+        try:
+            es.indices.create(index=current)
+            logger.info("Created transaction partition %s", current)
+        except BadRequestError as e:
+            if e.error != 'resource_already_exists_exception':
+                raise
+    # Fields added since a partition was created (adding fields is always allowed)
+    es.indices.put_mapping(index=TRANSACTION_ALIAS, properties=TRANSACTION_MAPPINGS['properties'])
+
+
+async def ensure_transaction_index_async(es):
+    """ensure_transaction_index for an AsyncElasticsearch client."""
+    await es.indices.put_index_template(name=TEMPLATE_NAME, **index_template())
+    if await es.indices.exists(index=TRANSACTION_ALIAS) and not await es.indices.exists_alias(name=TRANSACTION_ALIAS):
+        _warn_legacy()
+        return
+    current = partition_name(datetime.utcnow())
+    if not await es.indices.exists(index=current):
+        try:
+            await es.indices.create(index=current)
+            logger.info("Created transaction partition %s", current)
+        except BadRequestError as e:
+            if e.error != 'resource_already_exists_exception':
+                raise
+    await es.indices.put_mapping(index=TRANSACTION_ALIAS, properties=TRANSACTION_MAPPINGS['properties'])
+
+
+def ensure_history_index(es):
+    """
+    Bootstrap step: create the per-user history projection. On a cluster with
+    no transactions yet it is complete from the start; otherwise reads keep
+    using the transactions alias until backfill_history.py has filled it.
+    """
+    if es.indices.exists(index=HISTORY_INDEX):
+        return
+    meta = {}
+    if not es.indices.exists(index=TRANSACTION_ALIAS) or es.count(index=TRANSACTION_ALIAS)['count'] == 0:
+        meta['backfilled_at'] = datetime.utcnow().isoformat() + 'Z'
+    try:
+        es.indices.create(index=HISTORY_INDEX, settings=history_settings(),
+                          mappings=dict(HISTORY_MAPPINGS, _meta=meta))
+        logger.info("Created history projection %s", HISTORY_INDEX)
+    except BadRequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+
+async def ensure_history_index_async(es):
+    """ensure_history_index for an AsyncElasticsearch client."""
+    if await es.indices.exists(index=HISTORY_INDEX):
+        return
+    meta = {}
+    if not await es.indices.exists(index=TRANSACTION_ALIAS) or (await es.count(index=TRANSACTION_ALIAS))['count'] == 0:
+        meta['backfilled_at'] = datetime.utcnow().isoformat() + 'Z'
+    try:
+        await es.indices.create(index=HISTORY_INDEX, settings=history_settings(),
+                                mappings=dict(HISTORY_MAPPINGS, _meta=meta))
+        logger.info("Created history projection %s", HISTORY_INDEX)
+    except BadRequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+
+def projection_actions(tx_id, audit, correction=False):
+    """
+    Bulk actions that mirror one audit record into the history projection:
+    a copy for the sender, and one for the receiver unless the transfer
+    failed (receivers never see failed transfers). With `correction`, a
+    failed transfer also removes a receiver copy written earlier.
+    """
+    doc = dict(audit, trans_id=tx_id)
+    sender, receiver = audit['sender_username'], audit['receiver_username']
+    actions = [
+        {'index': {'_index': HISTORY_INDEX, '_id': f'{tx_id}:{sender}', 'routing': sender}},
+        dict(doc, owner=sender)
+    ]
+    if audit.get('status') != 'failed':
+        actions += [
+            {'index': {'_index': HISTORY_INDEX, '_id': f'{tx_id}:{receiver}', 'routing': receiver}},
+            dict(doc, owner=receiver)
+        ]
+    elif correction:
+        actions.append({'delete': {'_index': HISTORY_INDEX, '_id': f'{tx_id}:{receiver}', 'routing': receiver}})
+    return actions
+
+
+def _warn_legacy():
+    logger.warning("'%s' is a dynamically mapped legacy index; run migrate_index.py to move it to %s",
+                   TRANSACTION_ALIAS, versioned_name())
+
+
+class IndexCatalog:
+    """
+    What is currently behind the transactions alias, refreshed every
+    LAYOUT_CHECK_INTERVAL from a single get_mapping call.
+
+    It answers four questions:
+    - where a new audit record goes: the month partition, or the legacy
+      index while one exists;
+    - which indices a time range has to read: only overlapping
+      partitions, plus any unpartitioned index;
+    - how identifier fields are queried: `status` on mapped indices,
+      `status.keyword` on a legacy dynamic one;
+    - whether the routed history projection is complete enough to serve
+      reads.
+
+    Pods pick up a migration without a restart, so a rollout may happen
+    before or after it. A new month's partition appears when its first
+    transfer is written, sooner than the next check: a write to a month
+    the catalog does not know yet makes the next load() look again, and a
+    range that reaches past the newest known partition is read through
+    the alias.
+    """
+
+    def __init__(self, alias=TRANSACTION_ALIAS, interval=LAYOUT_CHECK_INTERVAL):
+        self.alias     = alias
+        self.interval  = interval
+        self._indices  = []
+        self._legacy   = None
+        self._history  = False
+        self._checked  = 0.0
+        self._lock     = threading.Lock()
+
+    def load(self, es):
+        if self._stale():
+            try:
+                self._update(es.indices.get_mapping(index=[self.alias, HISTORY_INDEX], ignore_unavailable=True))
+            except Exception as e:
+                self._failed(e)
+        return self
+
+    async def load_async(self, es):
+        if self._stale():
+            try:
+                self._update(await es.indices.get_mapping(index=[self.alias, HISTORY_INDEX],
+                                                          ignore_unavailable=True))
+            except Exception as e:
+                self._failed(e)
+        return self
+
+    def invalidate(self):
+        self._checked = 0.0
+
+    def fields(self):
+        suffix = '.keyword' if self._legacy else ''
+        return {name: name + suffix for name in KEYWORD_FIELDS}
+
+    @property
+    def history_ready(self):
+        return self._history
+
+    def write_index(self, timestamp):
+        if self._legacy:
+            return self.alias
+        index = partition_name(timestamp)
+        if index not in self._indices:
+            # This write creates the partition; readers must see it before the next check
+            self.invalidate()
+        return index
+
+    def read_indices(self, since=None, until=None):
+        """Indices that can hold transactions in [since, until); the alias when unbounded."""
+        if self._legacy or (since is None and until is None) or not self._indices:
+            return [self.alias]
+        known_until = max((bounds[1] for bounds in map(partition_bounds, self._indices) if bounds),
+                          default=datetime.min)
+        if min(until or datetime.max, datetime.utcnow()) > known_until:
+            # Partitions created since the last check may hold part of the range
+            return [self.alias]
+        selected = []
+        for index in self._indices:
+            bounds = partition_bounds(index)
+            if bounds is None or ((since is None or bounds[1] > since) and (until is None or bounds[0] < until)):
+                selected.append(index)
+        return selected
+
+    def lookup_indices(self, now=None):
+        """Partitions a just-written transaction is in; `get` is realtime there."""
+        if self._legacy:
+            return [self.alias]
+        now = now or datetime.utcnow()
+        return [partition_name(now), partition_name(previous_month(now))]
+
+    def _stale(self):
+        return time.monotonic() - self._checked >= self.interval
+
+    def _update(self, res):
+        history = res.pop(HISTORY_INDEX, None)
+        history = bool(history and history['mappings'].get('_meta', {}).get('backfilled_at'))
+        # Only the declared mapping disables dynamic fields
+        legacy = any(str(m['mappings'].get('dynamic', 'true')).lower() != 'false' for m in res.values())
+        with self._lock:
+            if legacy != self._legacy:
+                logger.info("Transaction index layout: %s", 'legacy' if legacy else 'mapped')
+            if history and not self._history:
+                logger.info("Serving history from %s", HISTORY_INDEX)
+            self._indices = sorted(res)
+            self._legacy, self._history, self._checked = legacy, history, time.monotonic()
+
+    def _failed(self, e):
+        # Keep the last answer; before the index exists the mapped layout is right
+        logger.warning("Could not read transaction mapping: %s", e)
+        with self._lock:
+            self._checked = time.monotonic()
+
+
+# Shared by the request handlers and the history pager
+catalog = IndexCatalog()
+
+
+def find_transaction(es, trans_id):
+    """
+    Fetch a transaction by id. The two most recent partitions are read with
+    a realtime mget, so a transfer made a moment ago is found before the next
+    refresh; older ids fall back to an ids query across the alias.
+    """
+    catalog.load(es)
+    docs = es.mget(docs=[{'_index': index, '_id': trans_id} for index in catalog.lookup_indices()])['docs']
+    found = _first_found(docs)
+    if found is None:
+        found = _first_hit(es.search(index=catalog.alias, query={'ids': {'values': [trans_id]}}, size=1))
+    return found
+
+
+async def find_transaction_async(es, trans_id):
+    """find_transaction for an AsyncElasticsearch client."""
+    await catalog.load_async(es)
+    docs = (await es.mget(docs=[{'_index': index, '_id': trans_id} for index in catalog.lookup_indices()]))['docs']
+    found = _first_found(docs)
+    if found is None:
+        found = _first_hit(await es.search(index=catalog.alias, query={'ids': {'values': [trans_id]}}, size=1))
+    return found
+
+
+def _first_found(docs):
+    # A partition that does not exist yet comes back as an error entry
+    return next((doc['_source'] for doc in docs if doc.get('found')), None)
+
+
+def _first_hit(res):
+    hits = res['hits']['hits']
+    return hits[0]['_source'] if hits else None
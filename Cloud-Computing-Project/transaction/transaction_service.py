@@ -1,22 +1,43 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import os
+import json
 import uuid
 from datetime import datetime
-import requests
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from elasticsearch import Elasticsearch, NotFoundError
 from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity
 from flask_cors import CORS
-import hashlib
+from common import lifecycle, log, metrics, tracing, compression
+from common.bootstrap import Bootstrap, bootstrap_required, register_health_routes
+from common.card_cache import CardCache
+from common.es_client import ProcessLocalClient
+from notification_outbox import NotificationOutbox, ensure_outbox_index, outbox_actions
+from transfer_engine import (
+    check_transfer, fetch_versioned_cards, execute_transfer, execute_batch, log_balances,
+    TransferError, InsufficientBalance, TransferConflict, TransferPending
+)
+from idempotency import IdempotencyStore, idempotent, money_may_move, IDEMPOTENCY_MAPPINGS
+from transaction_index import (
+    ensure_transaction_index, ensure_history_index, projection_actions, catalog, find_transaction
+)
+from user_stats import ensure_user_stats_index, stats_entries, stats_actions
+from user_rollups import ensure_rollup_index, rollup_actions
+from history import (
+    fetch_page, iter_history, parse_range, InvalidCursor, HISTORY_PAGE_SIZE, HISTORY_MAX_LIMIT
+)
 
 # ─── LOGGING CONFIG ───────────────────────────────────────────────────────────
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(levelname)s - %(message)s'
-)
+# JSON lines, formatted and written off the request thread (see common/log.py)
+log.configure('transaction')
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
+log.init_app(app)
+metrics.init_app(app)
+tracing.init_app(app, 'transaction')
+compression.init_app(app)
 
 # ─── CORS CONFIG ─────────────────────────────────────────────────────────────
 CORS(app, resources={
@@ -39,72 +60,105 @@ ES_HOST = os.getenv('ES_HOST')
 ES_PORT = os.getenv('ES_PORT')
 ES_USERNAME = os.getenv('ELASTIC_USERNAME')
 ES_PASSWORD = os.getenv('ELASTIC_PASSWORD')
-try:
-    es = Elasticsearch(
-        [f'http://{ES_HOST}:{ES_PORT}'],
-        basic_auth=(ES_USERNAME, ES_PASSWORD)
-    )
-    # Test the connection
-    if not es.ping():
-        logger.error(f"Failed to connect to Elasticsearch at {ES_HOST}:{ES_PORT}")
-        raise ConnectionError("Elasticsearch connection failed")
-    logger.info(f"Successfully connected to Elasticsearch at {ES_HOST}:{ES_PORT}")
-except Exception as e:
-    logger.error(f"Failed to initialize Elasticsearch client: {str(e)}")
-    raise
+# One client per process, created on first use (safe to fork). Nothing
+# talks to ES at import time; see the bootstrap below.
+es = ProcessLocalClient(lambda: Elasticsearch(
+    [f'http://{ES_HOST}:{ES_PORT}'],
+    basic_auth=(ES_USERNAME, ES_PASSWORD)
+))
 
 # ─── INDEX SETUP ───────────────────────────────────────────────────────────────
 CARD_INDEX        = 'cards'
-TRANSACTION_INDEX = 'transactions'
-if not es.indices.exists(index=TRANSACTION_INDEX):
-    logger.info(f"Creating transaction index: {TRANSACTION_INDEX}")
-    es.indices.create(index=TRANSACTION_INDEX)
+IDEMPOTENCY_INDEX = 'idempotency_keys'
+
+# Largest payout accepted by POST /transactions/batch
+BATCH_MAX_TRANSFERS = int(os.getenv('BATCH_MAX_TRANSFERS', 500))
+
+# Extra balance reads around each transfer, for debugging only
+LOG_TRANSFER_BALANCES = os.getenv('LOG_TRANSFER_BALANCES', 'false').lower() == 'true'
+
+# Indices are created in the background once ES is reachable
+bootstrap = Bootstrap(es, 'transaction', started_at=STARTED_AT)
+bootstrap.step(ensure_transaction_index)
+bootstrap.step(ensure_history_index)
+bootstrap.step(ensure_user_stats_index)
+bootstrap.step(ensure_rollup_index)
+bootstrap.step(ensure_outbox_index)
+bootstrap.ensure_index(IDEMPOTENCY_INDEX, mappings=IDEMPOTENCY_MAPPINGS)
+
+# Idempotency-Key records for POST /transactions and /transactions/batch
+idempotency = IdempotencyStore.from_env(es, IDEMPOTENCY_INDEX)
 
 # ─── NOTIFICATION SERVICE ────────────────────────────────────────────────────
 NOTIFY_URL = os.getenv('NOTIFY_URL')
+NOTIFY_BATCH_URL = os.getenv('NOTIFY_BATCH_URL', f'{NOTIFY_URL}/batch')
 SERVICE_SECRET = os.getenv('SERVICE_SECRET')
 
-def notify_transaction(tx, sdoc, rdoc, amt, status, reason):
-    payload = {
+# Notifications are stored with the audit records they announce (see
+# outbox_actions) and delivered off the request path by the outbox dispatchers.
+outbox = NotificationOutbox.from_env(NOTIFY_BATCH_URL, {
+    'X-Service-Token': SERVICE_SECRET,
+    'Content-Type':  'application/json'
+}, es=es, card_index=CARD_INDEX)
+lifecycle.on_shutdown(outbox.close)
+
+def transaction_event(tx, sdoc, rdoc, amt, status, reason):
+    return {
         'trans_id':          tx,
         'sender_doc':        sdoc,
         'receiver_doc':      rdoc,
         'amount':            amt,
         'status':            status,
         'reason':            reason
-    }   
-    headers = {
-        'X-Service-Token': SERVICE_SECRET,
-        'Content-Type':  'application/json'
     }
+
+def batch_event(batch_id, sdoc, items, cards):
+    return {
+        'trans_id':   batch_id,
+        'status':     'batch',
+        'sender_doc': sdoc,
+        'items':      [{
+            'trans_id':     item['tx_id'],
+            'receiver_doc': cards[item['receiver']][0],
+            'amount':       item['amount'],
+            'status':       item['audit']['status'],
+            'reason':       item['audit'].get('error')
+        } for item in items]
+    }
+
+def notify(event, stored=True):
+    """Queue `event`; one not `stored` with its audit records is stored on its own first."""
+    logger.debug("Queueing notification for transaction %s with status %s", event['trans_id'], event['status'])
+    if stored:
+        outbox.enqueue(event)
+    else:
+        outbox.record(event)
+
+def fetch_card(username):
     try:
-        if reason:
-            logger.info(f"Sending notification for transaction {tx} with status {status}. Reason: {reason}")
-        else:
-            logger.info(f"Sending notification for transaction {tx} with status {status}")
-        requests.post(NOTIFY_URL, json=payload, headers=headers, timeout=5)
-        logger.info(f"Successfully sent notification for transaction {tx}")
-    except Exception as e:
-        logger.error(f"Failed to send notification for transaction {tx}: {str(e)}")
+        return es.get(index=CARD_INDEX, id=username)['_source']
+    except NotFoundError:
+        return None
+
+card_cache = CardCache.from_env(fetch_card)
 
 def username_to_phone(username):
     """
     Given a username (used as the ES doc‐ID in the cards index),
     return the associated phone number, or None if not found.
     """
-    try:
-        res = es.get(index=CARD_INDEX, id=username)
-        return res['_source'].get('phone')
-    except NotFoundError:
-        logger.warning(f"Card not found for username: {username}")
-        return None
+    phone = card_cache.get_phone(username)
+    if phone is None:
+        logger.warning("Card not found for username: %s", username)
+    return phone
 
 @app.route('/transactions', methods=['POST'])
+@bootstrap_required(bootstrap)
 @jwt_required()
+@idempotent(idempotency)
 def create_transaction():
     current_phone = get_jwt_identity()
     data = request.get_json() or {}
-    logger.info(f"Received transaction request from {current_phone}")
 
     sender   = data.get('sender_username')
     receiver = data.get('receiver_username')
@@ -114,13 +168,16 @@ def create_transaction():
     # 1) Generate tx_id & get timestamp
     tx_id     = uuid.uuid4().hex
     timestamp = datetime.utcnow().isoformat()+'Z'
-    logger.info(f"Generated transaction ID: {tx_id}")
+    log.bind_trans_id(tx_id)
+    logger.debug("Transaction request from %s", current_phone)
 
     # 2) Early validation helpers
-    def fail(msg, code=400, should_notify=True):
-        logger.warning(f"Transaction {tx_id} failed: {msg}")
-        # create a failed audit only if notification is needed
-        if should_notify:
+    def fail(msg, code=400, should_notify=True, recorded=False):
+        logger.warning("Transaction failed: %s", msg)
+        event = transaction_event(tx_id, sdoc, rdoc, amount, 'failed', msg)
+        # create a failed audit only if notification is needed; a rolled-back
+        # transfer already has one
+        if should_notify and not recorded:
             audit = {
                 'sender_username':   sender,
                 'receiver_username': receiver,
@@ -129,139 +186,259 @@ def create_transaction():
                 'amount':            amount,
                 'error':             msg
             }
-            es.index(index=TRANSACTION_INDEX, id=tx_id, body=audit)
-            logger.info(f"Notifying about failed transaction {tx_id} with reason: {msg}")
-            notify_transaction(tx_id, sdoc, rdoc, amount, 'failed', msg)
+            # Also drops a receiver history copy left by a transfer that failed midway
+            es.bulk(operations=[{'index': {'_index': catalog.load(es).write_index(timestamp), '_id': tx_id}}, audit]
+                    + projection_actions(tx_id, audit, correction=True)
+                    + rollup_actions(stats_entries(tx_id, audit))
+                    + stats_actions(stats_entries(tx_id, audit))
+                    + outbox_actions(event))
+        if should_notify:
+            # Replaces the completed event stored by a rolled-back transfer
+            notify(event, stored=not recorded)
         return jsonify({'message': msg}), code
 
-    # Fetch & check PIN & verify sender
-    try:
-        sdoc = es.get(index=CARD_INDEX, id=sender)['_source']
-        logger.info(f"Found sender card for {sender}")
-    except NotFoundError:
-        logger.error(f"Sender card not found: {sender}")
+    # Fetch sender & receiver cards in one round trip
+    sdoc = rdoc = None
+    if not sender:
+        logger.warning("Missing sender username")
         return fail('Sender card not found', 404, should_notify=False)
-
-    # Fetch receiver
-    try:
-        rdoc = es.get(index=CARD_INDEX, id=receiver)['_source']
-        logger.info(f"Found receiver card for {receiver}")
-    except NotFoundError:
-        logger.error(f"Receiver card not found: {receiver}")
+    if not receiver:
+        logger.warning("Missing receiver username")
         return fail('Receiver not found', 404, should_notify=False)
+    sender_card, receiver_card = fetch_versioned_cards(es, CARD_INDEX, sender, receiver)
+    sdoc = sender_card[0] if sender_card else None
+    rdoc = receiver_card[0] if receiver_card else None
 
-    # Verify token matches sender
-    if current_phone != sdoc.get('phone'):
-        logger.error(f"Token mismatch: {current_phone} != {sdoc.get('phone')}")
-        return fail('Invalid sender', 403, should_notify=False)
+    if sdoc is None:
+        logger.warning("Sender card not found: %s", sender)
+        return fail('Sender card not found', 404, should_notify=False)
 
-    # Basic payload validation
-    if not all([sender, receiver, amount, pin]) or amount <= 0:
-        logger.error(f"Invalid transaction payload: {data}")
-        return fail('Invalid transaction payload', 400, should_notify=False)
+    if rdoc is None:
+        logger.warning("Receiver card not found: %s", receiver)
+        return fail('Receiver not found', 404, should_notify=False)
 
-    # Prevent self-transactions
-    if sender == receiver:
-        logger.warning(f"Self-transaction attempted: {sender}")
-        return fail('Cannot send money to yourself', 400, should_notify=False)
+    # Token, payload, PIN and balance checks
+    rejection = check_transfer(current_phone, sender, receiver, amount, pin, sdoc)
+    if rejection:
+        msg, code, should_notify = rejection
+        return fail(msg, code, should_notify=should_notify)
 
-    # Verify PIN
-    if sdoc.get('pin') != pin:
-        logger.warning(f"Invalid PIN for user: {sender}")
-        return fail('invalid PIN', 401, should_notify=True)
+    # 3) All checks passed → conditional debit, then credit and audit in one bulk request
+    try:
+        logger.debug("Processing transfer of %s from %s to %s", amount, sender, receiver)
+        if LOG_TRANSFER_BALANCES:
+            log_balances(es, CARD_INDEX, sender, receiver, 'Before')
+
+        audit = {
+            'sender_username':   sender,
+            'receiver_username': receiver,
+            'timestamp':         timestamp,
+            'status':            'completed',
+            'amount':            amount
+        }
+        event = transaction_event(tx_id, sdoc, rdoc, amount, 'completed', None)
+        _, seq_no, primary_term = sender_card
+        money_may_move()
+        execute_transfer(es, CARD_INDEX, catalog.load(es).write_index(timestamp), tx_id, sender, receiver,
+                         amount, audit, seq_no, primary_term, extra_actions=outbox_actions(event))
+        card_cache.invalidate(sender)
+        card_cache.invalidate(receiver)
+        logger.info("Transaction completed: %s from %s to %s", amount, sender, receiver)
+
+        if LOG_TRANSFER_BALANCES:
+            log_balances(es, CARD_INDEX, sender, receiver, 'After')
 
-    # Balance check
-    if float(sdoc.get('balance', 0)) < amount:
-        logger.warning(f"Insufficient balance for {sender}: {sdoc.get('balance')} < {amount}")
+        # Notify both
+        notify(event)
+        return jsonify({'message':'Transaction completed','trans_id':tx_id}), 201
+
+    except InsufficientBalance:
+        logger.warning("Insufficient balance for %s after concurrent update", sender)
         return fail('Insufficient balance', 400, should_notify=True)
 
-    # 3) All checks passed → perform debit/credit
-    try:
-        logger.info(f"Processing transaction {tx_id}: {amount} from {sender} to {receiver}")
-        
-        # Log the current balances before transaction
-        try:
-            sender_balance = es.get(index=CARD_INDEX, id=sender)['_source'].get('balance', 0)
-            receiver_balance = es.get(index=CARD_INDEX, id=receiver)['_source'].get('balance', 0)
-            logger.info(f"Before transaction - Sender balance: {sender_balance}, Receiver balance: {receiver_balance}")
-        except Exception as e:
-            logger.error(f"Error fetching initial balances: {str(e)}")
+    except TransferConflict as e:
+        logger.error("Transaction aborted: %s", e)
+        return fail('Card is busy, please retry', 409, should_notify=True)
 
-        # Update sender balance
-        try:
-            es.update(
-                index=CARD_INDEX,
-                id=sender,
-                body={'script':{
-                    'source':'ctx._source.balance-=params.amt',
-                    'lang':'painless',
-                    'params':{'amt':amount}
-                }}
-            )
-            logger.info(f"Successfully updated sender balance")
-        except Exception as e:
-            logger.error(f"Error updating sender balance: {str(e)}")
-            raise
+    except TransferError as e:
+        logger.error("Transaction rolled back: %s", e)
+        return fail('Transaction failed', 500, should_notify=True, recorded=True)
 
-        # Update receiver balance
-        try:
-            es.update(
-                index=CARD_INDEX,
-                id=receiver,
-                body={'script':{
-                    'source':'ctx._source.balance+=params.amt',
-                    'lang':'painless',
-                    'params':{'amt':amount}
-                }}
-            )
-            logger.info(f"Successfully updated receiver balance")
-        except Exception as e:
-            logger.error(f"Error updating receiver balance: {str(e)}")
-            raise
+    except TransferPending as e:
+        # Money has moved or will be refunded by reconcile_transfers.py; no failed audit on top.
+        # A stored event waits for that: the sweeper skips pending transfers.
+        logger.error("Transaction pending: %s", e)
+        card_cache.invalidate(sender)
+        card_cache.invalidate(receiver)
+        return jsonify({'message': 'Transaction is pending', 'trans_id': tx_id}), 202
 
-        # Mark completed
-        try:
-            audit = {
+    except Exception as e:
+        # Traceback is rendered off-thread by the log listener
+        logger.exception("Transaction failed with error: %s", e)
+        return fail('Transaction failed', 500, should_notify=True)
+
+@app.route('/transactions/batch', methods=['POST'])
+@bootstrap_required(bootstrap)
+@jwt_required()
+@idempotent(idempotency)
+def create_transaction_batch():
+    """
+    Pay many receivers from one sender in a single request.
+    Body JSON:
+    {
+      "sender_username": str,
+      "pin": str,
+      "transfers": [{"receiver_username": str, "amount": float}, ...]
+    }
+    The sender and PIN are checked once, all cards are fetched with one
+    mget, the total is debited once and every credit and audit record goes
+    through one bulk request. Each transfer gets its own result.
+    """
+    current_phone = get_jwt_identity()
+    data = request.get_json() or {}
+    sender    = data.get('sender_username')
+    pin       = data.get('pin')
+    transfers = data.get('transfers')
+    batch_id  = uuid.uuid4().hex
+    timestamp = datetime.utcnow().isoformat()+'Z'
+    log.bind_trans_id(batch_id)
+    logger.debug("Batch request from %s", current_phone)
+
+    if not sender or not pin or not isinstance(transfers, list) or not transfers:
+        return jsonify({'message': 'Invalid batch payload'}), 400
+    if len(transfers) > BATCH_MAX_TRANSFERS:
+        return jsonify({'message': f'A batch may contain at most {BATCH_MAX_TRANSFERS} transfers'}), 400
+
+    receivers = [t.get('receiver_username') if isinstance(t, dict) else None for t in transfers]
+    usernames = [sender] + sorted({r for r in receivers if r and r != sender})
+    cards = dict(zip(usernames, fetch_versioned_cards(es, CARD_INDEX, *usernames)))
+
+    sender_card = cards[sender]
+    if sender_card is None:
+        return jsonify({'message': 'Sender card not found'}), 404
+    sdoc, seq_no, primary_term = sender_card
+    if current_phone != sdoc.get('phone'):
+        logger.warning("Token mismatch: %s != %s", current_phone, sdoc.get('phone'))
+        return jsonify({'message': 'Invalid sender'}), 403
+    if sdoc.get('pin') != pin:
+        logger.warning("Invalid PIN for user: %s", sender)
+        return jsonify({'message': 'invalid PIN'}), 401
+
+    # Validate each transfer against the running balance
+    remaining = float(sdoc.get('balance', 0))
+    results, accepted, short = [], [], []
+    for i, (transfer, receiver) in enumerate(zip(transfers, receivers)):
+        amount = transfer.get('amount') if isinstance(transfer, dict) else None
+        result = {'index': i, 'receiver_username': receiver, 'amount': amount}
+        results.append(result)
+        if not receiver or not isinstance(amount, (int, float)) or amount <= 0:
+            result.update(status='rejected', code=400, message='Invalid transaction payload')
+            continue
+        if receiver == sender:
+            result.update(status='rejected', code=400, message='Cannot send money to yourself')
+            continue
+        if cards.get(receiver) is None:
+            result.update(status='rejected', code=404, message='Receiver not found')
+            continue
+
+        item = {
+            'tx_id':    uuid.uuid4().hex,
+            'receiver': receiver,
+            'amount':   amount,
+            'result':   result,
+            'audit': {
                 'sender_username':   sender,
                 'receiver_username': receiver,
                 'timestamp':         timestamp,
                 'status':            'completed',
-                'amount':            amount
+                'amount':            amount,
+                'batch_id':          batch_id
             }
-            es.index(index=TRANSACTION_INDEX, id=tx_id, body=audit)
-            logger.info(f"Successfully created transaction audit record")
-        except Exception as e:
-            logger.error(f"Error creating transaction audit: {str(e)}")
-            raise
-
-        # Log final balances
+        }
+        result['trans_id'] = item['tx_id']
+        if amount > remaining:
+            item['audit'].update(status='failed', error='Insufficient balance')
+            result.update(status='failed', code=400, message='Insufficient balance')
+            short.append(item)
+            continue
+        remaining -= amount
+        accepted.append(item)
+
+    tx_index = catalog.load(es).write_index(timestamp)
+
+    def audit_actions(items, correction=False):
+        actions = []
+        for item in items:
+            actions += [{'index': {'_index': tx_index, '_id': item['tx_id']}}, item['audit']]
+            actions += projection_actions(item['tx_id'], item['audit'], correction)
+        entries = [entry for item in items for entry in stats_entries(item['tx_id'], item['audit'])]
+        return actions + rollup_actions(entries) + stats_actions(entries)
+
+    # One notification event for the whole batch, stored with its audit records
+    event = batch_event(batch_id, sdoc, accepted + short, cards)
+
+    def fail_accepted(msg, code):
+        for item in accepted:
+            item['audit'].update(status='failed', error=msg)
+            item['result'].update(status='failed', code=code, message=msg)
+        failed_event = batch_event(batch_id, sdoc, accepted + short, cards)
+        es.bulk(operations=audit_actions(accepted, correction=True) + audit_actions(short)
+                + outbox_actions(failed_event))
+        return failed_event
+
+    if accepted:
         try:
-            sender_balance = es.get(index=CARD_INDEX, id=sender)['_source'].get('balance', 0)
-            receiver_balance = es.get(index=CARD_INDEX, id=receiver)['_source'].get('balance', 0)
-            logger.info(f"After transaction - Sender balance: {sender_balance}, Receiver balance: {receiver_balance}")
+            money_may_move()
+            failed = set(execute_batch(es, CARD_INDEX, tx_index, sender, accepted, seq_no, primary_term,
+                                       extra_actions=audit_actions(short) + outbox_actions(event)))
+            for item in accepted:
+                if item['tx_id'] in failed:
+                    item['audit'].update(status='failed', error='Transaction failed')
+                    item['result'].update(status='failed', code=500, message='Transaction failed')
+                else:
+                    item['result'].update(status='completed', code=201, message='Transaction completed')
+        except InsufficientBalance:
+            event = fail_accepted('Insufficient balance', 400)
+        except TransferConflict:
+            event = fail_accepted('Card is busy, please retry', 409)
+        except TransferPending:
+            # Settled by reconcile_transfers.py; nothing is written or notified for them here
+            for item in accepted:
+                item['audit']['status'] = 'pending'
+                item['result'].update(status='pending', code=202, message='Transaction is pending')
         except Exception as e:
-            logger.error(f"Error fetching final balances: {str(e)}")
-
-        # Notify both
-        notify_transaction(tx_id, sdoc, rdoc, amount, 'completed', None)
-        return jsonify({'message':'Transaction completed','trans_id':tx_id}), 201
-
-    except Exception as e:
-        error_msg = f"Transaction {tx_id} failed with error: {str(e)}"
-        logger.error(error_msg)
-        # Log the full exception details
-        import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
-        return fail('Transaction failed', 500, should_notify=True)
+            logger.exception("Batch failed with error: %s", e)
+            event = fail_accepted('Transaction failed', 500)
+        card_cache.invalidate(sender)
+        for item in accepted:
+            card_cache.invalidate(item['receiver'])
+    elif short:
+        es.bulk(operations=audit_actions(short) + outbox_actions(event))
+
+    # Rolled-back or pending transfers change the stored event
+    settled = [item for item in accepted + short if item['audit']['status'] != 'pending']
+    if settled:
+        final = batch_event(batch_id, sdoc, settled, cards)
+        notify(final, stored=final['items'] == event['items'])
+
+    completed = sum(1 for r in results if r['status'] == 'completed')
+    pending = sum(1 for r in results if r['status'] == 'pending')
+    logger.info("Batch: %d/%d transfers completed", completed, len(results))
+    return jsonify({
+        'batch_id':  batch_id,
+        'completed': completed,
+        'pending':   pending,
+        'failed':    len(results) - completed - pending,
+        'results':   results
+    }), 201 if completed == len(results) else 207
 
 @app.route('/transaction/<string:trans_id>', methods=['GET'])
 @jwt_required()
 def get_transaction(trans_id):
-    logger.info(f"Fetching transaction: {trans_id}")
-    try:
-        tx = es.get(index=TRANSACTION_INDEX, id=trans_id)['_source']
-    except NotFoundError:
-        logger.warning(f"Transaction not found: {trans_id}")
+    log.bind_trans_id(trans_id)
+    tx = find_transaction(es, trans_id)
+    if tx is None:
+        logger.info("Transaction not found")
         return jsonify({'message':'Transaction not found'}), 404
 
     cur_phone = get_jwt_identity()
@@ -270,59 +447,66 @@ def get_transaction(trans_id):
 
     # If user is neither sender nor receiver
     if s_phone != cur_phone and r_phone != cur_phone:
-        logger.warning(f"Unauthorized access attempt to transaction {trans_id} by {cur_phone}")
+        logger.warning("Unauthorized access attempt to transaction by %s", cur_phone)
         return jsonify({'message':'Forbidden'}), 403
     
     # If user is receiver and transaction is failed, don't show it
     if r_phone == cur_phone and tx.get('status') == 'failed':
-        logger.info(f"Receiver {r_phone} attempted to view failed transaction {trans_id}")
+        logger.info("Receiver %s attempted to view a failed transaction", r_phone)
         return jsonify({'message':'Transaction not found'}), 404
 
-    logger.info(f"Successfully retrieved transaction {trans_id}")
     return jsonify(tx), 200
 
 @app.route('/transactions/<string:username>', methods=['GET'])
 @jwt_required()
 def get_transactions_for_user(username):
-    logger.info(f"Fetching transactions for user: {username}")
     current_phone = get_jwt_identity()
     user_phone = username_to_phone(username)
     if current_phone != user_phone:
-        logger.warning(f"Unauthorized access attempt to user {username}'s transactions by {current_phone}")
+        logger.warning("Unauthorized access attempt to %s's transactions by %s", username, current_phone)
         return jsonify({'message':'Forbidden'}), 403
 
-    # Get all transactions where user is either sender or receiver
-    q = {
-        "query": {
-            "bool": {
-                "should": [
-                    {"term": {"sender_username.keyword": username}},  # Using .keyword for exact match
-                    {"term": {"receiver_username.keyword": username}}  # Using .keyword for exact match
-                ]
-            }
-        },
-        "size": 10000,  # Set a large size to get all transactions
-        "sort": [
-            {"timestamp": {"order": "desc"}}  # Sort by timestamp in descending order (newest first)
-        ]
-    }
-    res = es.search(index=TRANSACTION_INDEX, body=q)
-    txs = []
-    
-    # Filter transactions based on user role and status
-    for hit in res['hits']['hits']:
-        tx = hit['_source']
-        tx['trans_id'] = hit['_id']  # Add transaction ID to the response
-        # If user is sender, show all transactions
-        if tx['sender_username'] == username:  # Exact case match
-            txs.append(tx)
-        # If user is receiver, only show successful transactions
-        elif tx['receiver_username'] == username and tx.get('status') != 'failed':  # Exact case match
-            txs.append(tx)
-    
-    logger.info(f"Found {len(txs)} transactions for user {username}")
+    limit  = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    stream = request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+    # Optional time range; only the overlapping monthly partitions are read
+    try:
+        since, until = parse_range(request.args.get('from'), request.args.get('to'))
+    except ValueError:
+        return jsonify({'message': 'Invalid date range'}), 400
+
+    # Streamed NDJSON: one transaction per line, memory stays flat
+    if stream:
+        def generate():
+            for tx in iter_history(es, username, since=since, until=until):
+                yield json.dumps(tx) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    # Cursor pagination
+    if limit is not None or cursor:
+        try:
+            limit = int(limit) if limit is not None else HISTORY_PAGE_SIZE
+        except ValueError:
+            return jsonify({'message': 'Invalid limit'}), 400
+        if not 0 < limit <= HISTORY_MAX_LIMIT:
+            return jsonify({'message': f'limit must be between 1 and {HISTORY_MAX_LIMIT}'}), 400
+        try:
+            txs, next_cursor = fetch_page(es, username, limit, cursor, since, until)
+        except InvalidCursor:
+            return jsonify({'message': 'Invalid cursor'}), 400
+        except NotFoundError:
+            return jsonify({'message': 'Cursor expired'}), 410
+        logger.info("Returning page of %d transactions for user %s", len(txs), username)
+        return jsonify({'transactions': txs, 'next_cursor': next_cursor}), 200
+
+    # Full history, fetched page by page so nothing past 10,000 hits is lost
+    txs = list(iter_history(es, username, since=since, until=until))
+    logger.info("Found %d transactions for user %s", len(txs), username)
     return jsonify({'transactions': txs}), 200
 
+register_health_routes(app, bootstrap)
+
 if __name__ == '__main__':
     PORT = int(os.getenv('TRANS_PORT'))
-    app.run(host='0.0.0.0', port=PORT, debug=True)
+    app.run(host='0.0.0.0', port=PORT)
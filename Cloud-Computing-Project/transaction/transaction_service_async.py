@@ -0,0 +1,350 @@
+"""
+asyncio (ASGI) variant of the transaction service.
+
+Serves the same POST /transactions, GET /transaction/<id> and
+GET /transactions/<username> routes as transaction_service.py, but every
+Elasticsearch and notification call is awaited instead of pinning a worker
+thread, so one process can hold thousands of in-flight transfers.
+Batch payouts and Idempotency-Key handling stay on the WSGI service.
+
+Run with:
+    uvicorn transaction_service_async:app --host 0.0.0.0 --port $TRANS_PORT
+"""
+import time
+STARTED_AT = time.perf_counter()
+
+import os
+import json
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+from elasticsearch import AsyncElasticsearch, NotFoundError
+from common import log, metrics, tracing, compression
+from common.card_cache import TTLCache
+from common.bootstrap import AsyncBootstrap, quart_bootstrap_required, register_quart_health_routes
+from common.jwt_auth import TokenVerifier, jwt_required, get_jwt_identity
+from notification_outbox import AsyncNotificationOutbox, ensure_outbox_index_async, outbox_actions
+from transfer_engine import (
+    check_transfer, fetch_versioned_cards_async, execute_transfer_async,
+    TransferError, InsufficientBalance, TransferConflict, TransferPending
+)
+from transaction_index import (
+    ensure_transaction_index_async, ensure_history_index_async, projection_actions, catalog,
+    find_transaction_async
+)
+from user_stats import ensure_user_stats_index_async, stats_entries, stats_actions
+from user_rollups import ensure_rollup_index_async, rollup_actions
+from history import (
+    fetch_page_async, iter_history_async, parse_range, InvalidCursor, HISTORY_PAGE_SIZE, HISTORY_MAX_LIMIT
+)
+
+# ─── LOGGING CONFIG ───────────────────────────────────────────────────────────
+# Each request runs in its own task, so the bound trans_id never leaks between requests
+log.configure('transaction-async')
+logger = logging.getLogger(__name__)
+app = Quart(__name__)
+
+# ─── CORS CONFIG ─────────────────────────────────────────────────────────────
+app = cors(
+    app,
+    allow_origin="*",
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
+    expose_headers=["Content-Type", "Authorization"],
+    max_age=3600
+)
+metrics.init_quart_app(app)
+tracing.init_quart_app(app, 'transaction-async')
+compression.init_quart_app(app)
+
+# ─── JWT CONFIG ───────────────────────────────────────────────────────────────
+# Same checks and error bodies as flask-jwt-extended in the Flask services
+jwt_verifier = TokenVerifier.from_env()
+
+# ─── ELASTICSEARCH CLIENT ─────────────────────────────────────────────────────
+ES_HOST = os.getenv('ES_HOST')
+ES_PORT = os.getenv('ES_PORT')
+ES_USERNAME = os.getenv('ELASTIC_USERNAME')
+ES_PASSWORD = os.getenv('ELASTIC_PASSWORD')
+# Connections per ES node; bounds how many requests are on the wire at once
+ES_MAX_CONNECTIONS = int(os.getenv('ES_MAX_CONNECTIONS', 100))
+
+CARD_INDEX        = 'cards'
+
+# Created on the serving loop in startup()
+es = None
+
+# Index setup runs on the serving loop once the client exists; /readyz reports it
+bootstrap = AsyncBootstrap('transaction-async', started_at=STARTED_AT)
+bootstrap.step(ensure_transaction_index_async)
+bootstrap.step(ensure_history_index_async)
+bootstrap.step(ensure_user_stats_index_async)
+bootstrap.step(ensure_rollup_index_async)
+bootstrap.step(ensure_outbox_index_async)
+
+# ─── NOTIFICATION SERVICE ────────────────────────────────────────────────────
+NOTIFY_URL = os.getenv('NOTIFY_URL')
+NOTIFY_BATCH_URL = os.getenv('NOTIFY_BATCH_URL', f'{NOTIFY_URL}/batch')
+SERVICE_SECRET = os.getenv('SERVICE_SECRET')
+
+outbox = AsyncNotificationOutbox.from_env(NOTIFY_BATCH_URL, {
+    'X-Service-Token': SERVICE_SECRET,
+    'Content-Type':  'application/json'
+}, card_index=CARD_INDEX)
+
+# username -> phone; a card's phone never changes once it is issued
+phone_cache = TTLCache(
+    int(os.getenv('CARD_CACHE_SIZE', 10000)),
+    float(os.getenv('CARD_PHONE_TTL', 3600)),
+    name='card_phones'
+)
+
+@app.before_serving
+async def startup():
+    global es
+    # Creating the client does not connect; nothing here waits on ES
+    es = tracing.instrument_es(metrics.instrument_es(AsyncElasticsearch(
+        [f'http://{ES_HOST}:{ES_PORT}'],
+        basic_auth=(ES_USERNAME, ES_PASSWORD),
+        connections_per_node=ES_MAX_CONNECTIONS
+    )))
+    bootstrap.start(es)
+    await outbox.start(es)
+    logger.info("Transaction service ready to serve in %.1f ms", (time.perf_counter() - STARTED_AT) * 1000)
+
+@app.after_serving
+async def shutdown():
+    bootstrap.stop()
+    await outbox.close()
+    await es.close()
+
+def transaction_event(tx, sdoc, rdoc, amt, status, reason):
+    return {
+        'trans_id':          tx,
+        'sender_doc':        sdoc,
+        'receiver_doc':      rdoc,
+        'amount':            amt,
+        'status':            status,
+        'reason':            reason
+    }
+
+async def notify(event, stored=True):
+    """Queue `event`; one not `stored` with its audit record is stored on its own first."""
+    logger.debug("Queueing notification for transaction %s with status %s", event['trans_id'], event['status'])
+    if stored:
+        outbox.enqueue(event)
+    else:
+        await outbox.record(event)
+
+async def username_to_phone(username):
+    """
+    Given a username (used as the ES doc‐ID in the cards index),
+    return the associated phone number, or None if not found.
+    """
+    phone = phone_cache.get(username)
+    if phone is not None:
+        return phone
+    try:
+        phone = (await es.get(index=CARD_INDEX, id=username))['_source'].get('phone')
+    except NotFoundError:
+        logger.warning("Card not found for username: %s", username)
+        return None
+    if phone is not None:
+        phone_cache.set(username, phone)
+    return phone
+
+@app.route('/transactions', methods=['POST'])
+@quart_bootstrap_required(bootstrap)
+@jwt_required(jwt_verifier)
+async def create_transaction():
+    current_phone = get_jwt_identity()
+    data = await request.get_json(silent=True) or {}
+
+    sender   = data.get('sender_username')
+    receiver = data.get('receiver_username')
+    amount   = data.get('amount')
+    pin      = data.get('pin')
+
+    # 1) Generate tx_id & get timestamp
+    tx_id     = uuid.uuid4().hex
+    timestamp = datetime.utcnow().isoformat()+'Z'
+    log.bind_trans_id(tx_id)
+    logger.debug("Transaction request from %s", current_phone)
+
+    sdoc = rdoc = None
+
+    # 2) Early validation helpers
+    async def fail(msg, code=400, should_notify=True, recorded=False):
+        logger.warning("Transaction failed: %s", msg)
+        event = transaction_event(tx_id, sdoc, rdoc, amount, 'failed', msg)
+        # A rolled-back transfer already has its failed audit
+        if should_notify and not recorded:
+            audit = {
+                'sender_username':   sender,
+                'receiver_username': receiver,
+                'timestamp':         timestamp,
+                'status':            'failed',
+                'amount':            amount,
+                'error':             msg
+            }
+            tx_index = (await catalog.load_async(es)).write_index(timestamp)
+            await es.bulk(operations=[{'index': {'_index': tx_index, '_id': tx_id}}, audit]
+                          + projection_actions(tx_id, audit, correction=True)
+                          + rollup_actions(stats_entries(tx_id, audit))
+                          + stats_actions(stats_entries(tx_id, audit))
+                          + outbox_actions(event))
+        if should_notify:
+            # Replaces the completed event stored by a rolled-back transfer
+            await notify(event, stored=not recorded)
+        return jsonify({'message': msg}), code
+
+    # Fetch sender & receiver cards in one round trip
+    if not sender:
+        logger.warning("Missing sender username")
+        return await fail('Sender card not found', 404, should_notify=False)
+    if not receiver:
+        logger.warning("Missing receiver username")
+        return await fail('Receiver not found', 404, should_notify=False)
+    sender_card, receiver_card = await fetch_versioned_cards_async(es, CARD_INDEX, sender, receiver)
+    sdoc = sender_card[0] if sender_card else None
+    rdoc = receiver_card[0] if receiver_card else None
+
+    if sdoc is None:
+        logger.warning("Sender card not found: %s", sender)
+        return await fail('Sender card not found', 404, should_notify=False)
+    if rdoc is None:
+        logger.warning("Receiver card not found: %s", receiver)
+        return await fail('Receiver not found', 404, should_notify=False)
+
+    # Token, payload, PIN and balance checks
+    rejection = check_transfer(current_phone, sender, receiver, amount, pin, sdoc)
+    if rejection:
+        msg, code, should_notify = rejection
+        return await fail(msg, code, should_notify=should_notify)
+
+    # 3) All checks passed → conditional debit, then credit and audit in one bulk request
+    try:
+        logger.debug("Processing transfer of %s from %s to %s", amount, sender, receiver)
+        audit = {
+            'sender_username':   sender,
+            'receiver_username': receiver,
+            'timestamp':         timestamp,
+            'status':            'completed',
+            'amount':            amount
+        }
+        event = transaction_event(tx_id, sdoc, rdoc, amount, 'completed', None)
+        _, seq_no, primary_term = sender_card
+        tx_index = (await catalog.load_async(es)).write_index(timestamp)
+        await execute_transfer_async(es, CARD_INDEX, tx_index, tx_id, sender, receiver, amount,
+                                     audit, seq_no, primary_term, extra_actions=outbox_actions(event))
+        logger.info("Transaction completed: %s from %s to %s", amount, sender, receiver)
+
+        await notify(event)
+        return jsonify({'message':'Transaction completed','trans_id':tx_id}), 201
+
+    except InsufficientBalance:
+        logger.warning("Insufficient balance for %s after concurrent update", sender)
+        return await fail('Insufficient balance', 400, should_notify=True)
+
+    except TransferConflict as e:
+        logger.error("Transaction aborted: %s", e)
+        return await fail('Card is busy, please retry', 409, should_notify=True)
+
+    except TransferError as e:
+        logger.error("Transaction rolled back: %s", e)
+        return await fail('Transaction failed', 500, should_notify=True, recorded=True)
+
+    except TransferPending as e:
+        # Money has moved or will be refunded by reconcile_transfers.py; no failed audit on top.
+        # A stored event waits for that: the sweeper skips pending transfers.
+        logger.error("Transaction pending: %s", e)
+        return jsonify({'message': 'Transaction is pending', 'trans_id': tx_id}), 202
+
+    except Exception:
+        logger.exception("Transaction failed")
+        return await fail('Transaction failed', 500, should_notify=True)
+
+@app.route('/transaction/<string:trans_id>', methods=['GET'])
+@jwt_required(jwt_verifier)
+async def get_transaction(trans_id):
+    log.bind_trans_id(trans_id)
+    tx = await find_transaction_async(es, trans_id)
+    if tx is None:
+        logger.info("Transaction not found")
+        return jsonify({'message':'Transaction not found'}), 404
+
+    cur_phone = get_jwt_identity()
+    # Both lookups are independent, so resolve them concurrently
+    s_phone, r_phone = await asyncio.gather(
+        username_to_phone(tx['sender_username']),
+        username_to_phone(tx['receiver_username'])
+    )
+
+    # If user is neither sender nor receiver
+    if s_phone != cur_phone and r_phone != cur_phone:
+        logger.warning("Unauthorized access attempt to transaction by %s", cur_phone)
+        return jsonify({'message':'Forbidden'}), 403
+
+    # If user is receiver and transaction is failed, don't show it
+    if r_phone == cur_phone and tx.get('status') == 'failed':
+        logger.info("Receiver %s attempted to view a failed transaction", r_phone)
+        return jsonify({'message':'Transaction not found'}), 404
+
+    return jsonify(tx), 200
+
+@app.route('/transactions/<string:username>', methods=['GET'])
+@jwt_required(jwt_verifier)
+async def get_transactions_for_user(username):
+    current_phone = get_jwt_identity()
+    user_phone = await username_to_phone(username)
+    if current_phone != user_phone:
+        logger.warning("Unauthorized access attempt to %s's transactions by %s", username, current_phone)
+        return jsonify({'message':'Forbidden'}), 403
+
+    limit  = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    stream = request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+    # Optional time range; only the overlapping monthly partitions are read
+    try:
+        since, until = parse_range(request.args.get('from'), request.args.get('to'))
+    except ValueError:
+        return jsonify({'message': 'Invalid date range'}), 400
+
+    # Streamed NDJSON: one transaction per line, memory stays flat
+    if stream:
+        async def generate():
+            async for tx in iter_history_async(es, username, since=since, until=until):
+                yield (json.dumps(tx) + '\n').encode()
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    # Cursor pagination
+    if limit is not None or cursor:
+        try:
+            limit = int(limit) if limit is not None else HISTORY_PAGE_SIZE
+        except ValueError:
+            return jsonify({'message': 'Invalid limit'}), 400
+        if not 0 < limit <= HISTORY_MAX_LIMIT:
+            return jsonify({'message': f'limit must be between 1 and {HISTORY_MAX_LIMIT}'}), 400
+        try:
+            txs, next_cursor = await fetch_page_async(es, username, limit, cursor, since, until)
+        except InvalidCursor:
+            return jsonify({'message': 'Invalid cursor'}), 400
+        except NotFoundError:
+            return jsonify({'message': 'Cursor expired'}), 410
+        logger.info("Returning page of %d transactions for user %s", len(txs), username)
+        return jsonify({'transactions': txs, 'next_cursor': next_cursor}), 200
+
+    # Full history, fetched page by page
+    txs = [tx async for tx in iter_history_async(es, username, since=since, until=until)]
+    logger.info("Found %d transactions for user %s", len(txs), username)
+    return jsonify({'transactions': txs}), 200
+
+register_quart_health_routes(app, bootstrap)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv('TRANS_PORT')))
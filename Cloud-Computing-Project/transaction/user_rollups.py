@@ -0,0 +1,224 @@
+"""
+The `user_rollups` projection: one document per user and hour with the
+totals of the transfers they can see in it, so a report over any range
+reads one document per active hour instead of every transaction.
+
+    _id "alice|2024-05-01T13", routed by username
+    {
+      "username": "alice", "hour": "2024-05-01T13:00:00Z", "period": "afternoon",
+      "sent":     {"count": 2, "total": 30.0},
+      "received": {"count": 0, "total": 0.0},
+      "failed": 1, "max_amount": 20.0,
+      "peers": [{"name": "bob", "role": "sent", "count": 2}]
+    }
+
+It is built from the same stats_entries as user_stats and rides in the
+same bulk requests: every bulk that writes audit records carries one
+scripted upsert per (user, hour) touched, just before the user_stats
+updates (rollup_actions, then stats_actions). A rolled-back transfer is
+subtracted again; as in user_stats, `max_amount` is not lowered until
+rebuild_rollups.py recomputes it. The reporting service reads a range
+with one search: a date_histogram over the hours with sums of the
+numbers, and a nested terms aggregation over `peers` for the top
+counterparties (see reporting/report_range.py).
+"""
+import logging
+from datetime import datetime
+from elasticsearch import BadRequestError
+from transaction_index import TRANSACTION_ALIAS
+from user_stats import RETRY_ON_CONFLICT, period
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_INDEX = 'user_rollups'
+
+# Everything a ranged report aggregates is indexed; `peers` is nested so
+# each counterparty's count stays paired with its name and role
+_SIDE = {'properties': {'count': {'type': 'long'}, 'total': {'type': 'double'}}}
+ROLLUP_MAPPINGS = {
+    'dynamic': False,
+    '_routing': {'required': True},
+    'properties': {
+        'username':   {'type': 'keyword'},
+        'hour':       {'type': 'date'},
+        'period':     {'type': 'keyword'},
+        'sent':       _SIDE,
+        'received':   _SIDE,
+        'failed':     {'type': 'long'},
+        'max_amount': {'type': 'double'},
+        'peers': {
+            'type': 'nested',
+            'properties': {
+                'name':  {'type': 'keyword'},
+                'role':  {'type': 'keyword'},
+                'count': {'type': 'long'}
+            }
+        }
+    }
+}
+
+# Painless twin of record() below; params: add, remove
+ROLLUP_SCRIPT = """
+void tally(Map s, Map e, int sign) {
+  if (e.status != 'completed') { s.failed += sign; return; }
+  Map side = s[e.role];
+  side.count += sign;
+  side.total += sign * e.amount;
+  if (sign > 0 && e.amount > s.max_amount) { s.max_amount = e.amount; }
+  if (s.peers == null) { s.peers = []; }
+  Map peer = null;
+  for (p in s.peers) { if (p.name == e.counterparty && p.role == e.role) { peer = p; } }
+  if (peer == null) { peer = ['name': e.counterparty, 'role': e.role, 'count': 0]; s.peers.add(peer); }
+  peer.count += sign;
+  s.peers.removeIf(p -> p.count <= 0);
+  s.peers.sort((a, b) -> a.role == b.role ? a.name.compareTo(b.name) : a.role.compareTo(b.role));
+}
+for (e in params.remove) { tally(ctx._source, e, -1); }
+for (e in params.add) { tally(ctx._source, e, 1); }
+"""
+
+
+def _meta(count):
+    # Complete from the start on a cluster with no transactions yet
+    return {'rebuilt_at': datetime.utcnow().isoformat() + 'Z'} if count == 0 else {}
+
+
+def _outdated(mapping):
+    # Written before `peers` and the numbers were indexed
+    return 'peers' not in mapping[ROLLUP_INDEX]['mappings'].get('properties', {})
+
+
+def _upgrade_note():
+    logger.warning("Indexed the rollup fields of %s; ranged reports read the history "
+                   "until rebuild_rollups.py has run", ROLLUP_INDEX)
+
+
+def ensure_rollup_index(es):
+    """
+    Bootstrap step: create the projection, or add the aggregated fields to
+    one created before they were indexed. Either way, until
+    rebuild_rollups.py has run on a cluster that already has transactions,
+    reporting serves ranges from the transaction history instead.
+    """
+    if es.indices.exists(index=ROLLUP_INDEX):
+        if _outdated(es.indices.get_mapping(index=ROLLUP_INDEX)):
+            # Replacing `_meta` drops rebuilt_at: the documents need rewriting
+            es.indices.put_mapping(index=ROLLUP_INDEX, properties=ROLLUP_MAPPINGS['properties'], meta={})
+            _upgrade_note()
+        return
+    count = es.count(index=TRANSACTION_ALIAS)['count'] if es.indices.exists(index=TRANSACTION_ALIAS) else 0
+    try:
+        es.indices.create(index=ROLLUP_INDEX, mappings=dict(ROLLUP_MAPPINGS, _meta=_meta(count)))
+        logger.info("Created hourly rollup projection %s", ROLLUP_INDEX)
+    except BadRequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+
+async def ensure_rollup_index_async(es):
+    """ensure_rollup_index for an AsyncElasticsearch client."""
+    if await es.indices.exists(index=ROLLUP_INDEX):
+        if _outdated(await es.indices.get_mapping(index=ROLLUP_INDEX)):
+            await es.indices.put_mapping(index=ROLLUP_INDEX, properties=ROLLUP_MAPPINGS['properties'], meta={})
+            _upgrade_note()
+        return
+    count = (await es.count(index=TRANSACTION_ALIAS))['count'] if await es.indices.exists(index=TRANSACTION_ALIAS) else 0
+    try:
+        await es.indices.create(index=ROLLUP_INDEX, mappings=dict(ROLLUP_MAPPINGS, _meta=_meta(count)))
+        logger.info("Created hourly rollup projection %s", ROLLUP_INDEX)
+    except BadRequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+
+def empty_rollup(username, hour):
+    return {
+        'username':   username,
+        'hour':       f'{hour}:00:00Z',
+        'period':     period(int(hour[11:13])),
+        'sent':       {'count': 0, 'total': 0.0},
+        'received':   {'count': 0, 'total': 0.0},
+        'failed':     0,
+        'max_amount': 0.0,
+        'peers':      []
+    }
+
+
+def rollup_key(username, entry):
+    """(username, 'YYYY-MM-DDTHH') of a stats entry, or None without a usable timestamp."""
+    hour = entry['timestamp'][:13]
+    return (username, hour) if len(hour) == 13 and hour[10] == 'T' else None
+
+
+def rollup_id(username, hour):
+    return f'{username}|{hour}'
+
+
+def rollup_keys(entries):
+    """(username, hour) in the order rollup_actions emits their updates."""
+    return list(dict.fromkeys(key for key in (rollup_key(u, e) for u, e in entries) if key))
+
+
+def rollup_actions(add, remove=()):
+    """
+    Bulk actions applying `add` and subtracting `remove` (both lists of
+    stats_entries), one scripted upsert per (user, hour) in rollup_keys order.
+    """
+    changes = {}
+    for name, entries in (('add', add), ('remove', remove)):
+        for username, entry in entries:
+            key = rollup_key(username, entry)
+            if key:
+                changes.setdefault(key, {'add': [], 'remove': []})[name].append(entry)
+    actions = []
+    for (username, hour), params in changes.items():
+        actions += [
+            {'update': {'_index': ROLLUP_INDEX, '_id': rollup_id(username, hour), 'routing': username,
+                        'retry_on_conflict': RETRY_ON_CONFLICT}},
+            {'scripted_upsert': True, 'upsert': empty_rollup(username, hour),
+             'script': {'source': ROLLUP_SCRIPT, 'lang': 'painless', 'params': params}}
+        ]
+    return actions
+
+
+# ─── PYTHON EQUIVALENT ───────────────────────────────────────────────────────
+def _tally(rollup, entry, sign):
+    if entry['status'] != 'completed':
+        rollup['failed'] += sign
+        return
+    side = rollup[entry['role']]
+    side['count'] += sign
+    side['total'] += sign * entry['amount']
+    if sign > 0 and entry['amount'] > rollup['max_amount']:
+        rollup['max_amount'] = entry['amount']
+    tally_peer(rollup.setdefault('peers', []), entry['counterparty'], entry['role'], sign)
+
+
+def tally_peer(peers, name, role, sign):
+    """Count one more (or one fewer) transfer with `name` in `role`; peers stay sorted by role and name."""
+    peer = next((p for p in peers if p['name'] == name and p['role'] == role), None)
+    if peer is None:
+        peer = {'name': name, 'role': role, 'count': 0}
+        peers.append(peer)
+    peer['count'] += sign
+    peers[:] = sorted((p for p in peers if p['count'] > 0), key=lambda p: (p['role'], p['name']))
+
+
+def record(rollup, add, remove=()):
+    """What ROLLUP_SCRIPT does to `rollup`; used by rebuilds and the benchmarks' fake ES."""
+    for entry in remove:
+        _tally(rollup, entry, -1)
+    for entry in add:
+        _tally(rollup, entry, 1)
+    return rollup
+
+
+def rollups_of(entries):
+    """{_id: document} of every hour in `entries` (stats_entries of one or more users)."""
+    rollups = {}
+    for username, entry in entries:
+        key = rollup_key(username, entry)
+        if key:
+            doc = rollups.setdefault(rollup_id(*key), empty_rollup(*key))
+            record(doc, [entry])
+    return rollups
@@ -0,0 +1,237 @@
+"""
+The `user_stats` projection: one document per user with the running
+totals the reporting service serves, so a report is a single get instead
+of a scan of the history.
+
+    {
+      "username": "alice",
+      "sent":     {"count": 12, "total": 310.5},
+      "received": {"count": 3,  "total": 40.0},
+      "completed": 15, "failed": 2, "max_amount": 120.0,
+      "daily":        {"2024-05-01": {"count": 2, "total_amount": 30.0}},
+      "time_of_day":  {"morning": 4, "afternoon": 9, "evening": 2, "night": 0},
+      "recipients":   {"bob": 7, ...},
+      "senders":      {"carol": 3, ...},
+      "recent":       [{"transaction_id": ..., "amount": ..., "type": "sent",
+                        "status": "completed", "timestamp": ...}, ...]
+    }
+
+It counts what the user can see, like the history: everything they sent,
+plus what they received unless it failed. Completed transfers feed the
+totals and buckets; failed ones only `failed` and `recent`.
+
+Every bulk that writes audit records ends with one scripted upsert per
+user touched (stats_actions), so a 500-item payout updates the sender's
+document once. A transfer rolled back after its bulk is subtracted again
+(see transfer_engine._compensation). Two values stay approximate after
+that until rebuild_user_stats.py recomputes them: `max_amount` is not
+lowered, and `recent` is one entry short for the receiver.
+"""
+import os
+import logging
+from datetime import datetime
+from elasticsearch import BadRequestError
+from transaction_index import TRANSACTION_ALIAS
+
+logger = logging.getLogger(__name__)
+
+USER_STATS_INDEX = 'user_stats'
+
+# Read by id only; the per-day and per-counterparty maps must not grow the mapping
+USER_STATS_MAPPINGS = {
+    'dynamic': False,
+    'properties': {
+        'username': {'type': 'keyword'}
+    }
+}
+
+RECENT_SIZE = int(os.getenv('USER_STATS_RECENT_SIZE', 5))
+# Stats updates are commutative, so ES may retry them internally
+RETRY_ON_CONFLICT = int(os.getenv('USER_STATS_RETRY_ON_CONFLICT', 5))
+
+# Painless twin of record() below; params: add, remove, recent_size
+STATS_SCRIPT = """
+void tally(Map s, Map e, int sign) {
+  if (e.status != 'completed') { s.failed += sign; return; }
+  Map side = s[e.role];
+  side.count += sign;
+  side.total += sign * e.amount;
+  s.completed += sign;
+  if (sign > 0 && e.amount > s.max_amount) { s.max_amount = e.amount; }
+  Map day = s.daily[e.day];
+  if (day == null) { day = ['count': 0, 'total_amount': 0.0]; s.daily[e.day] = day; }
+  day.count += sign;
+  day.total_amount += sign * e.amount;
+  if (day.count <= 0) { s.daily.remove(e.day); }
+  s.time_of_day[e.period] += sign;
+  Map peers = e.role == 'sent' ? s.recipients : s.senders;
+  def n = peers.getOrDefault(e.counterparty, 0) + sign;
+  if (n > 0) { peers[e.counterparty] = n; } else { peers.remove(e.counterparty); }
+}
+void forget(List recent, def id) {
+  for (int i = recent.size() - 1; i >= 0; i--) {
+    if (recent[i].transaction_id == id) { recent.remove(i); }
+  }
+}
+Map s = ctx._source;
+for (e in params.remove) { tally(s, e, -1); forget(s.recent, e.id); }
+for (e in params.add) {
+  tally(s, e, 1);
+  forget(s.recent, e.id);
+  s.recent.add(['transaction_id': e.id, 'amount': e.amount, 'type': e.role,
+                'status': e.status, 'timestamp': e.timestamp]);
+}
+s.recent.sort((a, b) -> {
+  int c = b.timestamp.compareTo(a.timestamp);
+  return c != 0 ? c : b.transaction_id.compareTo(a.transaction_id);
+});
+while (s.recent.size() > params.recent_size) { s.recent.remove(s.recent.size() - 1); }
+"""
+
+
+def ensure_user_stats_index(es):
+    """
+    Bootstrap step: create the projection. On a cluster with no transactions
+    yet it is complete from the start; otherwise reporting keeps computing
+    reports from the transactions until rebuild_user_stats.py has run.
+    """
+    if es.indices.exists(index=USER_STATS_INDEX):
+        return
+    meta = {}
+    if not es.indices.exists(index=TRANSACTION_ALIAS) or es.count(index=TRANSACTION_ALIAS)['count'] == 0:
+        meta['rebuilt_at'] = datetime.utcnow().isoformat() + 'Z'
+    try:
+        es.indices.create(index=USER_STATS_INDEX, mappings=dict(USER_STATS_MAPPINGS, _meta=meta))
+        logger.info("Created user stats projection %s", USER_STATS_INDEX)
+    except BadRequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+
+async def ensure_user_stats_index_async(es):
+    """ensure_user_stats_index for an AsyncElasticsearch client."""
+    if await es.indices.exists(index=USER_STATS_INDEX):
+        return
+    meta = {}
+    if not await es.indices.exists(index=TRANSACTION_ALIAS) or (await es.count(index=TRANSACTION_ALIAS))['count'] == 0:
+        meta['rebuilt_at'] = datetime.utcnow().isoformat() + 'Z'
+    try:
+        await es.indices.create(index=USER_STATS_INDEX, mappings=dict(USER_STATS_MAPPINGS, _meta=meta))
+        logger.info("Created user stats projection %s", USER_STATS_INDEX)
+    except BadRequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+
+
+def empty_stats(username):
+    return {
+        'username':    username,
+        'sent':        {'count': 0, 'total': 0.0},
+        'received':    {'count': 0, 'total': 0.0},
+        'completed':   0,
+        'failed':      0,
+        'max_amount':  0.0,
+        'daily':       {},
+        'time_of_day': {'morning': 0, 'afternoon': 0, 'evening': 0, 'night': 0},
+        'recipients':  {},
+        'senders':     {},
+        'recent':      []
+    }
+
+
+def period(hour):
+    if 6 <= hour < 12:
+        return 'morning'
+    if 12 <= hour < 18:
+        return 'afternoon'
+    if 18 <= hour < 24:
+        return 'evening'
+    return 'night'
+
+
+def stats_entries(tx_id, audit):
+    """
+    (username, entry) for every user who can see the audit record. Dates
+    and buckets are worked out here so the script only adds numbers.
+    """
+    sender, receiver = audit.get('sender_username'), audit.get('receiver_username')
+    timestamp = audit.get('timestamp') or ''
+    try:
+        amount = float(audit.get('amount') or 0)
+    except (TypeError, ValueError):
+        amount = 0.0
+    try:
+        hour = int(timestamp[11:13])
+    except ValueError:
+        hour = 0
+    base = {'id': tx_id, 'amount': amount, 'status': audit.get('status'), 'timestamp': timestamp,
+            'day': timestamp[:10], 'period': period(hour)}
+    entries = [(sender, dict(base, role='sent', counterparty=receiver))]
+    if audit.get('status') != 'failed':
+        entries.append((receiver, dict(base, role='received', counterparty=sender)))
+    return entries
+
+
+def stats_owners(entries):
+    """Users in the order stats_actions emits their updates."""
+    return list(dict.fromkeys(username for username, _ in entries))
+
+
+def stats_actions(add, remove=()):
+    """
+    Bulk actions applying `add` and subtracting `remove` (both lists of
+    stats_entries), one scripted upsert per user in stats_owners order.
+    """
+    changes = {}
+    for key, entries in (('add', add), ('remove', remove)):
+        for username, entry in entries:
+            changes.setdefault(username, {'add': [], 'remove': []})[key].append(entry)
+    actions = []
+    for username, params in changes.items():
+        actions += [
+            {'update': {'_index': USER_STATS_INDEX, '_id': username, 'retry_on_conflict': RETRY_ON_CONFLICT}},
+            {'scripted_upsert': True, 'upsert': empty_stats(username),
+             'script': {'source': STATS_SCRIPT, 'lang': 'painless',
+                        'params': dict(params, recent_size=RECENT_SIZE)}}
+        ]
+    return actions
+
+
+# ─── PYTHON EQUIVALENT ───────────────────────────────────────────────────────
+def _tally(stats, entry, sign):
+    if entry['status'] != 'completed':
+        stats['failed'] += sign
+        return
+    side = stats[entry['role']]
+    side['count'] += sign
+    side['total'] += sign * entry['amount']
+    stats['completed'] += sign
+    if sign > 0 and entry['amount'] > stats['max_amount']:
+        stats['max_amount'] = entry['amount']
+    day = stats['daily'].setdefault(entry['day'], {'count': 0, 'total_amount': 0.0})
+    day['count'] += sign
+    day['total_amount'] += sign * entry['amount']
+    if day['count'] <= 0:
+        del stats['daily'][entry['day']]
+    stats['time_of_day'][entry['period']] += sign
+    peers = stats['recipients'] if entry['role'] == 'sent' else stats['senders']
+    count = peers.get(entry['counterparty'], 0) + sign
+    if count > 0:
+        peers[entry['counterparty']] = count
+    else:
+        peers.pop(entry['counterparty'], None)
+
+
+def record(stats, add, remove=(), recent_size=RECENT_SIZE):
+    """What STATS_SCRIPT does to `stats`; used by rebuilds and the benchmarks' fake ES."""
+    for entry in remove:
+        _tally(stats, entry, -1)
+        stats['recent'] = [r for r in stats['recent'] if r['transaction_id'] != entry['id']]
+    for entry in add:
+        _tally(stats, entry, 1)
+        stats['recent'] = [r for r in stats['recent'] if r['transaction_id'] != entry['id']]
+        stats['recent'].append({'transaction_id': entry['id'], 'amount': entry['amount'], 'type': entry['role'],
+                                'status': entry['status'], 'timestamp': entry['timestamp']})
+    stats['recent'].sort(key=lambda r: (r['timestamp'], r['transaction_id']), reverse=True)
+    del stats['recent'][recent_size:]
+    return stats
@@ -1,3 +1,6 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import os
 from datetime import datetime
 from flask import Flask, request, jsonify
@@ -8,6 +11,10 @@ from flask_jwt_extended import (
 from flask_cors import CORS
 from elasticsearch import Elasticsearch
 from werkzeug.security import generate_password_hash, check_password_hash
+from common import log, metrics, tracing
+from common.card_cache import CardCache
+from common.es_client import ProcessLocalClient
+from common.bootstrap import Bootstrap, register_health_routes
 import logging
 
 app = Flask(__name__)
@@ -24,49 +31,52 @@ ES_USERNAME = os.getenv('ELASTIC_USERNAME')
 ES_PASSWORD = os.getenv('ELASTIC_PASSWORD')
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(levelname)s - %(message)s'
-)
+log.configure('user_management')
 logger = logging.getLogger(__name__)
+log.init_app(app)
+metrics.init_app(app)
+tracing.init_app(app, 'user_management')
 
-# Log Elasticsearch configuration
-logger.info("Elasticsearch Configuration:")
-logger.info(f"Host: {ES_HOST}")
-logger.info(f"Port: {ES_PORT}")
-logger.info(f"Username: {ES_USERNAME}")
-logger.info(f"Password: {ES_PASSWORD}")  # Mask password for security
+# Log Elasticsearch configuration (never the password)
+logger.info("Elasticsearch configuration: host=%s port=%s username=%s", ES_HOST, ES_PORT, ES_USERNAME)
 ES_URL = os.getenv('ES_URL')
-try:
-    logger.info(f"Attempting to connect to Elasticsearch at {ES_URL}")
-    es = Elasticsearch(
-        [ES_URL],
-        basic_auth=(ES_USERNAME, ES_PASSWORD)
-    )
-    # Test the connection
-    if not es.ping():
-        logger.error(f"Failed to connect to Elasticsearch at {ES_URL}")
-        raise ConnectionError("Elasticsearch connection failed")
-    logger.info(f"Successfully connected to Elasticsearch at {ES_URL}")
-    # Log cluster information
-    cluster_info = es.info()
-    logger.info(f"Connected to Elasticsearch cluster: {cluster_info.get('name', 'unknown')}")
-    logger.info(f"Elasticsearch version: {cluster_info.get('version', {}).get('number', 'unknown')}")
-except Exception as e:
-    logger.error(f"Failed to initialize Elasticsearch client: {str(e)}")
-    raise
+# One client per process, created on first use (safe to fork). Nothing
+# talks to ES at import time; see the bootstrap below.
+es = ProcessLocalClient(lambda: Elasticsearch(
+    [ES_URL],
+    basic_auth=(ES_USERNAME, ES_PASSWORD)
+))
 
 # Index names
 USER_INDEX  = 'users'
 CARD_INDEX = 'cards'
 
+def fetch_card(username):
+    res = es.get(index=CARD_INDEX, id=username, ignore=[404])
+    return res['_source'] if res.get('found', False) else None
+
+card_cache = CardCache.from_env(fetch_card)
+
+def card_response(card):
+    """A card as the API returns it, without the transfer engine's bookkeeping."""
+    card = dict(card)
+    card.pop('pending', None)  # debits not yet settled, see transfer_engine
+    card.pop('credits', None)  # recent transfer credits, kept for reconcile_transfers
+    return card
+
+bootstrap = Bootstrap(es, 'user_management', started_at=STARTED_AT)
+
+@bootstrap.step
+def log_cluster_info(es):
+    cluster_info = es.info()
+    logger.info("Connected to Elasticsearch cluster: %s", cluster_info.get('name', 'unknown'))
+    logger.info("Elasticsearch version: %s", cluster_info.get('version', {}).get('number', 'unknown'))
+
 # — Users index: password, email(unique), birthdate, phone(unique), created_date —
-if not es.indices.exists(index=USER_INDEX):
-    es.indices.create(index=USER_INDEX)
+bootstrap.ensure_index(USER_INDEX)
 # — Cards index: card_id(unique), username(unique), cvv, cardnumber,
 #   exp_date, cardholder_name, created_date, balance, phone —
-if not es.indices.exists(index=CARD_INDEX):
-    es.indices.create(index=CARD_INDEX)
+bootstrap.ensure_index(CARD_INDEX)
 
 
 
@@ -206,6 +216,8 @@ def create_card():
 
     # Index with document ID = username
     es.index(index=CARD_INDEX, id=username, body=card_doc)
+    card_cache.invalidate(username, phone=True)
+    card_cache.prime(username, card_doc)
 
     return jsonify({'message': 'Card created', 'card_id': username}), 201
 
@@ -251,17 +263,17 @@ def get_card(username):
     card = verify_user_by_username(username)
     if not card:
         return jsonify({'message': 'Unauthorized'}), 403
-    return jsonify(card), 200
+    return jsonify(card_response(card)), 200
 
 def verify_user_by_username(username):
     # Get the currently authenticated user's phone from JWT
     current_user_phone = get_jwt_identity()
-    # Retrieve the card document by username (used as doc ID)
-    res = es.get(index=CARD_INDEX, id=username, ignore=[404])
-    if not res.get('found', False):
+    # Read fresh (the balance changes with every transfer), and let later
+    # ownership checks in this process use the phone it carries
+    card = fetch_card(username)
+    if not card:
         return False
-    card = res['_source']
-    # Check if the phone number in the card matches the current user
+    card_cache.prime(username, card)
     if card.get('phone') != current_user_phone:
         return False
     return card
@@ -271,7 +283,7 @@ def get_card_internal(username):
     res = es.get(index=CARD_INDEX, id=username, ignore=[404])
     if not res.get('found', False):
         return jsonify({'message': 'Card not found'}), 404
-    return jsonify(res['_source']), 200
+    return jsonify(card_response(res['_source'])), 200
 
 
 @app.route('/cards', methods=['GET'])
@@ -290,12 +302,14 @@ def get_cards():
     })
 
     hits = res['hits']['hits']
-    cards = [hit['_source'] for hit in hits]
+    cards = [card_response(hit['_source']) for hit in hits]
 
     return jsonify({'cards': cards}), 200
 
+register_health_routes(app, bootstrap)
+
 if __name__ == '__main__':
     PORT = int(os.getenv('USER_PORT'))
-    app.run(host='0.0.0.0', port=PORT, debug=True)
+    app.run(host='0.0.0.0', port=PORT)
     
 